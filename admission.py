@@ -0,0 +1,303 @@
+import math
+import threading
+from collections import deque
+from concurrent.futures import Future
+from time import time, perf_counter
+
+from utilityfolder.hash_util import hash_transaction
+from transaction import Transaction
+
+# The most transactions which wait for verification - beyond that new transactions are rejected with 503 until the workers catch up
+QUEUE_CAPACITY = 10000
+# Relayed transactions may only fill this share of the queue, the rest is kept free for the clients of this node
+RELAY_SHARE = 0.8
+# Threads which verify and admit the queued transactions
+ADMISSION_WORKERS = 2
+# The most transactions a worker verifies and admits together - they are saved with one write and relayed with one request per peer
+ADMISSION_BATCH_SIZE = 200
+# Every peer may relay PEER_RATE transactions per second to us, with bursts of up to PEER_BURST transactions
+PEER_RATE = 200.0
+PEER_BURST = 1000
+# The most peers we keep a rate limit for - the ones which didn't send anything for the longest time are forgotten first
+MAX_TRACKED_PEERS = 1000
+# Seconds a client of this node waits for its transaction to be admitted
+ADMISSION_TIMEOUT = 30
+
+
+class Overloaded(Exception):
+    """ Raised when a transaction isn't queued because the node is overloaded.
+
+    Attributes:
+        :status: The HTTP status of the answer - 429 if the sender exceeded its rate limit, 503 if the queue is full.
+        :retry_after: Seconds after which the sender should try again (the Retry-After header).
+        :message: The reason for the client.
+    """
+
+    def __init__(self, status, retry_after, message):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+        self.message = message
+
+
+class TokenBucket:
+    """ A rate limit: tokens are added at rate per second up to burst, every transaction takes one token """
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, count, now):
+        """ Take count tokens. Returns 0 if there were enough, otherwise the seconds until there will be enough (nothing is taken) """
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= count:
+            self.tokens -= count
+            return 0
+        return (count - self.tokens) / self.rate
+
+
+class _Item:
+    # One queued transaction and the future its sender waits on
+    __slots__ = ('transaction', 'tx_hash', 'is_receiving', 'durability', 'future')
+
+    def __init__(self, transaction, tx_hash, is_receiving, durability):
+        self.transaction = transaction
+        self.tx_hash = tx_hash
+        self.is_receiving = is_receiving
+        self.durability = durability
+        self.future = Future()
+
+
+class AdmissionQueue:
+    """ A bounded queue in front of Blockchain.add_transactions. The routes only queue a transaction, worker threads take the queued
+    transactions in batches and verify and admit them together - so a burst costs one write and one relay request per peer per batch
+    instead of one per transaction, and the request threads are free again right away.
+
+    When the queue is full the node sheds load: new transactions are rejected (503 with Retry-After) before any work is done for them.
+    Every peer has its own rate limit (429 with Retry-After) and relayed transactions may only fill part of the queue, so one busy relay
+    can't starve the clients of this node.
+
+    Attributes:
+        :blockchain: The Blockchain the transactions are added to.
+        :capacity: The most transactions which can wait in the queue.
+        :relay_capacity: The most relayed transactions which can wait in the queue.
+        :workers: The number of worker threads.
+        :batch_size: The most transactions a worker admits together.
+        :on_admitted: Called by the worker with the list of admitted transactions (dictionaries) of every batch, after their senders were
+            answered. By default it relays them with Blockchain.broadcast_transactions - the asyncio node passes its own function.
+    """
+
+    def __init__(self, blockchain, capacity=QUEUE_CAPACITY, workers=ADMISSION_WORKERS, batch_size=ADMISSION_BATCH_SIZE,
+                 relay_share=RELAY_SHARE, peer_rate=PEER_RATE, peer_burst=PEER_BURST, on_admitted=None):
+        self.blockchain = blockchain
+        self.capacity = capacity
+        self.relay_capacity = int(capacity * relay_share)
+        self.workers = workers
+        self.batch_size = batch_size
+        self.peer_rate = peer_rate
+        self.peer_burst = peer_burst
+        self.on_admitted = on_admitted if on_admitted != None else blockchain.broadcast_transactions
+        self.__queue = deque()
+        # The queued transactions and the ones the workers are admitting, keyed by their hash - the same transaction (relayed by several
+        # peers or sent again by a client) is only queued once, every sender of it waits on the same future
+        self.__pending = {}
+        self.__relayed = 0
+        self.__condition = threading.Condition()
+        self.__buckets = {}
+        self.__threads = []
+        self.__running = False
+        # Counters for stats()
+        self.__admitted = 0
+        self.__declined = 0
+        self.__rejected_full = 0
+        self.__rejected_rate = 0
+        self.__rejected_by_peer = {}
+        self.__batches = 0
+        # Transactions per second the workers get through (moving average), for the Retry-After of a full queue
+        self.__throughput = None
+
+    def start(self):
+        """ Start the worker threads """
+        with self.__condition:
+            if self.__running:
+                return
+            self.__running = True
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.__run, daemon=True, name='admission-{}'.format(i))
+            thread.start()
+            self.__threads.append(thread)
+
+    def stop(self):
+        """ Stop the worker threads once the queue is empty """
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify_all()
+        for thread in self.__threads:
+            thread.join()
+        self.__threads = []
+
+    def __retry_after(self):
+        # The time the workers need for the queued transactions, at least one second
+        throughput = self.__throughput or self.batch_size
+        return max(1, int(math.ceil(len(self.__queue) / throughput)))
+
+    def __reject(self, source, count):
+        # Count the rejected transactions of every peer, so a relay which keeps hitting the limits can be found
+        if source != None and (source in self.__rejected_by_peer or len(self.__rejected_by_peer) < MAX_TRACKED_PEERS):
+            self.__rejected_by_peer[source] = self.__rejected_by_peer.get(source, 0) + count
+
+    def __rate_limit(self, source, count, now):
+        # Returns the seconds the peer has to wait, 0 if it may send now
+        bucket = self.__buckets.get(source)
+        if bucket == None:
+            if len(self.__buckets) >= MAX_TRACKED_PEERS:
+                oldest = min(self.__buckets, key=lambda key: self.__buckets[key].updated)
+                del self.__buckets[oldest]
+            bucket = self.__buckets[source] = TokenBucket(self.peer_rate, self.peer_burst, now)
+        # A batch bigger than the burst would never fit, it only has to wait for a full bucket
+        return bucket.take(min(count, self.peer_burst), now)
+
+    def submit(self, transactions, is_receiving=False, durability=None, source=None):
+        """ Queue transactions and return a list with a Future for every transaction. A future's result is True if the transaction
+        was admitted, False if it was invalid. Raises Overloaded if the transactions can't be queued - then none is.
+        Submitting is idempotent: a transaction which is queued already gets the future of the queued one, a transaction which was
+        admitted already gets True - so a client which tries again never adds its transaction twice.
+
+        Arguments:
+            :transactions: A list of dictionaries with the sender, recipient, signature, amount and nonce of every transaction.
+            :is_receiving: True if the transactions were relayed by a peer node.
+            :durability: The durability mode for saving the transactions, None uses the default.
+            :source: The address of the peer which relayed the transactions, its rate limit is checked. None for our own clients.
+        """
+        items = [_Item(tx, hash_transaction(Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce'))),
+                       is_receiving, durability) for tx in transactions]
+        with self.__condition:
+            futures = []
+            new_items = {}
+            for item in items:
+                known = self.__pending.get(item.tx_hash) or new_items.get(item.tx_hash)
+                if known == None and self.blockchain.has_seen_transaction(item.transaction['sender'], item.transaction['recipient'],
+                                                                          item.transaction['signature'], item.transaction['amount'],
+                                                                          item.transaction.get('nonce')):
+                    # Admitted before - the answer is the same as back then
+                    item.future.set_result(True)
+                    known = item
+                elif known == None:
+                    new_items[item.tx_hash] = known = item
+                futures.append(known.future)
+            if is_receiving:
+                if self.__relayed + len(new_items) > self.relay_capacity or len(self.__queue) + len(new_items) > self.capacity:
+                    self.__rejected_full += len(items)
+                    self.__reject(source, len(items))
+                    raise Overloaded(503, self.__retry_after(), 'Too many transactions are waiting, try again later.')
+                if source != None:
+                    wait = self.__rate_limit(source, len(items), time())
+                    if wait > 0:
+                        self.__rejected_rate += len(items)
+                        self.__reject(source, len(items))
+                        raise Overloaded(429, max(1, int(math.ceil(wait))), 'Rate limit exceeded, try again later.')
+            elif len(self.__queue) + len(new_items) > self.capacity:
+                self.__rejected_full += len(items)
+                raise Overloaded(503, self.__retry_after(), 'Too many transactions are waiting, try again later.')
+            for item in new_items.values():
+                self.__queue.append(item)
+                self.__pending[item.tx_hash] = item
+            if is_receiving:
+                self.__relayed += len(new_items)
+            self.__condition.notify(len(new_items))
+        return futures
+
+    def __take_batch(self):
+        # Wait for queued transactions and take up to batch_size of them. Returns None when the queue is stopped and empty.
+        # They stay pending until they are answered, so a duplicate which comes in meanwhile waits for their answer
+        with self.__condition:
+            while len(self.__queue) == 0:
+                if not self.__running:
+                    return None
+                self.__condition.wait()
+            batch = []
+            while len(self.__queue) > 0 and len(batch) < self.batch_size:
+                item = self.__queue.popleft()
+                if item.is_receiving:
+                    self.__relayed -= 1
+                batch.append(item)
+            return batch
+
+    def __answer(self, item, result=None, error=None):
+        # The transaction isn't pending anymore - a later submit of it is either known to the blockchain or a new attempt
+        with self.__condition:
+            self.__pending.pop(item.tx_hash, None)
+        if error != None:
+            item.future.set_exception(error)
+        else:
+            item.future.set_result(result)
+
+    def __admit(self, items, is_receiving, durability, admitted):
+        results = self.blockchain.add_transactions([item.transaction for item in items], is_receiving=is_receiving,
+                                                   durability=durability, broadcast=False)
+        for (item, result) in zip(items, results):
+            self.__answer(item, result)
+            if result:
+                admitted.append(item.transaction)
+
+    def __run(self):
+        while True:
+            batch = self.__take_batch()
+            if batch == None:
+                return
+            start = perf_counter()
+            # add_transactions admits transactions with the same flags together, so the batch is split by them
+            groups = {}
+            for item in batch:
+                groups.setdefault((item.is_receiving, item.durability), []).append(item)
+            admitted = []
+            for ((is_receiving, durability), items) in groups.items():
+                try:
+                    self.__admit(items, is_receiving, durability, admitted)
+                except Exception:
+                    # One malformed transaction (like a sender which isn't a key) must not fail the others of the batch,
+                    # so they are admitted one by one and only the broken one gets the error. The batch may have failed after
+                    # some of its transactions were added (saving them, say) - those are admitted already and aren't added again
+                    for item in items:
+                        if item.future.done():
+                            continue
+                        transaction = item.transaction
+                        if self.blockchain.has_seen_transaction(transaction['sender'], transaction['recipient'], transaction['signature'],
+                                                                transaction['amount'], transaction.get('nonce')):
+                            self.__answer(item, True)
+                            admitted.append(transaction)
+                            continue
+                        try:
+                            self.__admit([item], is_receiving, durability, admitted)
+                        except Exception as error:
+                            self.__answer(item, error=error)
+            with self.__condition:
+                self.__batches += 1
+                self.__admitted += len(admitted)
+                self.__declined += len(batch) - len(admitted)
+                rate = len(batch) / max(perf_counter() - start, 1e-6)
+                self.__throughput = rate if self.__throughput == None else 0.2 * rate + 0.8 * self.__throughput
+            # The senders have their answer already, relaying to the peers doesn't delay them
+            if len(admitted) > 0:
+                self.on_admitted(admitted)
+
+    def stats(self):
+        """ Return a dictionary with the queue depth and the counters (the /admission route) """
+        with self.__condition:
+            return {
+                'depth': len(self.__queue),
+                'relayed_depth': self.__relayed,
+                'capacity': self.capacity,
+                'relay_capacity': self.relay_capacity,
+                'workers': self.workers,
+                'batches': self.__batches,
+                'admitted': self.__admitted,
+                'declined': self.__declined,
+                'rejected_queue_full': self.__rejected_full,
+                'rejected_rate_limited': self.__rejected_rate,
+                'rejected_by_peer': dict(self.__rejected_by_peer),
+                'throughput': self.__throughput
+            }
@@ -0,0 +1,132 @@
+# Benchmark of the chain encodings - compares JSON with the binary encoding of codec.py for a synthetic chain of signed transactions
+# python3 bench_codec.py --blocks 200 --transactions 10
+# python3 bench_codec.py --blocks 1000 --transactions 20 --scheme ed25519 --json
+#
+# It measures the size of the blockchain file, the time to encode and decode the chain, the time a Blockchain needs to load its file
+# and the bytes and time of a /chain request (a peer syncing the whole chain). The proofs of the synthetic blocks aren't valid,
+# loading and /chain don't check them.
+
+import json
+import os
+import random
+import tempfile
+from argparse import ArgumentParser
+from time import time
+
+import codec
+from block import Block
+from blockchain import Blockchain, block_to_dict, MINING_REWARD
+from simulator import load_node_module
+from transaction import Transaction
+from utilityfolder.hash_util import hash_block
+from wallet import Wallet, SIGNATURE_SCHEMES, SCHEME_RSA
+
+
+def build_chain(blocks, transactions, wallets):
+    """ Build a list of block dictionaries (like the /chain route returns) with signed transactions between the given wallets """
+    last_block = Block(0, '', [], 100, 0)
+    dict_chain = [block_to_dict(last_block)]
+    # The last nonce of every wallet, the transfers of a wallet continue it
+    nonces = {}
+    for index in range(1, blocks):
+        sender = random.choice(wallets)
+        first = nonces.get(sender.public_key, 0) + 1
+        transfers = [(random.choice(wallets).public_key, random.randint(1, 5), first + i) for i in range(transactions)]
+        nonces[sender.public_key] = first + transactions - 1
+        signatures = sender.sign_transactions(transfers)
+        block_transactions = [Transaction(sender.public_key, recipient, signature, amount, nonce)
+                              for ((recipient, amount, nonce), signature) in zip(transfers, signatures)]
+        block_transactions.append(Transaction('MINING', sender.public_key, '', MINING_REWARD))
+        last_block = Block(index, hash_block(last_block), block_transactions, random.randint(0, 1000), time())
+        dict_chain.append(block_to_dict(last_block))
+    return dict_chain
+
+
+def measure(function, repeat):
+    """ Run the function repeat times and return (the result of the last run, the best time) """
+    best = None
+    for i in range(repeat):
+        start = time()
+        result = function()
+        duration = time() - start
+        best = duration if best == None else min(best, duration)
+    return (result, best)
+
+
+def run(blocks, transactions, scheme, repeat):
+    wallets = []
+    for i in range(5):
+        wallet = Wallet('bench{}'.format(i), scheme)
+        wallet.create_keys()
+        wallets.append(wallet)
+    dict_chain = build_chain(blocks, transactions, wallets)
+    result = {'blocks': blocks, 'transactions_per_block': transactions, 'scheme': scheme, 'encodings': {}}
+    variants = {
+        'json': (lambda: json.dumps(dict_chain).encode(), lambda data: json.loads(data)),
+        'binary': (lambda: codec.encode_chain(dict_chain, compress=False), codec.decode_chain),
+        'binary+zlib': (lambda: codec.encode_chain(dict_chain), codec.decode_chain)
+    }
+    for (name, (encode, decode)) in variants.items():
+        (data, encode_time) = measure(encode, repeat)
+        (decoded, decode_time) = measure(lambda: decode(data), repeat)
+        if decoded != dict_chain:
+            raise ValueError('{} does not decode to the same chain'.format(name))
+        result['encodings'][name] = {'bytes': len(data), 'encode_seconds': encode_time, 'decode_seconds': decode_time}
+
+    # The blockchain files are written into a temporary directory, like the simulator does
+    os.chdir(tempfile.mkdtemp())
+    with open('blockchain-bench.txt', mode='w') as f:
+        f.write(json.dumps(dict_chain) + '\n[]\n[]')
+    # A node switched to the binary storage encoding still loads its JSON file and writes the binary file on the next save
+    migrated = Blockchain(wallets[0].public_key, 'bench', storage_encoding='binary')
+    migrated.save_data()
+    migrated.close()
+    result['storage'] = {}
+    for (storage, filename) in (('json', 'blockchain-bench.txt'), ('binary', 'blockchain-bench.bin')):
+        def load():
+            loaded = Blockchain(wallets[0].public_key, 'bench', storage_encoding=storage)
+            loaded.close()
+            return loaded
+        (blockchain, load_time) = measure(load, repeat)
+        if len(blockchain.chain) != blocks:
+            raise ValueError('Loading the {} file failed'.format(storage))
+        result['storage'][storage] = {'file_bytes': os.path.getsize(filename), 'load_seconds': load_time}
+
+    # A node serves the loaded chain, a peer syncs it with and without the binary encoding
+    module = load_node_module('bench')
+    module.blockchain = blockchain
+    client = module.app.test_client()
+    result['sync'] = {}
+    for (name, accept) in (('json', 'application/json'), ('binary', codec.MEDIA_TYPE + ', application/json')):
+        (response, sync_time) = measure(lambda: client.get('/chain', headers={'Accept': accept}), repeat)
+        result['sync'][name] = {'bytes': len(response.data), 'content_type': response.mimetype, 'seconds': sync_time}
+    return result
+
+
+def print_result(result):
+    print('{} blocks with {} {} transactions each'.format(result['blocks'], result['transactions_per_block'], result['scheme']))
+    base = result['encodings']['json']['bytes']
+    for (name, stats) in result['encodings'].items():
+        print('{:12} {:>10} bytes ({:5.1f}%)  encode {:.4f}s  decode {:.4f}s'.format(
+            name, stats['bytes'], 100.0 * stats['bytes'] / base, stats['encode_seconds'], stats['decode_seconds']))
+    for (name, stats) in result['storage'].items():
+        print('storage {:6} {:>10} bytes  load {:.4f}s'.format(name, stats['file_bytes'], stats['load_seconds']))
+    for (name, stats) in result['sync'].items():
+        print('/chain {:7} {:>10} bytes  {:.4f}s  ({})'.format(name, stats['bytes'], stats['seconds'], stats['content_type']))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--blocks', type=int, default=200)
+    parser.add_argument('--transactions', type=int, default=10, help='Signed transactions per block')
+    parser.add_argument('--scheme', choices=SIGNATURE_SCHEMES, default=SCHEME_RSA)
+    parser.add_argument('--repeat', type=int, default=3, help='Every measurement is repeated and the best time is reported')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', action='store_true', help='Print the result as JSON')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    result = run(args.blocks, args.transactions, args.scheme, args.repeat)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_result(result)
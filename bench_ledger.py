@@ -0,0 +1,66 @@
+# Benchmark of the columnar ledger - whole-chain queries on a synthetic chain, compared with a loop over all transactions
+# python3 bench_ledger.py --blocks 10000 --transactions 200 --addresses 100000
+#
+# The transactions of the synthetic chain aren't signed, the columnar ledger doesn't check them.
+
+import random
+from argparse import ArgumentParser
+from time import time
+
+from block import Block
+from columnar_ledger import ColumnarLedger
+from ledger import LedgerState
+from transaction import Transaction
+
+
+def build_chain(blocks, transactions, addresses):
+    names = ['address-{}'.format(i) for i in range(addresses)]
+    chain = [Block(0, '', [], 100, 0)]
+    for index in range(1, blocks):
+        block_transactions = [Transaction(random.choice(names), random.choice(names), '', random.randint(1, 5))
+                              for i in range(transactions)]
+        block_transactions.append(Transaction('MINING', random.choice(names), '', 10))
+        chain.append(Block(index, '', block_transactions, 0, 0))
+    return chain
+
+
+def timed(label, function):
+    start = time()
+    result = function()
+    print('{:40} {:10.1f} ms'.format(label, (time() - start) * 1000))
+    return result
+
+
+def loop_stats(chain, richest, blocks):
+    """ The same queries without the columnar ledger: one pass over every transaction of the chain """
+    ledger = LedgerState()
+    for block in chain:
+        ledger.apply_block(block)
+    balances = dict((address, balance) for (address, balance) in ledger.balances.items() if address != 'MINING')
+    top = sorted(balances.items(), key=lambda item: item[1], reverse=True)[:richest]
+    volumes = [sum(tx.amount for tx in block.transactions if tx.sender != 'MINING') for block in chain[-blocks:]]
+    return (top, volumes)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--blocks', type=int, default=5000)
+    parser.add_argument('--transactions', type=int, default=200, help='Transactions per block')
+    parser.add_argument('--addresses', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=None)
+    args = parser.parse_args()
+    random.seed(args.seed)
+    chain = timed('build synthetic chain', lambda: build_chain(args.blocks, args.transactions, args.addresses))
+    print('{} blocks, {} transactions, {} addresses'.format(len(chain), sum(len(block.transactions) for block in chain), args.addresses))
+    ledger = LedgerState()
+    for block in chain:
+        ledger.apply_block(block)
+    columns = timed('build columnar ledger', lambda: ColumnarLedger.from_chain(chain, ledger))
+    extra = Block(len(chain), '', [Transaction('address-1', 'address-2', '', 1)], 0, 0)
+    timed('apply one block', lambda: columns.apply_block(extra))
+    view = columns.view()
+    timed('every balance (array)', view.balance_array)
+    timed('every balance (dictionary)', view.balances)
+    timed('10 richest addresses', lambda: view.richest(10))
+    timed('/stats', lambda: view.stats(10, 10))
+    timed('/stats without the columnar ledger', lambda: loop_stats(chain, 10, 10))
@@ -0,0 +1,145 @@
+# Benchmark of the start of a node - the time until it answers its first request and the time until its chain is loaded
+# python3 bench_startup.py --blocks 5000 --transactions 20
+# python3 bench_startup.py --blocks 20000 --node node_async.py --runs 5
+#
+# Every run starts the node in a fresh process on a synthetic blockchain file and polls /health. The first answer is the
+# time-to-first-response, the first answer with the status 'ok' the time until the chain is loaded. Runs with --load-in-foreground
+# (the chain is loaded before the port is opened) are the comparison. It also measures how long importing the modules of a node and
+# of the tools takes in a fresh interpreter. The transactions of the synthetic chain aren't signed, loading doesn't check them.
+
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import urllib.error
+import urllib.request
+from argparse import ArgumentParser
+from time import perf_counter, sleep
+
+from block import Block
+from blockchain import block_to_dict, MINING_REWARD
+from transaction import Transaction
+from utilityfolder.hash_util import hash_block
+
+# Seconds between two polls of /health
+POLL_INTERVAL = 0.005
+# The modules whose import time is measured - the nodes and what the tools import
+MODULES = ('node', 'node_async', 'blockchain', 'wallet', 'chain_verifier', 'chain_stream')
+
+
+def write_chain(path, blocks, transactions):
+    """ Write a blockchain file with a synthetic chain, block by block so a long chain doesn't have to fit into memory """
+    names = ['address-{}'.format(i) for i in range(1000)]
+    last_block = Block(0, '', [], 100, 0)
+    with open(path, mode='w') as f:
+        f.write('[')
+        f.write(json.dumps(block_to_dict(last_block)))
+        for index in range(1, blocks):
+            block_transactions = [Transaction(random.choice(names), random.choice(names), '', random.randint(1, 5))
+                                  for i in range(transactions)]
+            block_transactions.append(Transaction('MINING', random.choice(names), '', MINING_REWARD))
+            last_block = Block(index, hash_block(last_block), block_transactions, 0, index)
+            f.write(', ')
+            f.write(json.dumps(block_to_dict(last_block)))
+        f.write(']\n[]\n[]')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def environment():
+    # The node runs in the temporary directory, it finds the modules of this directory (and utilityfolder above it) on the path
+    directory = os.path.dirname(os.path.abspath(__file__))
+    paths = [directory, os.path.dirname(directory), os.environ.get('PYTHONPATH', '')]
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(path for path in paths if path))
+
+
+def poll_health(port, timeout):
+    """ Return the /health status, None if the node doesn't answer yet """
+    try:
+        with urllib.request.urlopen('http://127.0.0.1:{}/health'.format(port), timeout=timeout) as response:
+            return json.loads(response.read()).get('status')
+    except (urllib.error.URLError, ConnectionError, socket.timeout):
+        return None
+
+
+def start_node(node, directory, port, foreground, timeout):
+    """ Start a node and return (seconds until the first answer, seconds until the chain was loaded) """
+    arguments = [sys.executable, node, '-p', str(port), '--admission-queue', '0']
+    if foreground:
+        arguments.append('--load-in-foreground')
+    start = perf_counter()
+    process = subprocess.Popen(arguments, cwd=directory, env=environment(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    first_response = None
+    try:
+        while perf_counter() - start < timeout:
+            if process.poll() != None:
+                raise RuntimeError('The node exited with status {}.'.format(process.returncode))
+            status = poll_health(port, timeout)
+            if status != None and first_response == None:
+                first_response = perf_counter() - start
+            if status == 'ok':
+                return (first_response, perf_counter() - start)
+            sleep(POLL_INTERVAL)
+        raise RuntimeError('The node did not load its chain within {} seconds.'.format(timeout))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def import_time(module):
+    # A fresh interpreter every time, the modules of an earlier import would be cached
+    start = perf_counter()
+    subprocess.run([sys.executable, '-c', 'import {}'.format(module)], env=environment(), check=True)
+    return perf_counter() - start
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--blocks', type=int, default=5000)
+    parser.add_argument('--transactions', type=int, default=20, help='Transactions per block')
+    parser.add_argument('--node', default='node.py', help='node.py or node_async.py')
+    parser.add_argument('--runs', type=int, default=3, help='Starts per mode, the median is reported')
+    parser.add_argument('--timeout', type=float, default=300)
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    node = os.path.join(os.path.dirname(os.path.abspath(__file__)), args.node)
+    results = {'blocks': args.blocks, 'transactions': args.transactions, 'node': args.node, 'imports': {}}
+    for module in MODULES:
+        results['imports'][module] = median([import_time(module) for i in range(args.runs)])
+    directory = tempfile.mkdtemp()
+    try:
+        for (mode, foreground) in (('background', False), ('foreground', True)):
+            runs = []
+            for i in range(args.runs):
+                port = free_port()
+                # The node writes snapshots of the ledger next to its chain, every run starts from the plain file
+                for name in os.listdir(directory):
+                    os.remove(os.path.join(directory, name))
+                write_chain(os.path.join(directory, 'blockchain-{}.txt'.format(port)), args.blocks, args.transactions)
+                runs.append(start_node(node, directory, port, foreground, args.timeout))
+            results[mode] = {'first_response': median([run[0] for run in runs]), 'loaded': median([run[1] for run in runs])}
+    finally:
+        shutil.rmtree(directory)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        print('{} blocks with {} transactions, {} (median of {} runs)'.format(args.blocks, args.transactions, args.node, args.runs))
+        for module in MODULES:
+            print('{:40} {:10.1f} ms'.format('import ' + module, results['imports'][module] * 1000))
+        for mode in ('background', 'foreground'):
+            print('{:40} {:10.1f} ms'.format('{} load: first response'.format(mode), results[mode]['first_response'] * 1000))
+            print('{:40} {:10.1f} ms'.format('{} load: chain loaded'.format(mode), results[mode]['loaded'] * 1000))
@@ -1,12 +1,33 @@
-from time import time
+import time as clock
 from utilityfolder.printable import Printable
 
 
 class Block(Printable):
     # Every blockshould be independent from the other blocks so we use the instance argument
-    def __init__(self, index, previous_hash, transactions, proof, time=time()):
+    def __init__(self, index, previous_hash, transactions, proof, time=None):
         self.index = index
         self.previous_hash = previous_hash
-        self.timestamp = time
+        # A default of time() would be evaluated once, when this module is imported - every block would get the same timestamp
+        self.timestamp = clock.time() if time == None else time
         self.transactions = transactions
         self.proof = proof
+
+
+class BlockHeader(Printable):
+    """ A block whose transactions were dropped - a pruned node only keeps the headers of old blocks.
+    The hash of a block can't be computed without its transactions, so the header stores the hash of the full block.
+
+    Attributes:
+        :block_hash: The hash of the full block.
+    """
+
+    def __init__(self, index, previous_hash, proof, timestamp, block_hash):
+        self.index = index
+        self.previous_hash = previous_hash
+        self.timestamp = timestamp
+        self.proof = proof
+        self.block_hash = block_hash
+
+    @staticmethod
+    def from_block(block, block_hash):
+        return BlockHeader(block.index, block.previous_hash, block.proof, block.timestamp, block_hash)
@@ -0,0 +1,163 @@
+from utilityfolder.hash_util import hash_block
+from median_time import MEDIAN_TIME_SPAN
+
+# Every block needs a proof whose hash starts with two zeros (see Verification.valid_proof), so a block takes 16 ** 2 hashes on average
+BLOCK_WORK = 16 ** 2
+
+
+class TreeNode:
+    """ A block in the block tree.
+
+    Attributes:
+        :block: The Block object.
+        :block_hash: The hash of the block.
+        :work: The cumulative work of the branch from the genesis block up to and including this block.
+        :main: True if the block is part of the main chain.
+    """
+
+    def __init__(self, block, block_hash, work, main=False):
+        self.block = block
+        self.block_hash = block_hash
+        self.work = work
+        self.main = main
+
+
+class BlockTree:
+    """ All blocks we know keyed by their hash - the main chain and the competing branches (forks) next to it.
+    The main chain is the branch with the most cumulative work. Every block in the tree has all its ancestors in the tree.
+    The tree isn't thread safe, the Blockchain only changes it while holding its lock.
+
+    Attributes:
+        :tip: The TreeNode of the last block of the main chain.
+    """
+
+    def __init__(self, chain, block_hashes=None):
+        """ Arguments:
+            :chain: The main chain, a list of blocks.
+            :block_hashes: The hashes of the blocks if the caller already has them (None for a block whose hash isn't known).
+        """
+        self.__nodes = {}
+        # The hashes of the blocks which aren't part of the main chain
+        self.__side = set()
+        self.tip = None
+        if block_hashes == None:
+            block_hashes = [None] * len(chain)
+        for (block, block_hash) in zip(chain, block_hashes):
+            self.extend(block, block_hash)
+
+    def __contains__(self, block_hash):
+        return block_hash in self.__nodes
+
+    def __len__(self):
+        return len(self.__nodes)
+
+    def get(self, block_hash):
+        """ Return the TreeNode of the block with this hash, or None if we don't know the block """
+        return self.__nodes.get(block_hash)
+
+    def main_chain_hashes(self):
+        """ Return the hashes of the main chain blocks, from the genesis block to the tip """
+        hashes = []
+        node = self.tip
+        while node != None:
+            hashes.append(node.block_hash)
+            node = self.parent(node)
+        hashes.reverse()
+        return hashes
+
+    def side_branch_blocks(self):
+        """ Return the number of blocks which are not part of the main chain """
+        return len(self.__side)
+
+    def add(self, block, block_hash=None):
+        """ Add a block to the tree without changing the main chain.
+        Returns the TreeNode of the block, or None if its parent is unknown or its index doesn't follow the index of its parent.
+
+        Arguments:
+            :block: The Block object.
+            :block_hash: The hash of the block if the caller already has it.
+        """
+        if block_hash == None:
+            block_hash = hash_block(block)
+        if block_hash in self.__nodes:
+            return self.__nodes[block_hash]
+        if len(self.__nodes) == 0:
+            # The genesis block has no parent
+            work = 0
+        else:
+            parent = self.__nodes.get(block.previous_hash)
+            if parent == None or block.index != parent.block.index + 1:
+                return None
+            work = parent.work + BLOCK_WORK
+        node = TreeNode(block, block_hash, work)
+        self.__nodes[block_hash] = node
+        self.__side.add(block_hash)
+        return node
+
+    def extend(self, block, block_hash=None):
+        """ Add a block which extends the main chain and make it the new tip. Returns its TreeNode (None like add) """
+        node = self.add(block, block_hash)
+        if node != None:
+            self.switch([], [node])
+        return node
+
+    def replace_block(self, block):
+        """ Replace the block of a node with its header (a BlockHeader) when a pruned node drops its transactions """
+        node = self.__nodes.get(block.block_hash)
+        if node != None:
+            node.block = block
+
+    def parent(self, node):
+        return self.__nodes.get(node.block.previous_hash)
+
+    def ancestors(self, node, count=MEDIAN_TIME_SPAN):
+        """ Return the blocks of the last count nodes of the branch which ends in node, the oldest first """
+        blocks = []
+        while node != None and len(blocks) < count:
+            blocks.append(node.block)
+            node = self.parent(node)
+        blocks.reverse()
+        return blocks
+
+    def path(self, new_tip):
+        """ Return a tuple (undo, apply) of TreeNode lists which moves the main chain to the branch of new_tip:
+        undo goes from the current tip down to the fork point, apply goes from the fork point up to new_tip """
+        undo = []
+        apply = []
+        old = self.tip
+        new = new_tip
+        # Walk both branches down until they meet at the block they share
+        while old is not new:
+            old_index = old.block.index
+            new_index = new.block.index
+            if old_index >= new_index:
+                undo.append(old)
+                old = self.parent(old)
+            if new_index >= old_index:
+                apply.append(new)
+                new = self.parent(new)
+        apply.reverse()
+        return (undo, apply)
+
+    def switch(self, undo, apply):
+        """ Move the main chain to another branch. undo and apply come from path """
+        for node in undo:
+            node.main = False
+            self.__side.add(node.block_hash)
+        for node in apply:
+            node.main = True
+            self.__side.discard(node.block_hash)
+        if len(apply) > 0:
+            self.tip = apply[-1]
+        elif len(undo) > 0:
+            self.tip = self.parent(undo[-1])
+
+    def prune(self, depth):
+        """ Remove the side branches which forked off more than depth blocks below the tip - the main chain is far ahead of them """
+        min_index = self.tip.block.index - depth
+        # Parents come before their children, so a removed block takes all blocks built on it with it
+        for block_hash in sorted(self.__side, key=lambda side_hash: self.__nodes[side_hash].block.index):
+            block = self.__nodes[block_hash].block
+            if block.index < min_index or block.previous_hash not in self.__nodes:
+                del self.__nodes[block_hash]
+                self.__side.discard(block_hash)
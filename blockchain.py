@@ -1,144 +1,726 @@
 # python3 blockchain.py
 
-from functools import reduce
 import hashlib as hl
 import json
+import os
 import pickle
-import requests
+import random
+import threading
+from time import time
 
 # Import a function from our hash_util.py file. Omit the ".py" in the import
-from utilityfolder.hash_util import hash_block
+from utilityfolder.hash_util import hash_block, hash_transaction
 from utilityfolder.verification import Verification
 # Import Block class
-from block import Block
+from block import Block, BlockHeader
 from transaction import Transaction
 from wallet import Wallet
+from ledger import LedgerState, PendingSpends, SnapshotStore
+from chain_state import ChainState
+from block_tree import BlockTree
+from seen_cache import SeenCache
+from peers import PeerTable
+from persistence import PersistenceScheduler, DURABILITY_ASYNC, FLUSH_INTERVAL, FLUSH_BATCH_SIZE
+import codec
+import tracing
+from median_time import TimeWindow, check_timestamp
+from events import EventLog, EVENT_BLOCK, EVENT_TRANSACTION, EVENT_REORG, EVENT_PEERS, EVENT_RESET
 
 
 # The reward we give to miners (for creating a new block)
 MINING_REWARD = 10
+# Every SNAPSHOT_INTERVAL blocks we store a snapshot of the ledger state (the balances) so a restart only replays the blocks after it
+SNAPSHOT_INTERVAL = 10
+# New transactions and blocks are relayed to GOSSIP_FANOUT random peers, which relay them further (gossip)
+GOSSIP_FANOUT = 3
+# How long (in seconds) we remember the hashes of transactions and blocks we have seen, so we don't process or relay them twice
+SEEN_TTL = 600
+# Seconds we wait for a peer before the request counts as failed - without a timeout a dead peer could block a request forever
+PEER_TIMEOUT = 5
+# Every PROBE_INTERVAL seconds a background thread tries the unhealthy peers again. A peer which failed PRUNE_AFTER_FAILURES times in a row is removed
+PROBE_INTERVAL = 5
+PRUNE_AFTER_FAILURES = 12
+# Competing branches are kept in the block tree so we can switch to them. Branches which forked off more than MAX_FORK_DEPTH blocks below our tip are dropped
+MAX_FORK_DEPTH = 100
+# A pruned node drops the transactions of old blocks in batches of PRUNE_INTERVAL blocks, so it doesn't revert the ledger for every new block
+PRUNE_INTERVAL = 10
+# How often mine_block tries - a block which arrives during the proof of work makes ours stale, then we mine again on the new last block
+MINING_ATTEMPTS = 2
+
+
+class StaleTip(Exception):
+    """ Raised by mine_block when other blocks kept arriving during the proof of work, so none of our blocks extended the chain.
+    Mining again right away works on the new last block.
+
+    Attributes:
+        :retry_after: Seconds after which the caller can try again (the Retry-After header).
+        :message: The reason for the client.
+    """
+
+    def __init__(self, message, retry_after=0):
+        super().__init__(message)
+        self.message = message
+        self.retry_after = retry_after
+
+
+
+def block_to_dict(block):
+    """ Convert a block to a dictionary like in the /chain route. A pruned block (BlockHeader) has a hash instead of transactions """
+    if isinstance(block, BlockHeader):
+        return {'index': block.index, 'previous_hash': block.previous_hash, 'proof': block.proof,
+                'timestamp': block.timestamp, 'hash': block.block_hash}
+    dict_block = block.__dict__.copy()
+    dict_block['transactions'] = [tx.__dict__ for tx in block.transactions]
+    return dict_block
+
+
+def read_peer_response(response):
+    """ Return the payload of a peer response - decoded from the binary encoding if the peer sent it in its Content-Type, JSON otherwise.
+    Raises a ValueError if the body can't be decoded """
+    if response.headers.get('Content-Type', '').startswith(codec.MEDIA_TYPE):
+        return codec.decode_chain(response.content) if response.content[:len(codec.MAGIC)] == codec.MAGIC else codec.decode(response.content)
+    return response.json()
 
 # Create a class for the blockchain, which we can use to create a blockchain object which can be used in the Node class.
 
 
 class Blockchain:
     # Constructor
-    def __init__(self, public_key, node_id):
+    def __init__(self, public_key, node_id, durability=DURABILITY_ASYNC, flush_interval=FLUSH_INTERVAL,
+                 flush_batch_size=FLUSH_BATCH_SIZE, transport=None, prune_depth=None, storage_encoding='json', wire_encoding='json',
+                 tracer=tracing.DISABLED, load_in_background=False):
         # Our starting block for the blockchain
         # Create this from the Block class and give starting criteria for previous_hash, index, transactions, proof and timestamp
         genesis_block = Block(0, '', [], 100, 0)
-        # Initiliasing our (empty) blockhain list
-        # We add __ before an attribute to mark it as private. We can do this with the chain and open_transaction attributes so that they aren't manipulated from the outside. This has security benefits
-        self.chain = [genesis_block]
+        # Requests are handled by several threads at the same time. Writers (mining, adding blocks and transactions, changing peers) take this
+        # lock so they run one after the other. Readers never take it - they read the current ChainState, which is immutable
+        self.__lock = threading.RLock()
+        # Initiliasing our (empty) blockhain, our unhandled transactions and the balances derived from the chain
+        # We add __ before an attribute to mark it as private. We can do this with the state so that it isn't manipulated from the outside. This has security benefits
         # The blockchain should only be editable from inside the blockchain, not outside
-        # Unhandled transcations
-        self.__open_transactions = []
+        self.__state = ChainState((genesis_block,), (), LedgerState(), times=TimeWindow.from_blocks((genesis_block,)), pending=PendingSpends())
         self.public_key = public_key
         # Add instance attribute for peer node and initialise an empty set. We can add and remove nodes to this set
         # Sets in python are unordered, unchangeable and unindexed. Also they don't allow duplicate values so every node can only be added once - this is good
-        self.__peer_nodes = set()
+        # The PeerTable also tracks the health of every peer, so requests skip peers which are down
+        self.__peers = PeerTable()
         self.node_id = node_id
         self.resolve_conflicts = False
+        # The number of times the main chain switched to another branch
+        self.reorganizations = 0
+        # The transport sends the HTTP requests to the peer nodes. It's the requests module, unless a test harness (like the cluster simulator)
+        # passes an object with the same post(url, json, timeout) and get(url, timeout) functions. None imports the requests module the first
+        # time we talk to a peer - importing it takes longer than everything else the start of a node does before loading the chain
+        self.transport = transport
+        # 'json' or 'binary' (see codec.py). The storage encoding is the format of the blockchain file, the wire encoding the format of the
+        # blocks and transactions we send to peers. JSON stays the default, the browser UI and older nodes only understand JSON
+        self.storage_encoding = storage_encoding
+        self.wire_encoding = wire_encoding
+        # Peers which rejected a binary request - they only get JSON from now on
+        self.__json_peers = set()
+        # The hashes of transactions and blocks we have seen recently - a relayed item we already know is rejected before any verification
+        # Only accepted transactions are seen, a rejected one can come again once it's valid (after the block with the coins of its sender)
+        self.__seen_transactions = SeenCache(SEEN_TTL)
+        self.__seen_blocks = SeenCache(SEEN_TTL)
+        # The hashes of relayed transactions which are being verified right now - the same transaction relayed by another peer meanwhile
+        # is rejected, so its signature isn't checked twice
+        self.__verifying = set()
+        self.__verifying_lock = threading.Lock()
+        # Open transactions saved before there were nonces. They can't be mined anymore, so they're set aside (and saved with the open
+        # transactions) until the wallet which sent them signs them again with a nonce (see take_unsigned_transactions)
+        self.__unsigned_transactions = ()
+        # The balances are rebuilt from the newest snapshot after loading, and then updated block by block
+        self.__snapshots = SnapshotStore(node_id)
+        # The columnar ledger for whole-chain queries. It's built the first time somebody asks for it, and then updated block by block
+        self.__columns = None
+        # The binary file stores the hash of every block, so the block tree doesn't have to hash the whole chain again
+        self.__loaded_hashes = None
+        # The tracer times the phases of mining, adding blocks and transactions, resolving and loading (see tracing.py). It's off by default
+        self.tracer = tracer
+        # New blocks, transactions, reorganizations and peer changes are published here, the /events route streams them to clients
+        self.events = EventLog()
+        # The main chain together with the competing branches we know. Only the main chain is saved - side branches are kept in memory
+        self.__tree = BlockTree(self.__state.chain)
+        # A pruned node keeps only the last prune_depth blocks in full. Older blocks are reduced to their headers and the balances up to them
+        # are kept in the committed snapshot. None keeps every block
+        self.prune_depth = prune_depth
+        self.pruned_height = -1
+        # Set once the chain is loaded. Until then the state is only the genesis block
+        self.loaded = threading.Event()
+        if load_in_background:
+            # Loading a long chain takes a while - the node can already answer its health checks meanwhile. The loading thread holds the
+            # lock the whole time, so every writer waits for the loaded chain. It's taken before we return, so no writer can come first
+            locked = threading.Event()
+
+            def load():
+                with self.__lock:
+                    locked.set()
+                    self.__load()
+                    # Clients which connected while we were loading only know the genesis block, they have to load everything again
+                    self.events.publish(EVENT_RESET, {'height': len(self.__state.chain) - 1})
+            threading.Thread(target=load, daemon=True, name='load-chain').start()
+            locked.wait()
+        else:
+            self.__load()
+        # Changes are not written in the request itself - they are marked dirty and written together by a background thread
+        # The durability is the default mode, every mutating method can override it
+        self.durability = durability
+        self.__persistence = PersistenceScheduler(
+            self.save_data, flush_interval, flush_batch_size)
+        self.__persistence.start()
+        # The background thread which probes unhealthy peers and removes dead ones
+        self.__stopped = threading.Event()
+        self.__prober = threading.Thread(target=self.__probe_peers, daemon=True)
+        self.__prober.start()
+
+    def __load(self):
         # Load data after empty set of nodes initiliased so that it is always updated
         self.load_data()
+        with self.tracer.span('rebuild_ledger'):
+            self.__publish(ledger=self.__rebuild_ledger(self.__state.chain))
+        self.__tree = BlockTree(self.__state.chain, self.__loaded_hashes)
+        self.__loaded_hashes = None
+        self.pruned_height = max([block.index for block in self.__state.chain if isinstance(block, BlockHeader)], default=-1)
+        self.loaded.set()
 
     # We add the following two methods to return copies of reference objects for chain and open_transactions so that we can't take advantage of that reference by still editing it from the outside after getting access to it
     # When you try to get the value of chain / access chain the following is achieved
     @property
     def chain(self):
-        return self.__chain[:]
+        return list(self.__state.chain)
 
     # When we want to set something to chain (overwrite it - like in the load_data function) the following happens ??
     @chain.setter
     def chain(self, val):
-        self.__chain = val
+        with self.__lock:
+            chain = tuple(val)
+            self.__tree = BlockTree(chain)
+            self.__columns = None
+            self.__publish(chain=chain, ledger=self.__rebuild_ledger(chain), columns=None, times=TimeWindow.from_blocks(chain))
+            self.pruned_height = max([block.index for block in chain if isinstance(block, BlockHeader)], default=-1)
+            # The whole chain changed, clients have to load it again
+            self.events.publish(EVENT_RESET, {'height': len(chain) - 1})
 
     def get_open_transactions(self):
-        return self.__open_transactions[:]
+        return list(self.__state.open_transactions)
+
+    def take_unsigned_transactions(self, sender):
+        """ Return the open transactions of the sender which were set aside because they were saved without a nonce, so its wallet can
+        sign them again with a nonce. The set-aside transactions of every other sender are dropped - only their own wallet can sign them,
+        and it's held by another node.
+
+        Arguments:
+            :sender: The address of the wallet which signs the transactions again.
+        """
+        with self.__lock:
+            unsigned = self.__unsigned_transactions
+            if len(unsigned) == 0:
+                return []
+            self.__unsigned_transactions = ()
+        taken = [tx for tx in unsigned if tx.sender == sender]
+        if len(taken) < len(unsigned):
+            print('Dropped {} open transactions without a nonce of other wallets'.format(len(unsigned) - len(taken)))
+        # The saved open transactions don't have to contain them anymore
+        self.__persist()
+        return taken
+
+    def replace_open_transactions(self, transactions):
+        """ Replace the open transactions without verifying them - a replica mirrors the open transactions of its primary like this
+
+        Arguments:
+            :transactions: The list of Transaction objects.
+        """
+        with self.__lock:
+            known = set(hash_transaction(tx) for tx in self.__state.open_transactions)
+            self.__publish(open_transactions=tuple(transactions))
+            for tx in transactions:
+                if hash_transaction(tx) not in known:
+                    self.events.publish(EVENT_TRANSACTION, tx.__dict__)
+
+    def gossip_peers(self):
+        """ Return a random selection of at most GOSSIP_FANOUT peer nodes to relay a new transaction or block to """
+        peers = self.get_healthy_peer_nodes()
+        return random.sample(peers, min(GOSSIP_FANOUT, len(peers)))
+
+    def has_seen_transaction(self, sender, recipient, signature, amount, nonce=None):
+        """ Return True if we have seen this transaction recently - this check is cheap, so it runs before the signature check """
+        return hash_transaction(Transaction(sender, recipient, signature, amount, nonce)) in self.__seen_transactions
+
+    def has_seen_block(self, block):
+        """ Return True if we have seen this block (a dictionary like in the /broadcast-block route) recently """
+        transactions = [Transaction(
+            tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce')) for tx in block['transactions']]
+        return hash_block(Block(block['index'], block['previous_hash'], transactions, block['proof'], block['timestamp'])) in self.__seen_blocks
+
+    def has_seen_block_hash(self, block_hash):
+        """ Return True if we have seen the block with this hash recently """
+        return block_hash in self.__seen_blocks
+
+    def has_block(self, block_hash):
+        """ Return True if the block is in our block tree - on the main chain or on a side branch. A new block can be added if we have its parent """
+        return block_hash in self.__tree
+
+    def get_fork_stats(self):
+        """ Return the size of the block tree, the number of blocks on side branches and the number of reorganizations so far """
+        return {
+            'blocks': len(self.__tree),
+            'side_branch_blocks': self.__tree.side_branch_blocks(),
+            'reorganizations': self.reorganizations
+        }
+
+    def compact_block(self, block):
+        """ Return the compact form of a block which we relay to peers: the header, the hashes of the transactions and the reward transaction.
+        Peers almost always have the transactions in their open transactions already, so we don't need to send them again.
+
+        Arguments:
+            :block: The Block object that should be relayed.
+        """
+        return {
+            'hash': hash_block(block),
+            'index': block.index,
+            'previous_hash': block.previous_hash,
+            'timestamp': block.timestamp,
+            'proof': block.proof,
+            # The reward transaction is the last transaction of a block, it is never in the open transactions so we send it in full
+            'tx_ids': [hash_transaction(tx) for tx in block.transactions[:-1]],
+            'reward': block.transactions[-1].__dict__
+        }
+
+    def expand_compact_block(self, compact_block, transactions=()):
+        """ Rebuild a full block (a dictionary like in the /broadcast-block route) from a compact block.
+        The transactions are taken from our open transactions and from the transactions the sender sent along.
+        Returns a tuple (block, missing): block is None if transactions are missing - missing lists their hashes so we can ask for them.
+        If the rebuilt block doesn't match the hash of the compact block, block is None and missing is empty.
+
+        Arguments:
+            :compact_block: The compact block as created by compact_block.
+            :transactions: Transaction dictionaries the sender sent in a follow-up request.
+        """
+        known = dict((hash_transaction(tx), tx) for tx in self.__state.open_transactions)
+        for tx in transactions:
+            converted_tx = Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce'))
+            known[hash_transaction(converted_tx)] = converted_tx
+        missing = [tx_id for tx_id in compact_block['tx_ids'] if tx_id not in known]
+        if len(missing) > 0:
+            return (None, missing)
+        reward = compact_block['reward']
+        block_transactions = [known[tx_id] for tx_id in compact_block['tx_ids']]
+        block_transactions.append(Transaction(reward['sender'], reward['recipient'], reward['signature'], reward['amount']))
+        block = Block(compact_block['index'], compact_block['previous_hash'], block_transactions,
+                      compact_block['proof'], compact_block['timestamp'])
+        if hash_block(block) != compact_block['hash']:
+            return (None, [])
+        dict_block = block.__dict__.copy()
+        dict_block['transactions'] = [tx.__dict__ for tx in block_transactions]
+        return (dict_block, [])
+
+    def snapshot(self):
+        """ Return the current ChainState. It never changes, so the chain, open transactions and balances in it always belong together """
+        return self.__state
+
+    def __publish(self, **changes):
+        """ Replace the current state with a copy that has the given fields changed - only call this while holding the lock.
+        New open transactions get new pending spends - callers which only append transactions pass them, everybody else gets them counted """
+        if 'open_transactions' in changes and 'pending' not in changes:
+            changes['pending'] = PendingSpends.from_transactions(changes['open_transactions'])
+        self.__state = self.__state._replace(**changes)
+
+    def __rebuild_ledger(self, chain):
+        """ Build the ledger state from the newest snapshot that still matches the chain and replay only the blocks after it """
+        ledger = self.__snapshots.latest_matching(chain)
+        if ledger == None:
+            # No usable snapshot (new node or the chain was replaced), so we have to replay the whole chain
+            ledger = LedgerState()
+        for block in chain[ledger.height + 1:]:
+            ledger.apply_block(block)
+        return ledger
+
+    def __confirm_block(self, ledger, block):
+        """ Return a new ledger state with the block applied and take a snapshot if it's due - the given ledger isn't changed """
+        ledger = ledger.copy()
+        ledger.apply_block(block)
+        if block.index % SNAPSHOT_INTERVAL == 0:
+            self.__snapshots.add(ledger, hash_block(block))
+        return ledger
+
+    def __update_columns(self, undo, apply):
+        """ Revert the undo blocks and apply the apply blocks to the columnar ledger if it's built - only call this while holding the lock.
+        Returns the new ColumnarView, or None if the columnar ledger isn't built """
+        if self.__columns == None:
+            return None
+        for block in undo:
+            self.__columns.revert_block(block)
+        for block in apply:
+            self.__columns.apply_block(block)
+        return self.__columns.view()
+
+    def get_columns(self):
+        """ Return the ColumnarView of the confirmed chain for whole-chain queries (every balance, the richest addresses, the volume per block).
+        The first call builds the columnar ledger from the chain, after that it's kept up to date with every block """
+        columns = self.__state.columns
+        if columns == None:
+            with self.__lock:
+                if self.__columns == None:
+                    # numpy is only imported by the first whole-chain query, importing it slows down the start of every node
+                    from columnar_ledger import ColumnarLedger
+                    state = self.__state
+                    self.__columns = ColumnarLedger.from_chain(state.chain, state.ledger)
+                    self.__publish(columns=self.__columns.view())
+                columns = self.__state.columns
+        return columns
+
+    def __extend(self, current, block, open_transactions):
+        """ Append a block to the main chain - only call this while holding the lock.
+        The open transactions are checked against the new ledger, the block could have used a nonce or spent the coins of one of them """
+        self.__tree.extend(block)
+        ledger = self.__confirm_block(current.ledger, block)
+        valid = Verification.verify_transaction_batch(open_transactions, ledger.get_balance, check_signatures=False,
+                                                      get_nonce=lambda sender: ledger.get_nonce(sender) + 1)
+        self.__publish(chain=current.chain + (block,), open_transactions=tuple(tx for (tx, ok) in zip(open_transactions, valid) if ok),
+                       ledger=ledger, columns=self.__update_columns([], [block]), times=current.times.push(block.timestamp))
+        self.events.publish(EVENT_BLOCK, block_to_dict(block))
+        self.__prune_history()
+
+    def __prune_history(self):
+        """ Drop the transactions of the blocks older than prune_depth blocks - only call this while holding the lock.
+        The balances at the last pruned block are committed as a snapshot first, so the ledger can always be rebuilt from the blocks we keep.
+        """
+        if self.prune_depth == None:
+            return
+        state = self.__state
+        chain = state.chain
+        height = len(chain) - 1 - self.prune_depth
+        if height - self.pruned_height < PRUNE_INTERVAL:
+            return
+        # Go back from the current balances to the balances at the new pruned height
+        ledger = state.ledger.copy()
+        for block in reversed(chain[height + 1:]):
+            ledger.revert_block(block)
+        self.__snapshots.commit(ledger, hash_block(chain[height]))
+        headers = []
+        for block in chain[self.pruned_height + 1:height + 1]:
+            header = BlockHeader.from_block(block, hash_block(block))
+            self.__tree.replace_block(header)
+            headers.append(header)
+        chain = chain[:self.pruned_height + 1] + tuple(headers) + chain[height + 1:]
+        if self.__columns != None:
+            # The transactions of the pruned blocks go into the base balances of the columns, otherwise they'd keep every transaction
+            self.__columns.rebase(height, ledger)
+            self.__publish(chain=chain, columns=self.__columns.view())
+        else:
+            self.__publish(chain=chain)
+        self.pruned_height = height
+
+    def get_blocks(self, start=0, end=None):
+        """ Return the full blocks from index start up to (not including) end, or None if one of them was pruned """
+        chain = self.__state.chain
+        blocks = chain[start:end]
+        if len(blocks) > 0 and isinstance(blocks[0], BlockHeader):
+            return None
+        return list(blocks)
+
+    def __reorganize(self, current, new_tip):
+        """ Switch the main chain to the branch which ends in new_tip - only call this while holding the lock.
+        The blocks after the fork point are undone and the blocks of the new branch are applied, so the work depends on the depth of the fork,
+        not on the length of the chain. Transactions of the undone blocks go back to the open transactions if they are still valid.
+        """
+        (undo, apply) = self.__tree.path(new_tip)
+        # A pruned node can't undo blocks it only has the headers of, so it can't switch to a branch which forked off before them
+        if len(undo) > 0 and isinstance(undo[-1].block, BlockHeader):
+            return False
+        ledger = current.ledger.copy()
+        for node in undo:
+            ledger.revert_block(node.block)
+        for node in apply:
+            # The nonces of a block depend on the blocks before it on its branch, so they can only be checked here. A branch with a
+            # used or skipped nonce stays a side branch
+            if not Verification.verify_nonces(node.block, ledger.get_nonce):
+                return False
+            ledger.apply_block(node.block)
+            if node.block.index % SNAPSHOT_INTERVAL == 0:
+                self.__snapshots.add(ledger, node.block_hash)
+        chain = current.chain[:apply[0].block.index] + tuple(node.block for node in apply)
+        # The transactions of the new branch are confirmed now. Everything else - the open transactions and the transactions of the undone
+        # blocks - is open again, as long as the sender can still afford it on the new branch
+        confirmed = set(hash_transaction(tx) for node in apply for tx in node.block.transactions)
+        # Blocks of peers are added without checking the signatures of their transactions, so the undone ones are checked now
+        orphaned = [tx for node in reversed(undo) for tx in node.block.transactions[:-1] if Wallet.verify_transaction(tx)]
+        candidates = []
+        for tx in orphaned + list(current.open_transactions):
+            tx_hash = hash_transaction(tx)
+            if tx_hash not in confirmed:
+                confirmed.add(tx_hash)
+                candidates.append(tx)
+        # The nonces start again after the last nonce confirmed on the new branch
+        valid = Verification.verify_transaction_batch(candidates, ledger.get_balance, check_signatures=False,
+                                                      get_nonce=lambda sender: ledger.get_nonce(sender) + 1)
+        self.__tree.switch(undo, apply)
+        self.__tree.prune(MAX_FORK_DEPTH)
+        self.__publish(chain=chain, open_transactions=tuple(tx for (tx, ok) in zip(candidates, valid) if ok), ledger=ledger,
+                       columns=self.__update_columns([node.block for node in undo], [node.block for node in apply]),
+                       times=TimeWindow.from_blocks(chain))
+        self.reorganizations += 1
+        if len(undo) == 0:
+            # Nothing was undone (like when resolve appends the new blocks of a peer), so for clients these are just new blocks
+            for node in apply:
+                self.events.publish(EVENT_BLOCK, block_to_dict(node.block))
+        else:
+            # Clients drop the undone blocks and append the blocks of the new branch
+            self.events.publish(EVENT_REORG, {
+                'undone': [{'index': node.block.index, 'hash': node.block_hash} for node in undo],
+                'applied': [block_to_dict(node.block) for node in apply]
+            })
+        self.__prune_history()
+        return True
+
+    def __read_file(self):
+        """ Read the blockchain file and return a tuple (chain, open transactions, peer nodes) of dictionaries.
+        The binary file is used if the storage encoding is binary and it exists, otherwise the JSON file - so switching a node to the
+        binary encoding keeps its chain, the binary file is written on the next save """
+        if self.storage_encoding == 'binary' and os.path.exists('blockchain-{}.bin'.format(self.node_id)):
+            with open('blockchain-{}.bin'.format(self.node_id), mode='rb') as f:
+                return codec.decode_state(f.read())
+        with open('blockchain-{}.txt'.format(self.node_id), mode='r') as f:
+            # with open('blockchain.txt', mode='r') as f:
+            # We use .json or .pickle to convert the data to a string (when we write) and then back to a native python object, such as a list 
+            # (when we read)
+            #file_content = pickle.loads(f.read())
+            file_content = f.readlines()
+            # Index third line of blockchain.txt with [2] for the connected nodes
+            return (json.loads(file_content[0][:-1]), json.loads(file_content[1][:-1]), json.loads(file_content[2]))
 
     def load_data(self):  # load_data is a method of the Blockchain class
         # We need to acces the global variables for blockchain and open_transactions
-        try:
-            with open('blockchain-{}.txt'.format(self.node_id), mode='r') as f:
-                # with open('blockchain.txt', mode='r') as f:
-                # We use .json or .pickle to convert the data to a string (when we write) and then back to a native python object, such as a list 
-                # (when we read)
-                #file_content = pickle.loads(f.read())
-                file_content = f.readlines()
-                blockchain = json.loads(file_content[0][:-1])
+        with self.tracer.span('load_data', encoding=self.storage_encoding) as span:
+            try:
+                with self.tracer.span('read_file'):
+                    (blockchain, open_transactions, peer_nodes) = self.__read_file()
                 # When we load our transactions we need to load them as OrderedDicts - because when we add a transaction we add it as an OrderedDict
                 # Therefore we need to ovewrite the old loaded data 'blockchain' with new data for the transactions
                 # Go through all transactions for a given block and create an OrderedDict for all of them so that this gets stored in the block instead 
                 # of the original transaction
-                updated_blockchain = []
-                for block in blockchain:
-                    # Store list of transaction in seperate variable converted_tx to make code look neater
-                    # Transaction needs to be an object not and OrderedDict but we also want to use an OpenDict to ensure we don't run into issues when 
-                    # hashing
-                    converted_tx = [Transaction(
-                        tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']]
-                    updated_block = Block(
-                        block['index'], block['previous_hash'], converted_tx, block['proof'], block['timestamp'])
-                    updated_blockchain.append(updated_block)
-                # Update blockchain
-                self.chain = updated_blockchain
-                open_transactions = json.loads(file_content[1][:-1])
-                # We also need to build the open_transaction load method upon OrderedDicts
-                updated_transactions = []
-                for tx in open_transactions:
-                    updated_transaction = Transaction(
-                        tx['sender'], tx['recipient'], tx['signature'], tx['amount'])
-                    updated_transactions.append(updated_transaction)
+                with self.tracer.span('build_blocks', blocks=len(blockchain)):
+                    updated_blockchain = []
+                    for block in blockchain:
+                        # Store list of transaction in seperate variable converted_tx to make code look neater
+                        # Transaction needs to be an object not and OrderedDict but we also want to use an OpenDict to ensure we don't run into issues when 
+                        # hashing
+                        # The old blocks of a pruned node are stored as headers, without transactions
+                        if 'transactions' not in block:
+                            updated_blockchain.append(BlockHeader(
+                                block['index'], block['previous_hash'], block['proof'], block['timestamp'], block['hash']))
+                            continue
+                        converted_tx = [Transaction(
+                            tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce')) for tx in block['transactions']]
+                        updated_block = Block(
+                            block['index'], block['previous_hash'], converted_tx, block['proof'], block['timestamp'])
+                        updated_blockchain.append(updated_block)
+                    # Update blockchain
+                    chain = tuple(updated_blockchain)
+                    self.__loaded_hashes = [block.get('hash') for block in blockchain]
+                    # We also need to build the open_transaction load method upon OrderedDicts
+                    updated_transactions = []
+                    unsigned_transactions = []
+                    for tx in open_transactions:
+                        updated_transaction = Transaction(
+                            tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce'))
+                        # Open transactions saved before there were nonces can't be mined anymore (see Verification.verify_nonces)
+                        if updated_transaction.nonce == None:
+                            unsigned_transactions.append(updated_transaction)
+                        else:
+                            updated_transactions.append(updated_transaction)
                 # Store updated/loaded transactions
-                self.__open_transactions = updated_transactions
-                # Load connected nodes
-                # Index third line of blockchain.txt with [2]
-                peer_nodes = json.loads(file_content[2])
+                with self.__lock:
+                    self.__publish(chain=chain, open_transactions=tuple(updated_transactions), times=TimeWindow.from_blocks(chain))
+                    self.__unsigned_transactions = tuple(unsigned_transactions)
                 # Store loaded nodes in a set
-                self.__peer_nodes = set(peer_nodes)
-        except (IOError, IndexError):
-            # Sometimes we can't control if we can access the file or not. So we handle this file error with IOError
-            # We also add Index Error in case that blockchain.txt is empty
-            # This hardcodes the starting data so it is available if we can't read the data file
-            print('Handled exception...')
-        finally:
-            print('Cleanup!')
+                self.__peers = PeerTable(peer_nodes)
+                span.set('blocks', len(chain))
+                span.set('open_transactions', len(updated_transactions))
+                span.set('unsigned_transactions', len(unsigned_transactions))
+                if len(unsigned_transactions) > 0:
+                    print('Set aside {} open transactions without a nonce - they are added again once their wallet signs them with a nonce'.format(
+                        len(unsigned_transactions)))
+            except (IOError, IndexError, codec.DecodeError) as error:
+                # Sometimes we can't control if we can access the file or not. So we handle this file error with IOError
+                # We also add Index Error in case that blockchain.txt is empty
+                # This hardcodes the starting data so it is available if we can't read the data file
+                # A new node has no file yet, that's not an error - the span records why we start with the genesis block
+                span.set('fallback', '{}: {}'.format(type(error).__name__, error))
 
     def save_data(self):
+        """ Write the full state to blockchain-<node_id>.txt (blockchain-<node_id>.bin with the binary storage encoding) and return True
+        if it succeeded. Usually this is called by the persistence scheduler - use flush() to write pending changes immediately. """
+        # Saving runs in the thread of the persistence scheduler, so it's a trace of its own
+        with self.tracer.span('save_data', encoding=self.storage_encoding) as span:
+            saved = self.__write_state()
+            span.set('saved', saved)
+            return saved
+
+    def __write_state(self):
+        # Before the chain is loaded the state is only the genesis block - writing it would replace the chain on disk. The changes stay
+        # pending until the next flush
+        if not self.loaded.is_set():
+            return False
+        # Take the current state first, other threads can publish a new state while we write
+        state = self.__state
+        chain = state.chain
+        # The transactions set aside without a nonce are saved with the open transactions, so they are still there after a restart
+        open_transactions = state.open_transactions + self.__unsigned_transactions
+        peer_nodes = self.__peers.nodes()
+        if self.storage_encoding == 'binary':
+            # The hashes have to belong to the same chain, so we take both while no writer changes them
+            with self.__lock:
+                state = self.__state
+                open_transactions = state.open_transactions + self.__unsigned_transactions
+                block_hashes = self.__tree.main_chain_hashes()
+            return self.__save_binary(state.chain, open_transactions, peer_nodes, block_hashes)
+        # Write to a temporary file and then replace the old file, so a crash during writing never leaves a half written file
+        filename = 'blockchain-{}.txt'.format(self.node_id)
         try:
-            with open('blockchain-{}.txt'.format(self.node_id), mode='w') as f:
+            with open(filename + '.tmp', mode='w') as f:
                 # We can't convert objects to json, therefore we convert the object to a dictionary with __dict__
                 # We are not manipulating this dictionary so we don't need .copy()
                 # We need to insure the transactions are converted to dictionaries
                 # block_el.transactions is the list of transactions sotred in a block which gets converted to a dictionary, 
                 # this the get stored in a block, and then a list of block which is also converted to a dictionary
-                saveable_chain = [block.__dict__ for block in [Block(block_el.index, block_el.previous_hash, [
-                    tx.__dict__ for tx in block_el.transactions], block_el.proof, block_el.timestamp) for block_el in self.__chain]]
+                saveable_chain = [block_to_dict(block_el) for block_el in chain]
                 f.write(json.dumps(saveable_chain))
                 f.write('\n')
                 # We need to convert the objects of open_transactions to a dictionary
-                saveable_tx = [tx.__dict__ for tx in self.__open_transactions]
+                saveable_tx = [tx.__dict__ for tx in open_transactions]
                 f.write(json.dumps(saveable_tx))
                 f.write('\n')
                 # Write connected nodes to file
-                f.write(json.dumps(list(self.__peer_nodes)))
+                f.write(json.dumps(peer_nodes))
                 # save_data = {
                 #     'chain': blockchain,
                 #     'ot': open_transactions
                 # }
                 # f.write(pickle.dumps(save_data))
+            os.replace(filename + '.tmp', filename)
+            return True
         except IOError:
             print('Saving failed!')
+            return False
+
+    def __save_binary(self, chain, open_transactions, peer_nodes, block_hashes):
+        """ Write the state to blockchain-<node_id>.bin in the compressed binary encoding of codec.py, together with the block hashes """
+        filename = 'blockchain-{}.bin'.format(self.node_id)
+        saveable_chain = [block_to_dict(block_el) for block_el in chain]
+        for (dict_block, block_hash) in zip(saveable_chain, block_hashes):
+            dict_block['hash'] = block_hash
+        data = codec.encode_state(saveable_chain, [tx.__dict__ for tx in open_transactions], peer_nodes)
+        try:
+            with open(filename + '.tmp', mode='wb') as f:
+                f.write(data)
+            os.replace(filename + '.tmp', filename)
+            return True
+        except IOError:
+            print('Saving failed!')
+            return False
+
+    def __persist(self, durability=None):
+        """ Mark the state as changed so it gets written to disk
+
+        Arguments:
+            :durability: DURABILITY_SYNC or DURABILITY_ASYNC, None uses the default durability of the blockchain.
+        """
+        self.__persistence.mark_dirty(durability or self.durability)
+
+    def flush(self):
+        """ Write all pending changes to disk now """
+        return self.__persistence.flush()
+
+    def close(self):
+        """ Stop the background threads and write all pending changes - call this on shutdown """
+        self.__stopped.set()
+        self.__persistence.stop()
+
+    def __post_peer(self, node, path, payload):
+        """ Send a POST request to a peer node and record whether it succeeded. Returns the response, or None if the peer couldn't be reached.
+        With the binary wire encoding the payload is sent binary, a peer which rejects that gets the payload again as JSON """
+        with self.tracer.span('post_peer', node=node, path=path) as span:
+            response = self.__send_post(node, path, payload)
+            span.set('status', response.status_code if response != None else None)
+            return response
+
+    def __send_post(self, node, path, payload):
+        # The requests module is imported here, the first time we talk to a peer (see __init__). After that this is only a lookup
+        import requests
+        transport = self.transport if self.transport != None else requests
+        url = 'http://{}{}'.format(node, path)
+        start = time()
+        # We could fail to make a connection to a peer node - we can't predict when it will fail so we use a try block
+        try:
+            if self.wire_encoding == 'binary' and node not in self.__json_peers:
+                response = transport.post(url, data=codec.encode(payload), headers={'Content-Type': codec.MEDIA_TYPE},
+                                               timeout=PEER_TIMEOUT)
+                # An older node answers 415 (unsupported media type) or 400 (no JSON found), so we fall back to JSON
+                if response.status_code not in (400, 415):
+                    self.__peers.record_success(node, time() - start)
+                    return response
+                self.__json_peers.add(node)
+            response = transport.post(url, json=payload, timeout=PEER_TIMEOUT)
+        except requests.exceptions.RequestException:
+            self.__peers.record_failure(node)
+            return None
+        self.__peers.record_success(node, time() - start)
+        return response
+
+    def __get_peer(self, node, path):
+        """ Send a GET request to a peer node and record whether it succeeded. Returns the response, or None if the peer couldn't be reached """
+        import requests
+        transport = self.transport if self.transport != None else requests
+        url = 'http://{}{}'.format(node, path)
+        start = time()
+        # With the binary wire encoding we ask for it, the peer decides - read_peer_response handles both
+        headers = {'Accept': codec.MEDIA_TYPE + ', application/json'} if self.wire_encoding == 'binary' else {}
+        with self.tracer.span('get_peer', node=node, path=path) as span:
+            try:
+                response = transport.get(url, headers=headers, timeout=PEER_TIMEOUT)
+            except requests.exceptions.RequestException:
+                self.__peers.record_failure(node)
+                span.set('status', None)
+                return None
+            self.__peers.record_success(node, time() - start)
+            span.set('status', response.status_code)
+            return response
+
+    def record_peer_success(self, node, latency):
+        """ Record a successful request to a peer which the caller sent itself (like the asyncio node does) """
+        self.__peers.record_success(node, latency)
+
+    def record_peer_pruned_height(self, node, pruned_height):
+        """ Record how far a peer pruned its chain (-1 if it keeps every block), from the X-Pruned-Height header of its /chain route """
+        self.__peers.set_pruned_height(node, pruned_height)
+
+    def record_peer_failure(self, node):
+        """ Record a failed request to a peer which the caller sent itself """
+        self.__peers.record_failure(node)
+
+    def __probe_peers(self):
+        """ Runs in a background thread: try the unhealthy peers again once their backoff has passed and remove peers that stay dead """
+        while not self.__stopped.wait(PROBE_INTERVAL):
+            for node in self.__peers.nodes_to_probe():
+                self.__get_peer(node, '/health')
+            if len(self.__peers.prune(PRUNE_AFTER_FAILURES)) > 0:
+                self.__publish_peers()
+                self.__persist()
 
     def proof_of_work(self):
         """ Increment through different proof numbers to find a valid PoW for our criteria """
+        state = self.__state
         # Fetch the last block - [-1] selects a list element from the right (the last block)
-        last_block = self.__chain[-1]
+        last_block = state.chain[-1]
         # Calculate last hash
         last_hash = hash_block(last_block)
+        return self.__find_proof(state.open_transactions, last_hash)
+
+    def __find_proof(self, transactions, last_hash):
         # Increment through proof numbers until the valid_proof function is satisfied. Output valid proof number
         proof = 0
-        while not Verification.valid_proof(self.__open_transactions, last_hash, proof):
+        while not Verification.valid_proof(transactions, last_hash, proof):
             proof += 1
         return proof
 
@@ -157,53 +739,61 @@ class Blockchain:
             # We want the participant to bethe same as the sender - therefore it doesn't matter which node you are sending from, the sender will always be the same
             participant = sender
 
-        # Fetch a list of all sent coin amounts for the given person
-        # This fetches sent amounts of transaction that were already included in the block
-        tx_sender = [[tx.amount for tx in block.transactions
-                      if tx.sender == participant] for block in self.__chain]
-        # Fetch a list of all sent coin amounts for the given person
-        # This fetches sent amounts of open transactions (to avoid double spending)
-        open_tx_sender = [tx.amount
-                          for tx in self.__open_transactions if tx.sender == participant]
-        # This gives a list with the transactions on the blockchain + open transactions - this is what we have paid in the past and what we are trying to pay now
-        tx_sender.append(open_tx_sender)
-        print(tx_sender)
-        amount_sent = reduce(lambda tx_sum, tx_amt: tx_sum + sum(tx_amt)
-                             if len(tx_amt) > 0 else tx_sum + 0, tx_sender, 0)
-        # This fetches recieved coin amounts of transactions that were already in...
-        # We ignore open transactions here because you shouldn't be able to...
-        # This uses the reduce tool to condense the following code into one line
-
-        # Old code
-        # amount_sent = 0
-        # for tx in tx_sender:
-        #    if len(tx) > 0: # This means the code ignores the genesis block
-        #        amount_sent += tx[0]
-
-        # This fetches recieved coin amounts of transactions that were already included in blocks of the blockchain
-        # We ignore open transactions here because you shouldn't be able to spend coins before the transaction was confirmed
-        tx_recipient = [[tx.amount for tx in block.transactions
-                        if tx.recipient == participant] for block in self.__chain]
-        amount_received = reduce(lambda tx_sum, tx_amt: tx_sum + sum(tx_amt)
-                                 if len(tx_amt) > 0 else tx_sum + 0, tx_recipient, 0)
-        # This also uses the reduce tool to condense the following code into one line
-
-        # Old code
-        # amount_received = 0
-        # for tx in tx_recipient:
-        #    if len(tx) > 0:
-        #        amount_received += tx[0]
-
+        # Read the balances and open transactions from one state so they belong together
+        state = self.__state
+        # The confirmed balance comes from the ledger state, so we don't have to scan every block of the chain
+        confirmed_balance = state.ledger.get_balance(participant)
+        # The sent amounts of open transactions are deducted (to avoid double spending). The pending spends add them up as the
+        # transactions come in, so we don't have to scan the open transactions either
+        # We ignore received open transactions because you shouldn't be able to spend coins before the transaction was confirmed
         # Return the total balance
-        return amount_received - amount_sent
+        return confirmed_balance - state.pending.get_amount(participant)
+
+    def get_next_nonce(self, sender):
+        """ Return the nonce the next transaction of the sender has to have - the last confirmed nonce plus its open transactions with a nonce """
+        state = self.__state
+        return state.ledger.get_nonce(sender) + state.pending.get_nonces(sender) + 1
+
+    def get_account(self, address):
+        """ Return the balances and nonces of an address as a dictionary. Everything comes from one state, so it belongs together """
+        state = self.__state
+        confirmed_balance = state.ledger.get_balance(address)
+        pending = state.pending.get_amount(address)
+        nonce = state.ledger.get_nonce(address)
+        return {
+            'address': address,
+            'balance': confirmed_balance - pending,
+            'confirmed_balance': confirmed_balance,
+            'pending': pending,
+            'nonce': nonce,
+            'next_nonce': nonce + state.pending.get_nonces(address) + 1
+        }
 
     def get_last_blockchain_value(self):
         """ Returns the last value of the current blockchain """
-        if len(self.__chain) < 1:
+        chain = self.__state.chain
+        if len(chain) < 1:
             return None
-        return self.__chain[-1]
+        return chain[-1]
+
+    def __start_verifying(self, tx_hashes):
+        # Claim relayed transactions for verification. Returns True for every hash which is new - False if we have seen it or another
+        # thread is verifying it right now (or it's twice in the list). The claimed hashes have to be released with __stop_verifying
+        claimed = []
+        with self.__verifying_lock:
+            for tx_hash in tx_hashes:
+                new = tx_hash not in self.__seen_transactions and tx_hash not in self.__verifying
+                if new:
+                    self.__verifying.add(tx_hash)
+                claimed.append(new)
+        return claimed
+
+    def __stop_verifying(self, tx_hashes):
+        with self.__verifying_lock:
+            for tx_hash in tx_hashes:
+                self.__verifying.discard(tx_hash)
 
-    def add_transaction(self, recipient, sender, signature, amount=1.0, is_receiving=False):
+    def add_transaction(self, recipient, sender, signature, amount=1.0, is_receiving=False, durability=None, broadcast=True, nonce=None):
         """ Appends a new value as well as the last blockchain value to the blockchain
 
         Arguments:
@@ -211,162 +801,402 @@ class Blockchain:
             :recipient: the recipiento of the coins
             :signature: The signature of the transaction.
             :amount: the amount of coins sent with the transaction, default is 1 coin
+            :is_receiving: True if the transaction was relayed by a peer node.
+            :durability: The durability mode for saving the transaction, None uses the default.
+            :broadcast: False if the caller relays the transaction to the peer nodes itself.
+            :nonce: The nonce of the transaction, it has to be the next nonce of the sender (see get_next_nonce).
         """
         # We should check that in the hosting_node a public key that is not None is stored - A public key should be needed to run the file.
         # Without the following code this can be avoided by passing None for the public and private key into the Wallet() and Blockchain. This should be prevented
         # if self.public_key == None:
         #     return False
-        transaction = Transaction(sender, recipient, signature, amount)
-        # Transaction dictionary contains all data of the transaction
-        if Verification.verify_transaction(transaction, self.get_balance):
-            # This process adds transaction data to open transactions
-            self.__open_transactions.append(transaction)
-            self.save_data()
-            # We can either be creating a new transaction or receiving a broadcast. We only want to broadcast the transaction if we are adding a 
-            # transaction. If we are receiving then we don't want to broadcast as this can cause an infinite number of broadcast between nodes. 
-            # Therefore we use the following if loop:
-            if not is_receiving:
-                # At this point after saving the data, it would be a good place to broadcast this data to the other peer nodes
-                for node in self.__peer_nodes:
-                    # Each node is on a different server so we need to send a HTTP request to send data
-                    url = 'http://{}/broadcast-transaction'.format(node)
-                    # We could fail to make a connection to a peer node - we can't predict when it will fail so we use a try block
-                    try:
-                        # Send a HTTP post request with requests
-                        response = requests.post(url, json={
-                                                 'sender': sender, 'recipient': recipient, 'amount': amount, 'signature': signature})
-                        # Check for errors
-                        if response.status_code == 400 or response.status_code == 500:
-                            print('Transaction declined: Needs resolving')
+        with self.tracer.span('add_transaction', relayed=is_receiving) as span:
+            transaction = Transaction(sender, recipient, signature, amount, nonce)
+            tx_hash = hash_transaction(transaction)
+            # A relayed transaction we already know (or verify right now) is rejected before the expensive signature check
+            if is_receiving and not self.__start_verifying([tx_hash])[0]:
+                span.set('rejected', 'seen')
+                return False
+            try:
+                # The signature check is the expensive part, so we do it before taking the lock
+                with self.tracer.span('verify_signature'):
+                    if not Verification.verify_transaction(transaction, self.get_balance, False):
+                        span.set('rejected', 'signature')
+                        return False
+                # Checking the funds and adding the transaction has to happen together, otherwise two threads could spend the same coins
+                with self.tracer.span('apply'):
+                    with self.__lock:
+                        # Our own client could send the same transaction twice at the same time
+                        if tx_hash in self.__seen_transactions:
+                            span.set('rejected', 'seen')
                             return False
-                    except requests.exceptions.ConnectionError:
-                        continue
+                        if self.get_balance(sender) < amount:
+                            span.set('rejected', 'funds')
+                            return False
+                        # A nonce which was used already is a replayed transaction, a nonce too far ahead is missing the ones before it
+                        # A transaction without a nonce could be replayed forever, so it isn't accepted at all
+                        if not Verification.valid_nonce(nonce, self.get_next_nonce(sender)):
+                            span.set('rejected', 'nonce')
+                            return False
+                        # This process adds transaction data to open transactions
+                        state = self.__state
+                        self.__publish(open_transactions=state.open_transactions + (transaction,), pending=state.pending.add((transaction,)))
+                        # Only now it's seen - a relayed copy is rejected from here on, and so is the relay of a rejected one back to us
+                        self.__seen_transactions.add(tx_hash)
+                        self.events.publish(EVENT_TRANSACTION, transaction.__dict__)
+            finally:
+                if is_receiving:
+                    self.__stop_verifying([tx_hash])
+            with self.tracer.span('persist'):
+                self.__persist(durability)
+            # Transactions we receive are relayed as well, that's how they reach nodes which aren't our peers (gossip). The seen cache of every
+            # node makes sure a transaction isn't relayed in circles forever
+            if broadcast:
+                with self.tracer.span('broadcast') as broadcast_span:
+                    # We only send the transaction to a few random peers, so the work per node stays the same no matter how big the network gets
+                    for node in self.gossip_peers():
+                        # Each node is on a different server so we need to send a HTTP request to send data
+                        response = self.__post_peer(node, '/broadcast-transaction', transaction.__dict__)
+                        if response == None:
+                            continue
+                        # Check for errors - a peer which declines the transaction needs resolving, the span records which one
+                        if response.status_code == 400 or response.status_code == 500:
+                            broadcast_span.set('declined_by', node)
+                            if not is_receiving:
+                                return False
             return True
-        return False
+
+    def add_transactions(self, transactions, is_receiving=False, durability=None, broadcast=True):
+        """ Verifies a batch of transactions together and appends the valid ones to the open transactions.
+        The accepted transactions are saved with one write and broadcast to every peer node with one request.
+
+        Arguments:
+            :transactions: A list of dictionaries with the sender, recipient, signature, amount and (optionally) nonce of every transaction.
+            :is_receiving: True if the batch was relayed by a peer node, transactions we already know are then rejected.
+            :durability: The durability mode for saving the batch, None uses the default.
+            :broadcast: False if the caller relays the accepted transactions to the peer nodes itself.
+        Returns a list with True or False for every transaction of the batch.
+        """
+        with self.tracer.span('add_transactions', relayed=is_receiving, transactions=len(transactions)) as span:
+            converted_tx = [Transaction(
+                tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce')) for tx in transactions]
+            tx_hashes = [hash_transaction(tx) for tx in converted_tx]
+            # Check the signatures without holding the lock, then check the funds of the correctly signed transactions under the lock
+            # Relayed transactions we already know (or verify right now) are skipped without checking the signature
+            verifying = self.__start_verifying(tx_hashes) if is_receiving else [True] * len(tx_hashes)
+            try:
+                with self.tracer.span('verify_signatures'):
+                    signed = [claimed and Verification.verify_transaction(tx, self.get_balance, False)
+                              for (tx, claimed) in zip(converted_tx, verifying)]
+                with self.tracer.span('apply'):
+                    with self.__lock:
+                        signed = [valid and tx_hash not in self.__seen_transactions for (valid, tx_hash) in zip(signed, tx_hashes)]
+                        funded = iter(Verification.verify_transaction_batch(
+                            [tx for (tx, valid) in zip(converted_tx, signed) if valid], self.get_balance, check_signatures=False,
+                            get_nonce=self.get_next_nonce))
+                        results = [valid and next(funded) for valid in signed]
+                        accepted = [tx for (tx, valid) in zip(converted_tx, results) if valid]
+                        span.set('accepted', len(accepted))
+                        if len(accepted) == 0:
+                            return results
+                        state = self.__state
+                        self.__publish(open_transactions=state.open_transactions + tuple(accepted), pending=state.pending.add(accepted))
+                        # Only the accepted transactions are seen
+                        for (tx_hash, valid) in zip(tx_hashes, results):
+                            if valid:
+                                self.__seen_transactions.add(tx_hash)
+                        for tx in accepted:
+                            self.events.publish(EVENT_TRANSACTION, tx.__dict__)
+            finally:
+                if is_receiving:
+                    self.__stop_verifying([tx_hash for (tx_hash, claimed) in zip(tx_hashes, verifying) if claimed])
+            with self.tracer.span('persist'):
+                self.__persist(durability)
+            if broadcast:
+                self.broadcast_transactions([tx.__dict__ for tx in accepted])
+            return results
+
+    def broadcast_transactions(self, transactions):
+        """ Send a list of accepted transactions (dictionaries) to a few random peer nodes with one request each, they relay them further """
+        with self.tracer.span('broadcast', transactions=len(transactions)) as span:
+            for node in self.gossip_peers():
+                response = self.__post_peer(node, '/broadcast-transactions/batch', {'transactions': transactions})
+                if response != None and (response.status_code == 400 or response.status_code == 500):
+                    span.set('declined_by', node)
 
 # Generate PoW and add it to the mine_block metadata
 
-    def mine_block(self):
-        """ This takes all open transactions and adds to a block (and then then blockchain) - it procesess open transactions """
+    def mine_block(self, durability=None, broadcast=True):
+        """ This takes all open transactions and adds to a block (and then then blockchain) - it procesess open transactions.
+        If another block arrives during the proof of work we mine again on top of it, up to MINING_ATTEMPTS times - after that it
+        raises StaleTip. Returns None if the block can't be mined at all (no wallet or an invalid signature).
+
+        Arguments:
+            :durability: The durability mode for saving the block, None uses the default.
+            :broadcast: False if the caller broadcasts the block to the peer nodes itself (like the asyncio node does).
+        """
         if self.public_key == None:
             return None
-        # Fetch the current last block of the blockchain
-        last_block = self.__chain[-1]
-        # Hash the last block (to be able to compare it to the stored value and verify it)
-        hashed_block = hash_block(last_block)
-        # Fetch valid PoW for the current block
-        proof = self.proof_of_work()
-        # Miners should be rewarded, so let's create a reward transaction
-        reward_transaction = Transaction(
-            'MINING', self.public_key, '', MINING_REWARD)
-        # The following 2 lines ensures that reward_transactions is managed locally, this means the global variable open_transactions wouldn't 
-        # be affected if mine_block denies a transaction - we don't want to add a reward if the transaction doesn't completely process
-        # Copy transaction instead of manipulating the open_transactions
-        # This ensures that if or some reason the mining should fail,we don't...
-        # This returns a new list (and doesn't affect the orignal list) - Refer to Lesson 78
-        copied_transactions = self.__open_transactions[:]
-        # After we have constructed our block objects we want to verify the signature for every transaction (except the reward transaction) with 
-        # the following code:
-        for tx in copied_transactions:
-            if not Wallet.verify_transaction(tx):
-                return None
-        copied_transactions.append(reward_transaction)
-        # open_transactions.append(reward_transaction)
-        block = Block(len(self.__chain), hashed_block,
-                      copied_transactions, proof)
-        self.__chain.append(block)
-        self.__open_transactions = []
-        self.save_data()
-        # Now we need to inform he peer nodes if there is a new block
-        for node in self.__peer_nodes:
-            url = 'http://{}/broadcast-block'.format(node)
-            # Convert block to a dictionary
-            converted_block = block.__dict__.copy()
-            converted_block['transactions'] = [
-                tx.__dict__ for tx in converted_block['transactions']]
-            # The data we want to append is a dictionary with the block key
+        attempt = 1
+        while True:
             try:
-                response = requests.post(url, json={'block': converted_block})
+                return self.__mine(durability, broadcast, attempt)
+            except StaleTip:
+                if attempt >= MINING_ATTEMPTS:
+                    raise
+                attempt += 1
+
+    def __mine(self, durability, broadcast, attempt):
+        # One attempt of mine_block, on the last block right now. Raises StaleTip if another block was added meanwhile
+        with self.tracer.span('mine_block', attempt=attempt) as span:
+            # Mining works on a snapshot of the state, so the slow PoW doesn't block readers or new transactions
+            state = self.__state
+            # Fetch the current last block of the blockchain
+            last_block = state.chain[-1]
+            # Hash the last block (to be able to compare it to the stored value and verify it)
+            hashed_block = hash_block(last_block)
+            # Copy transaction instead of manipulating the open_transactions
+            # This ensures that if or some reason the mining should fail,we don't...
+            # This returns a new list (and doesn't affect the orignal list) - Refer to Lesson 78
+            # Only transactions which are still valid on our chain are mined - their nonces continue the confirmed ones
+            valid = Verification.verify_transaction_batch(state.open_transactions, state.ledger.get_balance, check_signatures=False,
+                                                          get_nonce=lambda sender: state.ledger.get_nonce(sender) + 1)
+            copied_transactions = [tx for (tx, ok) in zip(state.open_transactions, valid) if ok]
+            span.set('transactions', len(copied_transactions))
+            # Fetch valid PoW for the current block
+            with self.tracer.span('proof_of_work') as pow_span:
+                proof = self.__find_proof(copied_transactions, hashed_block)
+                pow_span.set('proof', proof)
+            # Miners should be rewarded, so let's create a reward transaction
+            reward_transaction = Transaction(
+                'MINING', self.public_key, '', MINING_REWARD)
+            # After we have constructed our block objects we want to verify the signature for every transaction (except the reward transaction) with 
+            # the following code:
+            with self.tracer.span('verify_signatures'):
+                for tx in copied_transactions:
+                    if not Wallet.verify_transaction(tx):
+                        span.set('rejected', 'signature')
+                        return None
+            # The reward is added after the PoW, that's why verify_chain and add_block ignore the last transaction when checking the proof
+            copied_transactions.append(reward_transaction)
+            # The block gets the time it was mined at - unless the clocks of the nodes before us were ahead of ours, then it gets the
+            # median time of the last blocks, the earliest timestamp the other nodes accept
+            block = Block(len(state.chain), hashed_block,
+                          copied_transactions, proof, max(time(), state.times.median()))
+            span.set('index', block.index)
+            with self.tracer.span('apply'):
+                with self.__lock:
+                    current = self.__state
+                    # Another block was added while we were mining, so our block doesn't extend the chain anymore
+                    if current.chain[-1] is not last_block:
+                        span.set('rejected', 'stale')
+                        raise StaleTip('Another block was added while mining, try again.')
+                    # Only remove the transactions we mined - transactions which arrived during mining stay open
+                    mined = set(id(tx) for tx in copied_transactions)
+                    self.__extend(current, block, tuple(tx for tx in current.open_transactions if id(tx) not in mined))
+            # Our own block comes back to us through the gossip of the other nodes, so we remember it
+            self.__seen_blocks.add(hash_block(block))
+            # The write itself happens in the persistence thread (its own save_data trace), unless the durability is sync
+            with self.tracer.span('persist'):
+                self.__persist(durability)
+            if broadcast:
+                self.broadcast_block(block)
+            return block
+
+    def broadcast_block(self, block):
+        """ Send a new block to a few random peer nodes, which relay it further """
+        with self.tracer.span('broadcast', index=block.index) as span:
+            # Now we need to inform he peer nodes if there is a new block
+            # We only send the compact block - the header and the transaction hashes
+            compact_block = self.compact_block(block)
+            for node in self.gossip_peers():
+                response = self.__post_peer(node, '/broadcast-block', {'compact_block': compact_block})
+                if response == None:
+                    continue
+                # 202 means the peer doesn't have some of the transactions, so we send exactly those in a second request
+                if response.status_code == 202:
+                    try:
+                        missing = set(read_peer_response(response)['missing'])
+                    except (ValueError, KeyError):
+                        continue
+                    missing_transactions = [tx.__dict__ for tx in block.transactions[:-1] if hash_transaction(tx) in missing]
+                    response = self.__post_peer(node, '/broadcast-block', {
+                                                'compact_block': compact_block, 'transactions': missing_transactions})
+                    if response == None:
+                        continue
+                # A peer which declines the block needs resolving, the span records which one
                 if response.status_code == 400 or response.status_code == 500:
-                    print('Block declined: Needs resolving')
+                    span.set('declined_by', node)
                 # If status code = 409 we need to resolve conflicts
                 if response.status_code == 409:
                     self.resolve_conflicts = True
-            except requests.exceptions.ConnectionError:
-                continue
-        return block
+                    span.set('resolve_conflicts', True)
 
     # mine_block mines a new block with a reward. We want a function just to add a block (NOT to mine a block)
-    def add_block(self, block):
-        # Extract transaction data from transaction dictionary in block (block['transaction']) then create a list of all these transactions so 
-        # we can later pass it to valid_proof
-        transactions = [Transaction(
-            tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']]
-        proof_is_valid = Verification.valid_proof(
-            transactions[:-1], block['previous_hash'], block['proof'])  # To ignore the reward transaction we use transaction[:-1]
-        # Check if in the peer nodes blockchain the hash of the last block matches the hash stored in the last block of the incoming block
-        hashes_match = hash_block(self.chain[-1]) == block['previous_hash']
-        # Combine the above checks in a if statement
-        if not proof_is_valid or not hashes_match:
-            return False
-        # If we pass all the above checks we now know it is safe to add a block
-        # First we need to create a block object
-        converted_block = Block(
-            block['index'], block['previous_hash'], transactions, block['proof'], block['timestamp'])
-        self.__chain.append(block)
-        # We need to also update open_transactions
-        stored_transactions = self.__open_transactions[:]
-        # Loop through incoming transactions (itx)
-        for itx in block['transactions']:
-            for opentx in stored_transactions:
-                # For every incoming transaction check if its part of open transactions
-                # Also check if sender, recipient, amount and signature are the same in the open transactions and incoming transactions
-                if opentx.sender == itx['sender'] and opentx.recipient == itx['recipient'] and \
-                    opentx.amount == itx['amount'] and opentx.signature == itx['signature']:
-                    # If they are equal try to remove it
+    def add_block(self, block, durability=None, broadcast=True):
+        """ Add a block of a peer node. The block doesn't have to extend our chain - it can also start or extend a competing branch.
+        If that branch has more work than our chain, we reorganize to it. Returns True if the block was added, False if it's invalid
+        or its parent is unknown (then we need to resolve).
+
+        Arguments:
+            :block: The block as a dictionary (like in the /broadcast-block route).
+            :durability: The durability mode for saving the block, None uses the default.
+            :broadcast: False if the caller relays the block to the peer nodes itself.
+        """
+        with self.tracer.span('add_block', index=block['index']) as span:
+            # Extract transaction data from transaction dictionary in block (block['transaction']) then create a list of all these transactions so 
+            # we can later pass it to valid_proof
+            transactions = [Transaction(
+                tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce')) for tx in block['transactions']]
+            span.set('transactions', len(transactions))
+            with self.tracer.span('verify_proof'):
+                proof_is_valid = Verification.valid_proof(
+                    transactions[:-1], block['previous_hash'], block['proof'])  # To ignore the reward transaction we use transaction[:-1]
+            if not proof_is_valid:
+                span.set('rejected', 'proof')
+                return False
+            # First we need to create a block object
+            converted_block = Block(
+                block['index'], block['previous_hash'], transactions, block['proof'], block['timestamp'])
+            block_hash = hash_block(converted_block)
+            # The incoming transactions are identified by sender, recipient, amount and signature so we can remove them from open transactions
+            incoming = set((itx['sender'], itx['recipient'], itx['amount'], itx['signature']) for itx in block['transactions'])
+            # True if our main chain changed (and has to be saved)
+            changed = True
+            with self.tracer.span('apply') as apply_span:
+                with self.__lock:
+                    current = self.__state
+                    if block_hash in self.__tree:
+                        apply_span.set('result', 'known')
+                        return True
+                    # The timestamp is checked against the median time of the branch the block extends. For our main chain the window
+                    # is kept up to date block by block, a side branch only needs its last few blocks from the tree
+                    parent = self.__tree.get(block['previous_hash'])
+                    if parent != None:
+                        times = current.times if parent is self.__tree.tip else TimeWindow.from_blocks(self.__tree.ancestors(parent))
+                        reason = check_timestamp(block['timestamp'], times.median(), time())
+                        if reason != None:
+                            apply_span.set('result', 'timestamp')
+                            span.set('rejected', 'timestamp')
+                            return False
+                    # Check if the hash of our last block matches the previous_hash of the incoming block
+                    # This has to be checked under the lock, another thread could add a block at the same time
+                    hashes_match = hash_block(current.chain[-1]) == block['previous_hash']
+                    if hashes_match and converted_block.index == len(current.chain):
+                        # The usual case: the block extends our chain. Its nonces have to continue the nonces of our chain
+                        if not Verification.verify_nonces(converted_block, current.ledger.get_nonce):
+                            apply_span.set('result', 'nonce')
+                            span.set('rejected', 'nonce')
+                            return False
+                        # We need to also update open_transactions - every open transaction which is part of the incoming block is removed
+                        stored_transactions = tuple(opentx for opentx in current.open_transactions
+                                                    if (opentx.sender, opentx.recipient, opentx.amount, opentx.signature) not in incoming)
+                        self.__extend(current, converted_block, stored_transactions)
+                        apply_span.set('result', 'extend')
+                    else:
+                        # The block belongs to a competing branch - we keep it, because that branch could get more work than ours
+                        node = self.__tree.add(converted_block, block_hash)
+                        if node == None:
+                            apply_span.set('result', 'unknown_parent')
+                            return False
+                        if node.work <= self.__tree.tip.work or not self.__reorganize(current, node):
+                            changed = False
+                            self.__tree.prune(MAX_FORK_DEPTH)
+                            apply_span.set('result', 'side_branch')
+                        else:
+                            apply_span.set('result', 'reorganize')
+            self.__seen_blocks.add(block_hash)
+            if changed:
+                with self.tracer.span('persist'):
+                    self.__persist(durability)  # Update the stored data for the peer node
+            # Relay the new block to a few of our peers, so it reaches the nodes which aren't connected to the miner
+            # Blocks of competing branches are relayed as well, so every node learns about the branch and can switch to it
+            if broadcast:
+                self.broadcast_block(converted_block)
+            return True
+
+    # Resolve conflicts using the theory that the node with the longest chain always wins
+    def resolve(self, durability=None):
+        with self.tracer.span('resolve') as span:
+            # Go through all nodes in peer nodes to get snapshot of the block chain on each peer node
+            # Fetching the peer chains is slow, so we don't hold the lock while we do it
+            peer_chains = []
+            # Unhealthy peers are skipped, the background prober tells us when they are back
+            with self.tracer.span('fetch_chains'):
+                for node in self.get_healthy_peer_nodes():
+                    # Call the chain of peer nodes with the following URL - this calls the GET /chain route
+                    response = self.__get_peer(node, '/chain')
+                    if response == None:
+                        continue
+                    # Pruned peers tell us how far they pruned - their chain only starts after that block
+                    self.record_peer_pruned_height(node, int(response.headers.get('X-Pruned-Height', -1)))
                     try:
-                        self.__open_transactions.remove(opentx)
+                        # Now lets see whats in the request response - extract data as json (or the binary encoding if the peer sent that)
+                        peer_chains.append(read_peer_response(response))
                     except ValueError:
-                        print('Item was already removed')
-        self.save_data  # Update the stored data for the peer node
-        return True
+                        continue
+            span.set('peer_chains', len(peer_chains))
+            return self.resolve_from(peer_chains, durability)
 
-    # Resolve conflicts using the theory that the node with the longest chain always wins
-    def resolve(self):
-        winner_chain = self.chain
-        # Control whether our current chain is getting replaced. Initially we assume it is not
-        replace = False
-        # Go through all nodes in peer nodes to get snapshot of the block chain on each peer node
-        for node in self.__peer_nodes:
-            # Call the chain of peer nodes with the following URL - this calls the GET /chain route
-            url = 'http://{}/chain'.format(node)
-            try:
-                # Try to send a request to the url
-                response = requests.get(url)
-                # Now lets see whats in the request response - extract data as json
-                node_chain = response.json()
+    def resolve_from(self, peer_chains, durability=None):
+        """ Add the blocks of the given peer chains which we don't know yet to the block tree and switch to the branch with the most work.
+        Only the blocks after the last block we share with a peer are verified and applied - our open transactions are kept, and the
+        transactions of blocks we undo go back to them.
+        This is the part of resolve which doesn't need the network, so a node which fetches the chains itself (like the asyncio node) can use it.
+
+        Arguments:
+            :peer_chains: A list of chains in the JSON format of the /chain route.
+            :durability: The durability mode for saving the new chain, None uses the default.
+        """
+        with self.tracer.span('resolve_from', peer_chains=len(peer_chains)) as span:
+            # Control whether our current chain is getting replaced
+            replace = False
+            for node_chain in peer_chains:
                 # We have a list, using nested list comprehension create a new list of block objects - use the Block constructor.
                 # Then where we add transactions we need a list comprehension where we create a new list of transactions
                 node_chain = [Block(block['index'], block['previous_hash'], [Transaction(
-                    tx['sender'], tx['recipient'], tx['signature'], tx['amount']) for tx in block['transactions']],
+                    tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce')) for tx in block['transactions']],
                     block['proof'], block['timestamp']) for block in node_chain]
-                # Create node chain that is a list of blocks which has transactions that are transaction objects
-                node_chain_length = len(node_chain)
-                local_chain_length = len(winner_chain)
-                # We need to find out if the chain of the other peer node is longer than the current chain and if it's valid
-                if node_chain_length > local_chain_length and Verification.verify_chain(node_chain):
-                    # Make the longest chain the winner chain
-                    winner_chain = node_chain
-                    replace = True
-            except requests.exceptions.ConnectionError:
-                continue
-        self.resolve_conflicts = False
-        self.chain = winner_chain
-        # If we are replacing our blockchain then we can assume all of our open transactions are incorrect. Therefore we need to reset them
-        if replace:
-            self.__open_transactions = []
-        self.save_data()
-        return replace
+                # Every block in the tree has all its ancestors in the tree, so the blocks we know form the start of the peer chain.
+                # A binary search finds where the unknown blocks begin without hashing the whole chain
+                low = 0
+                high = len(node_chain)
+                while low < high:
+                    middle = (low + high) // 2
+                    if hash_block(node_chain[middle]) in self.__tree:
+                        low = middle + 1
+                    else:
+                        high = middle
+                # start == 0 means the peer has another genesis block, start == len(node_chain) means we know every block
+                start = low
+                if start == 0 or start == len(node_chain):
+                    continue
+                # We only verify the new blocks and how they link to the last block we know
+                with self.tracer.span('verify_chain', blocks=len(node_chain) - start) as verify_span:
+                    # The timestamps of the new blocks are checked against the median time of the blocks before them, which we know
+                    known = self.__tree.get(hash_block(node_chain[start - 1]))
+                    times = TimeWindow.from_blocks(self.__tree.ancestors(known)) if known != None else None
+                    valid = Verification.verify_chain(node_chain[start - 1:], times)
+                    verify_span.set('valid', valid)
+                if not valid:
+                    continue
+                with self.tracer.span('reorganize'):
+                    with self.__lock:
+                        node = None
+                        for block in node_chain[start:]:
+                            node = self.__tree.add(block)
+                            if node == None:
+                                break
+                            self.__seen_blocks.add(node.block_hash)
+                        if node != None and node.work > self.__tree.tip.work and self.__reorganize(self.__state, node):
+                            replace = True
+            with self.__lock:
+                self.resolve_conflicts = False
+            span.set('replaced', replace)
+            if replace:
+                with self.tracer.span('persist'):
+                    self.__persist(durability)
+            return replace
 
     def add_peer_node(self, node):
         """Adds a new node to the peer node set.
@@ -375,9 +1205,10 @@ class Blockchain:
             :node: The node URL which should be added.
         """
         # Access peer_nodes and add a node
-        self.__peer_nodes.add(node)
+        self.__peers.add(node)
+        self.__publish_peers()
         # Save connected nodes list to local blockchain.txt file
-        self.save_data()
+        self.__persist()
 
     def remove_peer_node(self, node):
         """Removes a new node to the peer node set.
@@ -385,12 +1216,24 @@ class Blockchain:
         Arguments:
             :node: The node URL which should be removed.
         """
-        self.__peer_nodes.discard(node)
-        self.save_data()
+        self.__peers.remove(node)
+        self.__publish_peers()
+        self.__persist()
+
+    def __publish_peers(self):
+        self.events.publish(EVENT_PEERS, {'nodes': self.__peers.nodes()})
 
     def get_peer_nodes(self):
         """Return a list of all connected peer nodes."""
-        return list(self.__peer_nodes)
+        return self.__peers.nodes()
+
+    def get_healthy_peer_nodes(self):
+        """Return a list of the peer nodes which are currently healthy."""
+        return self.__peers.healthy_nodes()
+
+    def get_peer_stats(self):
+        """Return the health of every peer node: last seen time, latency, failures in a row and the circuit breaker state."""
+        return self.__peers.stats()
 
 
 # Notes
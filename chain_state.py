@@ -0,0 +1,9 @@
+from collections import namedtuple
+
+# An immutable snapshot of the blockchain state: the chain and the open transactions are tuples and the ledger is never changed once it is published.
+# Writers build a new ChainState and publish it by replacing a single reference, so readers always see a chain, open transactions and
+# balances which belong together - without taking a lock.
+# columns is the ColumnarView of the chain, or None until somebody asks for it (see Blockchain.get_columns)
+# times is the TimeWindow of the last blocks of the chain (see median_time.py), a new block has to be at least as late as its median
+# pending is the PendingSpends of the open transactions (see ledger.py), it's replaced together with them
+ChainState = namedtuple('ChainState', ['chain', 'open_transactions', 'ledger', 'columns', 'times', 'pending'], defaults=(None, None, None))
@@ -0,0 +1,267 @@
+import json
+import os
+
+import chain_verifier
+import codec
+from block import Block
+from median_time import MEDIAN_TIME_SPAN
+from blockchain import PEER_TIMEOUT, read_peer_response
+from utilityfolder.hash_util import hash_block
+
+# The number of characters read from a file at once while parsing
+READ_SIZE = 1 << 16
+# Blocks fetched from a node with one /chain request while exporting
+EXPORT_BATCH_SIZE = 500
+# Blocks verified and written together while importing - the import only holds this many blocks in memory, and after an
+# interruption it resumes after the last batch it wrote
+IMPORT_BATCH_SIZE = 2000
+
+
+def iter_json_array(stream):
+    """ Yield the elements of a JSON array (like the chain line of a blockchain file or a /chain response) one by one, without
+    reading the whole array into memory. Reading stops at the end of the array, so the lines after it are never read.
+
+    Arguments:
+        :stream: A text file object which is positioned at (or before whitespace before) the opening bracket.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    at_end = False
+    started = False
+    read_size = READ_SIZE
+    while True:
+        # Skip the whitespace and the separators between the elements
+        while position < len(buffer) and buffer[position] in ' \t\r\n,[':
+            if buffer[position] == '[':
+                if started:
+                    break
+                started = True
+            position += 1
+        if position < len(buffer) and buffer[position] == ']' and started:
+            return
+        if position < len(buffer) and started:
+            try:
+                (element, end) = decoder.raw_decode(buffer, position)
+                # raw_decode only knows an element is complete when something follows it (a number could go on), unless the file ended
+                if end < len(buffer) or at_end:
+                    yield element
+                    position = end
+                    read_size = READ_SIZE
+                    continue
+            except ValueError:
+                if at_end:
+                    raise ValueError('Invalid JSON at character {} of the array.'.format(position))
+        elif at_end:
+            raise ValueError('The JSON array is not complete.')
+        # Drop what we have parsed and read more - an element bigger than one read takes several, each one twice as big
+        buffer = buffer[position:]
+        position = 0
+        chunk = stream.read(read_size)
+        read_size *= 2
+        if chunk == '':
+            at_end = True
+        buffer += chunk
+
+
+def iter_records(stream):
+    """ Yield the block dictionaries of a stream - either JSON lines (one block per line, what export writes) or a JSON array
+    (a blockchain-<port>.txt file or a saved /chain response) """
+    first = stream.read(1)
+    while first.isspace():
+        first = stream.read(1)
+    if first == '':
+        return
+    if first == '[':
+        # The bracket was already read, so iter_json_array gets it back in front of the rest
+        yield from iter_json_array(_Prefixed(first, stream))
+        return
+    line = first + stream.readline()
+    while line != '':
+        if line.strip():
+            yield json.loads(line)
+        line = stream.readline()
+
+
+class _Prefixed:
+    # A text stream with some characters put back in front of it
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size):
+        if self.prefix != '':
+            (data, self.prefix) = (self.prefix, '')
+            return data + self.stream.read(max(size - len(data), 0))
+        return self.stream.read(size)
+
+
+def iter_node_blocks(node, start=0, batch_size=EXPORT_BATCH_SIZE, transport=None):
+    """ Yield the blocks of a running node (host:port) from index start on, fetched batch by batch with /chain?start=&end=.
+    Only one batch is in memory at a time, and the node sends it in the binary encoding if it can (see codec.py) """
+    if transport == None:
+        import requests
+        transport = requests
+    headers = {'Accept': codec.MEDIA_TYPE + ', application/json'}
+    while True:
+        response = transport.get('http://{}/chain?start={}&end={}'.format(node, start, start + batch_size), headers=headers,
+                                 timeout=PEER_TIMEOUT)
+        if response.status_code == 410:
+            raise ValueError('The node pruned the blocks before index {}, export needs every block.'.format(
+                int(response.headers.get('X-Pruned-Height', -1)) + 1))
+        if response.status_code != 200:
+            raise ValueError('The node answered /chain with status {}.'.format(response.status_code))
+        blocks = read_peer_response(response)
+        if len(blocks) == 0:
+            return
+        # A node which ignores the range would send the same blocks forever
+        if blocks[0]['index'] != start:
+            raise ValueError('Asked for the blocks from index {}, but the node sent the ones from {}.'.format(start, blocks[0]['index']))
+        yield from blocks
+        start = blocks[-1]['index'] + 1
+        if len(blocks) < batch_size:
+            return
+
+
+def export_chain(blocks, output):
+    """ Write the blocks as JSON lines (one block per line) and return the number of blocks
+
+    Arguments:
+        :blocks: An iterable of block dictionaries.
+        :output: A text file object.
+    """
+    count = 0
+    for block in blocks:
+        output.write(json.dumps(block))
+        output.write('\n')
+        count += 1
+    return count
+
+
+class ChainImportError(Exception):
+    """ Raised when a stream can't be imported - an invalid block, a block in the wrong place or an existing chain """
+    pass
+
+
+class ChainImporter:
+    """ Imports a stream of blocks into the storage of a node (blockchain-<node_id>.txt), with constant memory.
+
+    The blocks are verified in batches on a process pool (see chain_verifier.py) and appended to blockchain-<node_id>.txt.import.
+    After every batch the checkpoint blockchain-<node_id>.txt.checkpoint records how far the file is written, the last blocks in it
+    (the next batch is linked to them and checked against their median time) and the last nonce of every sender so far.
+    An interrupted import resumes there: the file is cut back to the checkpoint and the blocks up to the last committed one are skipped.
+    When the stream ends the open transactions and peer lines are added and the file replaces the blockchain file of the node.
+
+    Attributes:
+        :node_id: The id (port) of the node.
+        :processes: The number of verification processes, None uses one per CPU.
+        :check_signatures: False only checks the links and the proofs of work.
+        :batch_size: The number of blocks verified and written together.
+    """
+
+    def __init__(self, node_id, processes=None, check_signatures=True, batch_size=IMPORT_BATCH_SIZE):
+        self.node_id = node_id
+        self.processes = processes
+        self.check_signatures = check_signatures
+        self.batch_size = batch_size
+        self.filename = 'blockchain-{}.txt'.format(node_id)
+        self.partial_filename = self.filename + '.import'
+        self.checkpoint_filename = self.filename + '.checkpoint'
+
+    def read_checkpoint(self):
+        """ Return the checkpoint of an interrupted import, None if there is none """
+        try:
+            with open(self.checkpoint_filename, mode='r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def __write_checkpoint(self, checkpoint):
+        # Written to a temporary file first, so an interruption never leaves half a checkpoint
+        with open(self.checkpoint_filename + '.tmp', mode='w') as f:
+            json.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.checkpoint_filename + '.tmp', self.checkpoint_filename)
+
+    def run(self, blocks, replace=False, progress=None):
+        """ Import the blocks and return the number of blocks of the imported chain. Raises ChainImportError if the stream can't be imported.
+
+        Arguments:
+            :blocks: An iterable of block dictionaries, starting with the genesis block.
+            :replace: True replaces an existing chain of the node, otherwise its existence is an error.
+            :progress: Called with the number of committed blocks after every batch.
+        """
+        checkpoint = self.read_checkpoint()
+        if checkpoint == None:
+            for filename in (self.filename, 'blockchain-{}.bin'.format(self.node_id)):
+                if os.path.exists(filename) and not replace:
+                    raise ChainImportError('{} exists already - it is only replaced with --force (replace=True).'.format(filename))
+            with open(self.partial_filename, mode='w') as f:
+                f.write('[')
+            checkpoint = {'committed': -1, 'offset': 1, 'last_blocks': [], 'nonces': {}}
+            self.__write_checkpoint(checkpoint)
+        # Everything after the last checkpoint is thrown away, those blocks are read and verified again
+        with open(self.partial_filename, mode='r+') as f:
+            f.truncate(checkpoint['offset'])
+        batch = []
+        for block in blocks:
+            if block['index'] <= checkpoint['committed']:
+                continue
+            batch.append(block)
+            if len(batch) >= self.batch_size:
+                checkpoint = self.__commit(batch, checkpoint, progress)
+                batch = []
+        if len(batch) > 0:
+            checkpoint = self.__commit(batch, checkpoint, progress)
+        if checkpoint['committed'] < 0:
+            raise ChainImportError('The stream has no blocks.')
+        with open(self.partial_filename, mode='a') as f:
+            # No open transactions and no peers - the node gets those once it runs
+            f.write(']\n[]\n[]')
+            f.flush()
+            os.fsync(f.fileno())
+        # A binary file would be read instead of the imported one (see Blockchain.__read_file)
+        if os.path.exists('blockchain-{}.bin'.format(self.node_id)):
+            os.remove('blockchain-{}.bin'.format(self.node_id))
+        os.replace(self.partial_filename, self.filename)
+        os.remove(self.checkpoint_filename)
+        return checkpoint['committed'] + 1
+
+    def __commit(self, batch, checkpoint, progress):
+        # Verify a batch, append it to the partial file, move the checkpoint behind it and return the new checkpoint
+        expected = checkpoint['committed'] + 1
+        for (offset, block) in enumerate(batch):
+            if block['index'] != expected + offset:
+                raise ChainImportError('Expected block {}, but the stream has block {}.'.format(expected + offset, block['index']))
+            if 'transactions' not in block:
+                raise ChainImportError('Block {} was pruned - an import needs every block in full.'.format(block['index']))
+        previous = checkpoint['last_blocks']
+        if len(previous) == 0:
+            # The chain has to start with the same genesis block every node has
+            if hash_block(chain_verifier.dict_to_block(batch[0])) != hash_block(Block(0, '', [], 100, 0)):
+                raise ChainImportError('The stream starts with another genesis block.')
+            chain = batch
+            verified = 1
+        else:
+            # The last blocks we committed go in front, so the first block of the batch is checked against them
+            chain = previous + batch
+            verified = len(previous)
+        # A checkpoint written before there were nonces doesn't know them, the nonces of that import can't be checked anymore
+        result = chain_verifier.verify_chain(chain, self.processes, self.check_signatures, verified=verified, nonces=checkpoint.get('nonces'),
+                                             check_nonces=checkpoint.get('nonces') != None)
+        if not result.valid:
+            raise ChainImportError('Block {} is invalid: {}'.format(chain[result.failed_index]['index'], result.reason))
+        with open(self.partial_filename, mode='a') as f:
+            for block in batch:
+                if f.tell() > 1:
+                    f.write(', ')
+                f.write(json.dumps(block))
+            f.flush()
+            os.fsync(f.fileno())
+            offset = f.tell()
+        checkpoint = {'committed': batch[-1]['index'], 'offset': offset, 'last_blocks': chain[-MEDIAN_TIME_SPAN:], 'nonces': result.nonces}
+        self.__write_checkpoint(checkpoint)
+        if progress != None:
+            progress(checkpoint['committed'] + 1)
+        return checkpoint
@@ -0,0 +1,154 @@
+# Offline tools for the blockchain files of a node - they work without a running node
+# python3 chain_tool.py verify blockchain-5000.txt
+# python3 chain_tool.py verify blockchain-5000.bin --processes 4 --no-signatures
+# python3 chain_tool.py export blockchain-5000.txt -o chain.jsonl   (or --node localhost:5000 instead of the file)
+# python3 chain_tool.py import chain.jsonl 5001                     (run it again after an interruption to resume)
+
+import json
+import sys
+from argparse import ArgumentParser
+from time import time
+
+import codec
+import chain_stream
+import chain_verifier
+
+
+def read_chain(path):
+    """ Read the chain (a list of block dictionaries) of a blockchain file - JSON (.txt) or the binary encoding (.bin) """
+    with open(path, mode='rb') as f:
+        data = f.read()
+    if data[:len(codec.MAGIC)] == codec.MAGIC:
+        (chain, open_transactions, peer_nodes) = codec.decode_state(data)
+        return chain
+    # The first line of the JSON file is the chain
+    return json.loads(data.split(b'\n', 1)[0])
+
+
+def print_progress(done, total):
+    # Progress goes to stderr, so the result on stdout can be piped
+    sys.stderr.write('\rverified {} of {} blocks ({:.0f}%)'.format(done, total, 100.0 * done / max(total, 1)))
+    sys.stderr.flush()
+
+
+def verify(args):
+    start = time()
+    try:
+        chain = read_chain(args.file)
+    except (IOError, ValueError, codec.DecodeError) as error:
+        print('Reading {} failed: {}'.format(args.file, error))
+        return 2
+    result = chain_verifier.verify_chain(chain, args.processes, not args.no_signatures, args.chunk_size,
+                                         None if args.quiet else print_progress)
+    if not args.quiet:
+        sys.stderr.write('\n')
+    if args.json:
+        output = result.to_dict()
+        output['seconds'] = time() - start
+        print(json.dumps(output))
+    elif result.valid:
+        print('{}: all {} blocks are valid ({:.2f}s)'.format(args.file, result.blocks, time() - start))
+    else:
+        print('{}: block {} is invalid - {}'.format(args.file, result.failed_index, result.reason))
+    return 0 if result.valid else 1
+
+
+def open_blocks(path):
+    """ Return (the blocks of a blockchain file or a stream as an iterator, the opened file). JSON files are parsed while the blocks are
+    read, the binary encoding can only be decoded as a whole """
+    f = open(path, mode='rb')
+    if f.read(len(codec.MAGIC)) == codec.MAGIC:
+        f.close()
+        return (iter(read_chain(path)), None)
+    f.close()
+    f = open(path, mode='r')
+    return (chain_stream.iter_records(f), f)
+
+
+def export(args):
+    start = time()
+    output = sys.stdout if args.output == '-' else open(args.output, mode='w')
+    f = None
+    try:
+        if args.node != None:
+            blocks = chain_stream.iter_node_blocks(args.node, args.start, args.batch_size)
+        else:
+            (blocks, f) = open_blocks(args.file)
+            blocks = (block for block in blocks if block['index'] >= args.start)
+        count = chain_stream.export_chain(blocks, output)
+    # The errors of the requests module are IOErrors as well
+    except (IOError, ValueError, codec.DecodeError) as error:
+        sys.stderr.write('Export failed: {}\n'.format(error))
+        return 2
+    finally:
+        if f != None:
+            f.close()
+        if output != sys.stdout:
+            output.close()
+    sys.stderr.write('exported {} blocks ({:.2f}s)\n'.format(count, time() - start))
+    return 0
+
+
+def import_chain(args):
+    start = time()
+    importer = chain_stream.ChainImporter(args.node_id, args.processes, not args.no_signatures, args.batch_size)
+    checkpoint = importer.read_checkpoint()
+    if checkpoint != None and not args.quiet:
+        sys.stderr.write('resuming after block {}\n'.format(checkpoint['committed']))
+    f = None
+    try:
+        if args.file == '-':
+            blocks = chain_stream.iter_records(sys.stdin)
+        else:
+            (blocks, f) = open_blocks(args.file)
+        progress = None if args.quiet else lambda done: sys.stderr.write('\rimported {} blocks'.format(done))
+        count = importer.run(blocks, args.force, progress)
+    except chain_stream.ChainImportError as error:
+        sys.stderr.write('\nImport failed: {}\n'.format(error))
+        return 1
+    except (IOError, ValueError, KeyError, codec.DecodeError) as error:
+        sys.stderr.write('\nReading {} failed: {}\n'.format(args.file, error))
+        return 2
+    finally:
+        if f != None:
+            f.close()
+    if not args.quiet:
+        sys.stderr.write('\n')
+    print('imported {} blocks into {} ({:.2f}s)'.format(count, importer.filename, time() - start))
+    return 0
+
+
+def create_parser():
+    parser = ArgumentParser(description='Offline tools for blockchain files.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    verify_parser = commands.add_parser('verify', help='Verify every block of a blockchain file: links, proofs of work and signatures.')
+    verify_parser.add_argument('file', help='The blockchain file, like blockchain-5000.txt or blockchain-5000.bin')
+    verify_parser.add_argument('--processes', type=int, default=None, help='Worker processes, one per CPU by default')
+    verify_parser.add_argument('--chunk-size', type=int, default=chain_verifier.CHUNK_SIZE, help='Blocks per task')
+    verify_parser.add_argument('--no-signatures', action='store_true', help='Only check the links and the proofs of work')
+    verify_parser.add_argument('--quiet', action='store_true', help='Don\'t report the progress')
+    verify_parser.add_argument('--json', action='store_true', help='Print the result as JSON')
+    verify_parser.set_defaults(run=verify)
+    export_parser = commands.add_parser('export', help='Write the blocks of a blockchain file or a running node as JSON lines.')
+    export_source = export_parser.add_mutually_exclusive_group(required=True)
+    export_source.add_argument('file', nargs='?', help='The blockchain file, like blockchain-5000.txt or blockchain-5000.bin')
+    export_source.add_argument('--node', help='Export from a running node instead, like localhost:5000 - it has to keep every block')
+    export_parser.add_argument('--output', '-o', default='-', help='The output file, stdout by default')
+    export_parser.add_argument('--start', type=int, default=0, help='The index of the first exported block')
+    export_parser.add_argument('--batch-size', type=int, default=chain_stream.EXPORT_BATCH_SIZE, help='Blocks per request to the node')
+    export_parser.set_defaults(run=export)
+    import_parser = commands.add_parser('import', help='Verify a stream of blocks and write it as the chain of a node (which must not run).')
+    import_parser.add_argument('file', help='JSON lines (like an export) or a JSON array (like a blockchain file), - reads stdin')
+    import_parser.add_argument('node_id', type=int, help='The port of the node, the chain is written to blockchain-<port>.txt')
+    import_parser.add_argument('--force', action='store_true', help='Replace the chain the node has')
+    import_parser.add_argument('--processes', type=int, default=None, help='Verification processes, one per CPU by default')
+    import_parser.add_argument('--batch-size', type=int, default=chain_stream.IMPORT_BATCH_SIZE, help='Blocks verified and committed together')
+    import_parser.add_argument('--no-signatures', action='store_true', help='Only check the links and the proofs of work')
+    import_parser.add_argument('--quiet', action='store_true', help='Don\'t report the progress')
+    import_parser.set_defaults(run=import_chain)
+    return parser
+
+
+if __name__ == '__main__':
+    args = create_parser().parse_args()
+    sys.exit(args.run(args))
@@ -0,0 +1,213 @@
+import os
+import multiprocessing
+from time import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from block import Block, BlockHeader
+from median_time import TimeWindow, MEDIAN_TIME_SPAN, check_timestamp
+from transaction import Transaction
+from utilityfolder.hash_util import hash_block
+from utilityfolder.verification import Verification
+from wallet import Wallet
+
+# The blocks one task of the process pool verifies. Smaller chunks spread the work more evenly and stop sooner after a failure,
+# bigger chunks send fewer tasks
+CHUNK_SIZE = 200
+# Starting a process pool takes longer than verifying a short chain, so shorter chains are always verified in this process
+PARALLEL_VERIFY_MIN = 500
+
+
+class VerificationResult:
+    """ The result of verify_chain.
+
+    Attributes:
+        :valid: True if every block is valid.
+        :blocks: The number of blocks of the chain.
+        :failed_index: The index (position in the chain) of the first invalid block, None if the chain is valid.
+        :reason: Why that block is invalid.
+        :nonces: The last nonce of every sender after the verified blocks, None if they weren't checked (or a pruned block hides them).
+    """
+
+    def __init__(self, blocks, failed_index=None, reason=None, nonces=None):
+        self.valid = failed_index == None
+        self.blocks = blocks
+        self.failed_index = failed_index
+        self.reason = reason
+        self.nonces = nonces
+
+    def to_dict(self):
+        return {'valid': self.valid, 'blocks': self.blocks, 'failed_index': self.failed_index, 'reason': self.reason}
+
+
+def dict_to_block(dict_block):
+    """ Convert a block dictionary of the chain file or the /chain route to a Block, or a BlockHeader if it was pruned """
+    if 'transactions' not in dict_block:
+        return BlockHeader(dict_block['index'], dict_block['previous_hash'], dict_block['proof'], dict_block['timestamp'], dict_block['hash'])
+    return Block(dict_block['index'], dict_block['previous_hash'], [Transaction(
+        tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce')) for tx in dict_block['transactions']],
+        dict_block['proof'], dict_block['timestamp'])
+
+
+def verify_block(block, previous_block, check_signatures=True, times=None, now=None):
+    """ Verify one block against the blocks before it. Returns None if it's valid, otherwise the reason why it isn't.
+    This only needs the block before it and the timestamps of the last blocks, which is why the chain can be verified in independent ranges.
+
+    Arguments:
+        :block: The Block (or BlockHeader) to verify.
+        :previous_block: The block before it in the chain.
+        :check_signatures: False skips the signature checks of the transactions.
+        :times: The TimeWindow of the chain up to previous_block, None skips the timestamp check.
+        :now: The current time, for the check that the timestamp isn't too far in the future.
+    """
+    if block.previous_hash != hash_block(previous_block):
+        return 'The previous hash does not match the block before.'
+    if times != None:
+        reason = check_timestamp(block.timestamp, times.median(), now if now != None else time())
+        if reason != None:
+            return reason
+    # The transactions of a pruned block are gone - its proof and signatures were checked before it was pruned
+    if isinstance(block, BlockHeader):
+        return None
+    # The reward is added after the proof of work, so it's not part of the proof - and it's the only transaction without a signature
+    if not Verification.valid_proof(block.transactions[:-1], block.previous_hash, block.proof):
+        return 'The proof of work is invalid.'
+    if check_signatures:
+        for tx in block.transactions[:-1]:
+            try:
+                valid = Wallet.verify_transaction(tx)
+            except (ValueError, TypeError):
+                # A sender which isn't a key at all
+                valid = False
+            if not valid:
+                return 'The signature of a transaction from {} is invalid.'.format(tx.sender[:16])
+    return None
+
+
+# Every worker process gets the shared position of the first failure found so far, so it can skip work after it
+_worker_failure = None
+
+
+def _init_verify_worker(failure):
+    global _worker_failure
+    _worker_failure = failure
+
+
+def _verify_range(start, dict_blocks, check_signatures, history, now):
+    # dict_blocks starts with the block before start, every other block is checked against the one before it. history is the list of the
+    # timestamps of the blocks before start (up to MEDIAN_TIME_SPAN), the window for the first block.
+    # Returns (index of the first invalid block, reason), or (None, None) if the range is valid (or was skipped)
+    previous = dict_to_block(dict_blocks[0])
+    times = TimeWindow(tuple(history), tuple(sorted(history)))
+    for (offset, dict_block) in enumerate(dict_blocks[1:]):
+        index = start + offset
+        # A failure before this block was found - the result of this range doesn't matter anymore
+        if _worker_failure != None and _worker_failure.value < index:
+            return (None, None)
+        try:
+            block = dict_to_block(dict_block)
+            reason = verify_block(block, previous, check_signatures, times, now)
+        except (KeyError, TypeError, ValueError) as error:
+            reason = 'The block is malformed ({}).'.format(error)
+        if reason != None:
+            return (index, reason)
+        previous = block
+        times = times.push(block.timestamp)
+    return (None, None)
+
+
+def _history(dict_chain, start):
+    # The timestamps of the blocks before start which the median time of block start is taken from. A malformed block among them is
+    # reported by the range it belongs to, its timestamp is left out here
+    timestamps = [dict_block.get('timestamp') for dict_block in dict_chain[max(start - MEDIAN_TIME_SPAN, 0):start]]
+    return [timestamp for timestamp in timestamps if isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool)]
+
+
+def _verify_nonces(dict_chain, start, nonces):
+    # Unlike everything else the nonces of a block depend on every block before it, so they are checked in one pass along the chain -
+    # there is no crypto in it, so it's quick. nonces holds the last nonce of every sender before block start and is moved along.
+    # Returns (index of the first block with invalid nonces, reason, nonces) - (None, None, nonces) if they are valid. The nonces are None
+    # after a pruned block
+    for index in range(start, len(dict_chain)):
+        try:
+            block = dict_to_block(dict_chain[index])
+        except (KeyError, TypeError, ValueError):
+            # The range which contains the block reports it as malformed
+            return (None, None, None)
+        # The transactions of a pruned block are gone, so the nonces of the blocks after it aren't known either
+        if isinstance(block, BlockHeader):
+            return (None, None, None)
+        if not Verification.verify_nonces(block, lambda sender: nonces.get(sender, 0)):
+            return (index, 'The nonces of the transactions are invalid.', None)
+        for tx in block.transactions[:-1]:
+            if tx.nonce != None:
+                nonces[tx.sender] = tx.nonce
+    return (None, None, nonces)
+
+
+def verify_chain(dict_chain, processes=None, check_signatures=True, chunk_size=CHUNK_SIZE, progress=None, verified=1, nonces=None,
+                 check_nonces=True):
+    """ Verify a whole chain (a list of block dictionaries) on a process pool and return a VerificationResult.
+    The chain is split into ranges of chunk_size blocks, every range is verified by one task. Once a block fails, ranges after it
+    are cancelled or stop early - ranges before it still finish, so the result is always the first invalid block of the chain.
+
+    Arguments:
+        :dict_chain: The chain as a list of block dictionaries, like in the chain file.
+        :processes: The number of processes, None uses one per CPU. 1 (or a chain shorter than PARALLEL_VERIFY_MIN) verifies in this process.
+        :check_signatures: False only checks the links and the proofs of work.
+        :chunk_size: The number of blocks of one range.
+        :progress: Called with (verified blocks, total blocks) every time a range is done.
+        :verified: The number of blocks at the start of dict_chain which are verified already - they are only there for the links and the
+            median time of the blocks after them. 1 is the genesis block.
+        :nonces: The last nonce of every sender in the verified blocks, None for none (a chain which starts with the genesis block).
+        :check_nonces: False skips the nonces - when the nonces of the verified blocks aren't known.
+    """
+    total = len(dict_chain)
+    # The nonces are checked in this process first, the pool doesn't have to verify the blocks after an invalid nonce
+    (nonce_index, nonce_reason, last_nonces) = (None, None, None)
+    if check_nonces:
+        (nonce_index, nonce_reason, last_nonces) = _verify_nonces(dict_chain, verified, dict(nonces) if nonces != None else {})
+    if total <= verified:
+        return VerificationResult(total, nonces=last_nonces)
+    processes = processes or os.cpu_count()
+    # Every range gets the block before it, and the timestamps of the blocks before it for the median time
+    ranges = [(start, min(start + chunk_size, total)) for start in range(verified, total, chunk_size)]
+    # Every range checks the timestamps against the same clock
+    now = time()
+    # The ranges after a block with invalid nonces are never verified. A range which finds a failure up to that block wins, so the
+    # result is still the first invalid block (and a block which is invalid for another reason too reports that reason)
+    if nonce_index != None:
+        ranges = [(start, end) for (start, end) in ranges if start <= nonce_index]
+    if processes <= 1 or total - verified < PARALLEL_VERIFY_MIN:
+        done = 0
+        for (start, end) in ranges:
+            (index, reason) = _verify_range(start, dict_chain[start - 1:end], check_signatures, _history(dict_chain, start), now)
+            if index != None and (nonce_index == None or index <= nonce_index):
+                return VerificationResult(total, index, reason)
+            done += end - start
+            if progress != None:
+                progress(done, total - verified)
+        return VerificationResult(total, nonce_index, nonce_reason, last_nonces)
+    failure = multiprocessing.Value('q', nonce_index if nonce_index != None else total)
+    first_failure = (nonce_index, nonce_reason)
+    done = 0
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_verify_worker, initargs=(failure,)) as executor:
+        pending = dict((executor.submit(_verify_range, start, dict_chain[start - 1:end], check_signatures, _history(dict_chain, start), now),
+                        (start, end)) for (start, end) in ranges)
+        while len(pending) > 0:
+            (finished, not_finished) = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                (start, end) = pending.pop(future)
+                (index, reason) = future.result()
+                if index != None and (first_failure[0] == None or index <= first_failure[0]):
+                    first_failure = (index, reason)
+                    failure.value = index
+                    # Ranges which didn't start yet and only contain blocks after the failure are never started
+                    for (other, (other_start, other_end)) in list(pending.items()):
+                        if other_start > index and other.cancel():
+                            del pending[other]
+                done += end - start
+                if progress != None:
+                    progress(done, total - verified)
+    if first_failure[0] != None:
+        return VerificationResult(total, first_failure[0], first_failure[1])
+    return VerificationResult(total, nonces=last_nonces)
@@ -0,0 +1,297 @@
+import struct
+import zlib
+
+# Compact binary encoding for blocks, transactions and the other payloads nodes exchange - an alternative to JSON.
+# Every value starts with a type byte, strings and lists are prefixed with their length, hex strings (keys, signatures and hashes) are stored
+# as raw bytes (half the size) and the known field names are stored as a single byte. A chain is split into segments which can be
+# compressed one by one, so a reader doesn't have to decompress more than one segment at a time.
+
+# Peers ask for this encoding with the Accept header and send it with the Content-Type header
+MEDIA_TYPE = 'application/x-blockchain'
+ENCODINGS = ('json', 'binary')
+# The first bytes of an encoded chain
+MAGIC = b'PBC1'
+# The number of blocks in one segment of an encoded chain
+SEGMENT_SIZE = 100
+
+NONE = 0
+FALSE = 1
+TRUE = 2
+INT = 3
+FLOAT = 4
+STR = 5
+HEX = 6
+TAGGED_HEX = 7
+LIST = 8
+DICT = 9
+
+# Field names which are stored as one byte (their position in this tuple + 1). New names can only be appended, never reordered,
+# and there can't be more than 127 of them
+FIELDS = ('index', 'previous_hash', 'timestamp', 'transactions', 'proof', 'sender', 'recipient', 'amount', 'signature',
+          'hash', 'tx_ids', 'reward', 'block', 'compact_block', 'missing', 'message', 'nonce')
+FIELD_IDS = dict((name, i + 1) for (i, name) in enumerate(FIELDS))
+
+_HEX_DIGITS = frozenset('0123456789abcdef')
+_DOUBLE = struct.Struct('>d')
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def _is_hex(value):
+    # Only lowercase hex with an even length turns back into exactly the same string
+    return len(value) > 0 and len(value) % 2 == 0 and _HEX_DIGITS.issuperset(value)
+
+
+def _write_varint(out, number):
+    while number > 0x7f:
+        out.append((number & 0x7f) | 0x80)
+        number >>= 7
+    out.append(number)
+
+
+def _write_bytes(out, data):
+    _write_varint(out, len(data))
+    out += data
+
+
+def _write_value(out, value):
+    # Strings, dictionaries and lists are by far the most common values, so they are checked first
+    kind = type(value)
+    if kind is str:
+        if _is_hex(value):
+            out.append(HEX)
+            data = bytes.fromhex(value)
+        else:
+            (prefix, separator, rest) = value.partition(':')
+            if separator and _is_hex(rest):
+                # Tagged keys like 'ed25519:<hex>'
+                out.append(TAGGED_HEX)
+                _write_bytes(out, prefix.encode('utf8'))
+                data = bytes.fromhex(rest)
+            else:
+                out.append(STR)
+                data = value.encode('utf8')
+        _write_bytes(out, data)
+    elif kind is dict:
+        out.append(DICT)
+        _write_varint(out, len(value))
+        for (key, item) in value.items():
+            field_id = FIELD_IDS.get(key, 0)
+            out.append(field_id)
+            if field_id == 0:
+                _write_bytes(out, key.encode('utf8'))
+            _write_value(out, item)
+    elif kind is list or kind is tuple:
+        out.append(LIST)
+        _write_varint(out, len(value))
+        for item in value:
+            _write_value(out, item)
+    # bool has to be checked before int, True and False are ints as well
+    elif value is None:
+        out.append(NONE)
+    elif value is True:
+        out.append(TRUE)
+    elif value is False:
+        out.append(FALSE)
+    elif isinstance(value, int):
+        out.append(INT)
+        # Zigzag encoding, so small negative numbers stay small
+        _write_varint(out, value * 2 if value >= 0 else -value * 2 - 1)
+    elif isinstance(value, float):
+        out.append(FLOAT)
+        out += _DOUBLE.pack(value)
+    elif isinstance(value, str):
+        _write_value(out, str(value))
+    elif isinstance(value, dict):
+        _write_value(out, dict(value))
+    elif isinstance(value, (list, tuple)):
+        _write_value(out, list(value))
+    else:
+        raise TypeError('Can not encode {}'.format(type(value).__name__))
+
+
+def _read_varint(data, position):
+    number = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        number |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return (number, position)
+        shift += 7
+
+
+def _read_value(data, position):
+    """ Decode the value at position and return a tuple (value, position after the value).
+    This is the hot loop of loading a chain, so the common cases (one byte lengths) are read inline instead of calling _read_varint.
+    Reading past the end raises an IndexError, decode turns it into a DecodeError """
+    kind = data[position]
+    position += 1
+    if kind == HEX or kind == STR:
+        length = data[position]
+        if length < 0x80:
+            position += 1
+        else:
+            (length, position) = _read_varint(data, position)
+        end = position + length
+        if end > len(data):
+            raise IndexError
+        if kind == HEX:
+            return (data[position:end].hex(), end)
+        return (data[position:end].decode('utf8'), end)
+    if kind == DICT:
+        (count, position) = _read_varint(data, position)
+        result = {}
+        for i in range(count):
+            field_id = data[position]
+            position += 1
+            if field_id == 0:
+                (length, position) = _read_varint(data, position)
+                key = data[position:position + length].decode('utf8')
+                position += length
+            elif field_id <= len(FIELDS):
+                key = FIELDS[field_id - 1]
+            else:
+                raise DecodeError('Unknown field {}'.format(field_id))
+            # Most values in a dictionary are hex strings (keys, signatures and hashes), they are read right here
+            if data[position] == HEX and data[position + 1] < 0x80:
+                end = position + 2 + data[position + 1]
+                if end > len(data):
+                    raise IndexError
+                result[key] = data[position + 2:end].hex()
+                position = end
+            else:
+                (result[key], position) = _read_value(data, position)
+        return (result, position)
+    if kind == LIST:
+        (count, position) = _read_varint(data, position)
+        result = []
+        for i in range(count):
+            (item, position) = _read_value(data, position)
+            result.append(item)
+        return (result, position)
+    if kind == INT:
+        (number, position) = _read_varint(data, position)
+        return (number // 2 if number % 2 == 0 else -(number + 1) // 2, position)
+    if kind == FLOAT:
+        if position + 8 > len(data):
+            raise IndexError
+        return (_DOUBLE.unpack_from(data, position)[0], position + 8)
+    if kind == NONE:
+        return (None, position)
+    if kind == TRUE:
+        return (True, position)
+    if kind == FALSE:
+        return (False, position)
+    if kind == TAGGED_HEX:
+        (length, position) = _read_varint(data, position)
+        prefix = data[position:position + length].decode('utf8')
+        position += length
+        (length, position) = _read_varint(data, position)
+        if position + length > len(data):
+            raise IndexError
+        return (prefix + ':' + data[position:position + length].hex(), position + length)
+    raise DecodeError('Unknown type {}'.format(kind))
+
+
+def _read(data, position):
+    """ _read_value with every way broken data can fail turned into a DecodeError """
+    try:
+        return _read_value(data, position)
+    except IndexError:
+        raise DecodeError('Unexpected end of data')
+    except UnicodeDecodeError as error:
+        raise DecodeError(str(error))
+
+
+def encode(value):
+    """ Encode a JSON-like value (dictionaries, lists, strings, numbers, booleans and None) """
+    out = bytearray()
+    _write_value(out, value)
+    return bytes(out)
+
+
+def decode(data):
+    """ Decode a value encoded with encode """
+    (value, position) = _read(data, 0)
+    if position != len(data):
+        raise DecodeError('Unexpected data after the value')
+    return value
+
+
+def _write_segments(out, items, compress):
+    segments = [items[i:i + SEGMENT_SIZE] for i in range(0, len(items), SEGMENT_SIZE)]
+    _write_varint(out, len(segments))
+    for segment in segments:
+        data = encode(segment)
+        if compress:
+            out.append(1)
+            _write_bytes(out, zlib.compress(data))
+        else:
+            out.append(0)
+            _write_bytes(out, data)
+
+
+def _read_segments(data, position):
+    """ Return a tuple (the items of all segments, position after the segments) """
+    items = []
+    try:
+        (count, position) = _read_varint(data, position)
+        for i in range(count):
+            compressed = data[position]
+            (length, position) = _read_varint(data, position + 1)
+            if position + length > len(data):
+                raise IndexError
+            segment = data[position:position + length]
+            position += length
+            if compressed:
+                segment = zlib.decompress(segment)
+            items.extend(decode(segment))
+    except IndexError:
+        raise DecodeError('Unexpected end of data')
+    except zlib.error as error:
+        raise DecodeError(str(error))
+    return (items, position)
+
+
+def encode_chain(dict_chain, compress=True):
+    """ Encode a chain (a list of block dictionaries like in the /chain route) in segments of SEGMENT_SIZE blocks
+
+    Arguments:
+        :dict_chain: The list of block dictionaries.
+        :compress: True compresses every segment with zlib - the same keys appear in many transactions, so this saves a lot.
+    """
+    out = bytearray(MAGIC)
+    _write_segments(out, dict_chain, compress)
+    return bytes(out)
+
+
+def decode_chain(data):
+    """ Decode a chain encoded with encode_chain and return the list of block dictionaries """
+    if data[:len(MAGIC)] != MAGIC:
+        raise DecodeError('Not an encoded chain')
+    (dict_chain, position) = _read_segments(data, len(MAGIC))
+    if position != len(data):
+        raise DecodeError('Unexpected data after the chain')
+    return dict_chain
+
+
+def encode_state(dict_chain, dict_transactions, peer_nodes, compress=True):
+    """ Encode the data of a blockchain file: the chain, the open transactions and the peer nodes """
+    out = bytearray(encode_chain(dict_chain, compress))
+    _write_value(out, dict_transactions)
+    _write_value(out, peer_nodes)
+    return bytes(out)
+
+
+def decode_state(data):
+    """ Decode a blockchain file encoded with encode_state and return a tuple (chain, open transactions, peer nodes) """
+    if data[:len(MAGIC)] != MAGIC:
+        raise DecodeError('Not an encoded blockchain file')
+    (dict_chain, position) = _read_segments(data, len(MAGIC))
+    (dict_transactions, position) = _read(data, position)
+    (peer_nodes, position) = _read(data, position)
+    return (dict_chain, dict_transactions, peer_nodes)
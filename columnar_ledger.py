@@ -0,0 +1,315 @@
+import numpy as np
+
+from block import BlockHeader
+
+# The arrays start with room for this many transactions and double their size when they are full
+INITIAL_CAPACITY = 1024
+# The MINING sender is always interned first, so it has this id
+MINING_ID = 0
+
+
+def _number(value, is_float):
+    # The columns add up in float64, LedgerState adds up the amounts themselves - a balance is only a float there if a float amount
+    # was part of it. Whole numbers of integer amounts go back to int, so every route answers with the same number as /balance
+    return float(value) if is_float else int(round(value))
+
+
+class ColumnarView:
+    """ An immutable view of the columnar ledger at one height - queries run on it without holding any lock.
+
+    Attributes:
+        :addresses: List of addresses, the position of an address is its id. It can be longer than address_count, the ledger only appends to it.
+        :address_count: The number of addresses at this height.
+        :senders: Array of sender ids, one per confirmed transaction.
+        :recipients: Array of recipient ids.
+        :amounts: Array of amounts.
+        :floats: Array which is True for every amount which was a float (and not an int) in the transaction.
+        :heights: Array of the index of the block every transaction is part of.
+        :base: Array of balances (by id) from before the first block in the columns - a pruned node has no transactions for those blocks.
+        :base_floats: Array which is True for every base balance which was a float.
+        :height: The index of the last block in the columns.
+    """
+
+    def __init__(self, addresses, address_count, senders, recipients, amounts, floats, heights, base, base_floats, height):
+        self.addresses = addresses
+        self.address_count = address_count
+        self.senders = senders
+        self.recipients = recipients
+        self.amounts = amounts
+        self.floats = floats
+        self.heights = heights
+        self.base = base
+        self.base_floats = base_floats
+        self.height = height
+        # The view never changes, so the balances are computed once and shared by all queries at this height
+        self.__balances = None
+        self.__float_balances = None
+
+    def balance_array(self):
+        """ Return an array with the balance of every address id - the same balances LedgerState has. Don't change the array """
+        balances = self.__balances
+        if balances is None:
+            size = self.address_count
+            balances = np.bincount(self.recipients, weights=self.amounts, minlength=size)
+            balances -= np.bincount(self.senders, weights=self.amounts, minlength=size)
+            balances[:len(self.base)] += self.base
+            self.__balances = balances
+        return balances
+
+    def float_balance_array(self):
+        """ Return an array which is True for every address id whose balance is a float in LedgerState - a float amount was sent or
+        received by it. Don't change the array """
+        float_balances = self.__float_balances
+        if float_balances is None:
+            size = self.address_count
+            float_balances = (np.bincount(self.recipients, weights=self.floats, minlength=size)
+                              + np.bincount(self.senders, weights=self.floats, minlength=size)) > 0
+            float_balances[:len(self.base_floats)] |= self.base_floats
+            self.__float_balances = float_balances
+        return float_balances
+
+    def balance(self, address_id):
+        """ Return the balance of the address id as the same number (int or float) LedgerState has """
+        return _number(self.balance_array()[address_id], self.float_balance_array()[address_id])
+
+    def balances(self):
+        """ Return a dictionary of the balance of every address. The MINING sender isn't an account, so it's left out """
+        balances = self.balance_array()[MINING_ID + 1:].tolist()
+        float_balances = self.float_balance_array()[MINING_ID + 1:].tolist()
+        return dict(zip(self.addresses[MINING_ID + 1:self.address_count],
+                        [_number(balance, is_float) for (balance, is_float) in zip(balances, float_balances)]))
+
+    def richest(self, count):
+        """ Return a list of (address, balance) tuples of the count addresses with the highest balances, the highest first.
+        The MINING sender isn't an account, so it's left out """
+        balances = self.balance_array().copy()
+        balances[MINING_ID] = -np.inf
+        count = min(count, len(balances) - 1)
+        if count <= 0:
+            return []
+        # argpartition finds the top count without sorting all balances, only those count are sorted
+        top = np.argpartition(-balances, count - 1)[:count]
+        top = top[np.argsort(-balances[top], kind='stable')]
+        return [(self.addresses[i], self.balance(i)) for i in top]
+
+    def volume_per_block(self, start=None, end=None):
+        """ Return a tuple (heights, transaction counts, volumes) of arrays for the blocks from start up to (not including) end.
+        The mining rewards aren't counted.
+
+        Arguments:
+            :start: The index of the first block, None starts at the first block in the columns.
+            :end: The index after the last block, None ends after the last block.
+        """
+        first = int(self.heights[0]) if len(self.heights) > 0 else self.height + 1
+        start = first if start == None else max(start, first)
+        end = self.height + 1 if end == None else min(end, self.height + 1)
+        if end <= start:
+            return (np.arange(0), np.zeros(0, dtype=np.int64), np.zeros(0))
+        # The heights are sorted, so the transactions of the blocks are found with a binary search instead of a pass over all of them
+        (offsets, transactions) = self.__block_offsets(start, end)
+        counts = np.bincount(offsets, minlength=end - start)
+        volumes = np.bincount(offsets, weights=self.amounts[transactions], minlength=end - start)
+        return (np.arange(start, end), counts, volumes)
+
+    def __block_offsets(self, start, end):
+        # The transactions (without the rewards) of the blocks from start up to end: a tuple (the block of every transaction counted from
+        # start, a boolean index of the transactions). The heights are sorted, so the blocks are found with a binary search instead of a pass
+        (first_tx, end_tx) = np.searchsorted(self.heights, [start, end])
+        transactions = np.zeros(len(self.senders), dtype=bool)
+        transactions[first_tx:end_tx] = self.senders[first_tx:end_tx] != MINING_ID
+        return (self.heights[transactions] - start, transactions)
+
+    def stats(self, richest=10, blocks=10):
+        """ Return a dictionary with the totals of the chain, the richest addresses and the volume of the last blocks (like the /stats route)
+
+        Arguments:
+            :richest: The number of richest addresses.
+            :blocks: The number of last blocks whose transaction count and volume are listed.
+        """
+        (heights, counts, volumes) = self.volume_per_block(self.height + 1 - blocks)
+        # A volume is a float if one of its amounts was
+        if len(heights) > 0:
+            (offsets, transactions) = self.__block_offsets(int(heights[0]), int(heights[-1]) + 1)
+            float_volumes = np.bincount(offsets, weights=self.floats[transactions], minlength=len(heights)) > 0
+        else:
+            float_volumes = np.zeros(0, dtype=bool)
+        # Every coin was created by a mining reward, so the supply is what the MINING sender paid out
+        supply = -self.balance(MINING_ID)
+        rewards = self.senders == MINING_ID
+        reward_count = int(np.count_nonzero(rewards))
+        return {
+            'height': self.height,
+            'addresses': self.address_count - 1,
+            'transactions': len(self.senders) - reward_count,
+            'volume': _number(self.amounts.sum() - self.amounts[rewards].sum(), bool(np.any(self.floats[~rewards]))),
+            'supply': supply,
+            'richest': [{'address': address, 'balance': balance} for (address, balance) in self.richest(richest)],
+            'blocks': [{'index': int(index), 'transactions': int(count), 'volume': _number(volume, is_float)}
+                       for (index, count, volume, is_float) in zip(heights, counts, volumes, float_volumes)]
+        }
+
+
+class ColumnarLedger:
+    """ The confirmed transactions of the chain as columns - NumPy arrays of sender ids, recipient ids, amounts and block heights.
+    Addresses are interned: every address gets an id (its position in the address list) the first time it appears.
+    Whole-chain queries (every balance, the richest addresses, the volume per block) are answered with vectorized group-bys on the columns,
+    instead of a loop over all blocks.
+
+    Like LedgerState it's updated block by block. It isn't thread safe, the Blockchain only changes it while holding its lock.
+    Readers use view(), which doesn't change anymore once it's taken.
+    """
+
+    def __init__(self):
+        self.__ids = {}
+        self.__addresses = []
+        self.__senders = np.zeros(INITIAL_CAPACITY, dtype=np.int64)
+        self.__recipients = np.zeros(INITIAL_CAPACITY, dtype=np.int64)
+        self.__amounts = np.zeros(INITIAL_CAPACITY, dtype=np.float64)
+        self.__floats = np.zeros(INITIAL_CAPACITY, dtype=bool)
+        self.__heights = np.zeros(INITIAL_CAPACITY, dtype=np.int64)
+        self.__size = 0
+        # The position of the first transaction of every block in the columns, so the last block can be reverted
+        self.__block_starts = []
+        self.__base = np.zeros(0)
+        self.__base_floats = np.zeros(0, dtype=bool)
+        self.height = -1
+        self.__view = None
+        # The number of transactions the views taken on the current arrays see - a write below it has to copy the arrays first
+        self.__shared_size = 0
+        self.__intern('MINING')
+
+    @classmethod
+    def from_chain(cls, chain, ledger):
+        """ Build the columns of a chain.
+        The blocks a pruned node only has the headers of have no transactions, their part of the balances comes from the ledger.
+
+        Arguments:
+            :chain: The list of blocks.
+            :ledger: The LedgerState of the chain.
+        """
+        columns = cls()
+        full_blocks = [block for block in chain if not isinstance(block, BlockHeader)]
+        if len(full_blocks) < len(chain):
+            # The columns start after the pruned blocks, so the balances up to them are what's left after taking the full blocks away
+            pruned = ledger.copy()
+            for block in reversed(full_blocks):
+                pruned.revert_block(block)
+            for (address, balance) in pruned.balances.items():
+                columns.__intern(address)
+            base = [pruned.get_balance(address) for address in columns.__addresses]
+            columns.__base = np.array(base, dtype=np.float64)
+            columns.__base_floats = np.array([isinstance(balance, float) for balance in base], dtype=bool)
+            columns.height = pruned.height
+        columns.apply_blocks(full_blocks)
+        return columns
+
+    def __intern(self, address):
+        address_id = self.__ids.get(address)
+        if address_id == None:
+            address_id = len(self.__addresses)
+            self.__ids[address] = address_id
+            self.__addresses.append(address)
+        return address_id
+
+    def __grow(self, needed):
+        # New arrays instead of resizing in place - views taken before still point to the old arrays
+        capacity = len(self.__senders)
+        while capacity < needed:
+            capacity *= 2
+        if capacity == len(self.__senders) and self.__size >= self.__shared_size:
+            return
+        self.__shared_size = 0
+        for name in ('senders', 'recipients', 'amounts', 'floats', 'heights'):
+            attribute = '_ColumnarLedger__' + name
+            old = getattr(self, attribute)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:self.__size] = old[:self.__size]
+            setattr(self, attribute, new)
+
+    def apply_block(self, block):
+        """ Append the transactions of the next block in the chain
+
+        Arguments:
+            :block: The block (with Transaction objects) that should be applied.
+        """
+        self.apply_blocks([block])
+
+    def apply_blocks(self, blocks):
+        """ Append the transactions of the next blocks in the chain - all columns are written at once, which makes building the
+        columns of a whole chain fast """
+        if len(blocks) == 0:
+            return
+        transactions = [tx for block in blocks for tx in block.transactions]
+        start = self.__size
+        end = start + len(transactions)
+        self.__grow(end)
+        intern = self.__intern
+        # One slice assignment per column is much faster than setting the elements one by one
+        self.__senders[start:end] = [intern(tx.sender) for tx in transactions]
+        self.__recipients[start:end] = [intern(tx.recipient) for tx in transactions]
+        self.__amounts[start:end] = [tx.amount for tx in transactions]
+        self.__floats[start:end] = [isinstance(tx.amount, float) for tx in transactions]
+        self.__heights[start:end] = np.repeat([block.index for block in blocks], [len(block.transactions) for block in blocks])
+        for block in blocks:
+            self.__block_starts.append(start)
+            start += len(block.transactions)
+        self.__size = end
+        self.height = blocks[-1].index
+        self.__view = None
+
+    def revert_block(self, block):
+        """ Remove the transactions of the last block applied - like LedgerState.revert_block
+
+        Arguments:
+            :block: The block that should be reverted.
+        """
+        # The transactions stay in the arrays until the next block overwrites them (__grow copies the arrays first if a view sees them)
+        self.__size = self.__block_starts.pop()
+        self.height = block.index - 1
+        self.__view = None
+
+    def rebase(self, height, ledger):
+        """ Fold the transactions of the blocks up to height into the base balances and drop them from the columns - a pruned node
+        does this when it prunes those blocks, so the columns only grow with the blocks it keeps in full.
+
+        Arguments:
+            :height: The index of the last pruned block.
+            :ledger: The LedgerState at that block (the committed snapshot).
+        """
+        # The blocks in the columns follow each other, the first one is as many blocks before the last one as there are block starts
+        first = self.height - len(self.__block_starts) + 1
+        dropped = min(height - first + 1, len(self.__block_starts))
+        if dropped <= 0:
+            return
+        cut = self.__block_starts[dropped] if dropped < len(self.__block_starts) else self.__size
+        for address in ledger.balances:
+            self.__intern(address)
+        base = [ledger.get_balance(address) for address in self.__addresses]
+        self.__base = np.array(base, dtype=np.float64)
+        self.__base_floats = np.array([isinstance(balance, float) for balance in base], dtype=bool)
+        # New arrays which only fit the blocks we keep - views taken before still point to the old arrays
+        size = self.__size - cut
+        capacity = INITIAL_CAPACITY
+        while capacity < size:
+            capacity *= 2
+        for name in ('senders', 'recipients', 'amounts', 'floats', 'heights'):
+            attribute = '_ColumnarLedger__' + name
+            old = getattr(self, attribute)
+            new = np.zeros(capacity, dtype=old.dtype)
+            new[:size] = old[cut:self.__size]
+            setattr(self, attribute, new)
+        self.__block_starts = [start - cut for start in self.__block_starts[dropped:]]
+        self.__size = size
+        self.__shared_size = 0
+        self.__view = None
+
+    def view(self):
+        """ Return the ColumnarView of the current height """
+        view = self.__view
+        if view == None:
+            size = self.__size
+            view = ColumnarView(self.__addresses, len(self.__addresses), self.__senders[:size], self.__recipients[:size], self.__amounts[:size],
+                                self.__floats[:size], self.__heights[:size], self.__base, self.__base_floats, self.height)
+            self.__view = view
+            self.__shared_size = max(self.__shared_size, size)
+        return view
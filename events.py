@@ -0,0 +1,169 @@
+import json
+import os
+import threading
+from collections import deque
+from itertools import islice
+
+# The number of events a node keeps, so a client which reconnects can get the events it missed
+EVENT_HISTORY = 1000
+# Seconds between two keep-alive comments on an idle stream - proxies close connections which stay silent for too long
+KEEPALIVE_INTERVAL = 15
+
+# The event types. A client which gets a reset event has missed events (it was away too long, or the node restarted) and has to load
+# the chain, the open transactions and the peers again
+EVENT_BLOCK = 'block'
+EVENT_TRANSACTION = 'transaction'
+EVENT_REORG = 'reorg'
+EVENT_PEERS = 'peers'
+EVENT_RESET = 'reset'
+
+
+class Event:
+    """ One event of the stream. The JSON text is created the first time a client needs it and then shared by every client.
+
+    Attributes:
+        :id: The id of the event, '<epoch>-<sequence number>'. The epoch changes on every start of the node.
+        :sequence: The sequence number of the event, it's one higher than the one of the event before.
+        :type: The event type (block, transaction, reorg, peers or reset).
+        :data: The payload of the event, anything which can be converted to JSON.
+    """
+    __slots__ = ('id', 'sequence', 'type', 'data', '__text')
+
+    def __init__(self, event_id, sequence, event_type, data):
+        self.id = event_id
+        self.sequence = sequence
+        self.type = event_type
+        self.data = data
+        self.__text = None
+
+    def to_sse(self):
+        """ Return the event in the text/event-stream format """
+        if self.__text == None:
+            self.__text = 'id: {}\nevent: {}\ndata: {}\n\n'.format(self.id, self.type, json.dumps(self.data))
+        return self.__text
+
+
+def keepalive():
+    """ Return an SSE comment - clients ignore it, it only keeps the connection open """
+    return ': keepalive\n\n'
+
+
+class EventLog:
+    """ The newest events of a node, in the order they happened. The blockchain publishes the events, the /events route streams them.
+    A client resumes with the id of the last event it got (the Last-Event-ID header of EventSource) and gets every event after it, as
+    long as the event is still in the history.
+
+    Attributes:
+        :capacity: The number of events which are kept.
+        :epoch: Identifies this run of the node, it's part of every event id. Ids of an earlier run can't be resumed.
+    """
+
+    def __init__(self, capacity=EVENT_HISTORY):
+        self.capacity = capacity
+        self.epoch = os.urandom(4).hex()
+        self.__events = deque(maxlen=capacity)
+        self.__sequence = 0
+        self.__changed = threading.Condition()
+        self.__listeners = []
+
+    def publish(self, event_type, data):
+        """ Add an event and wake up every waiting client.
+
+        Arguments:
+            :event_type: The event type.
+            :data: The payload of the event.
+        """
+        with self.__changed:
+            self.__sequence += 1
+            event = Event('{}-{}'.format(self.epoch, self.__sequence), self.__sequence, event_type, data)
+            self.__events.append(event)
+            self.__changed.notify_all()
+            listeners = list(self.__listeners)
+        for listener in listeners:
+            listener()
+        return event
+
+    def subscribe(self, listener):
+        """ Call listener (without arguments) after every new event - the asyncio node wakes up its streams like this """
+        with self.__changed:
+            self.__listeners.append(listener)
+
+    def unsubscribe(self, listener):
+        with self.__changed:
+            if listener in self.__listeners:
+                self.__listeners.remove(listener)
+
+    def last_id(self):
+        """ Return the id of the newest event, or the id a client which starts now resumes from if there is none yet """
+        with self.__changed:
+            return '{}-{}'.format(self.epoch, self.__sequence)
+
+    def reset_event(self, last_id):
+        """ Return the reset event for a client which can't resume after last_id. It has the id of the newest event, so the client
+        resumes from there after loading everything again """
+        return Event(self.last_id(), None, EVENT_RESET, {'last_event_id': last_id})
+
+    def __parse(self, last_id):
+        # Returns the sequence number of an id of this run, or None
+        if last_id == None:
+            return None
+        (epoch, separator, sequence) = last_id.rpartition('-')
+        if epoch != self.epoch or not sequence.isdigit():
+            return None
+        return int(sequence)
+
+    def since(self, last_id):
+        """ Return a tuple (events, complete) with the events after the event last_id.
+        complete is False if the client missed events we don't have anymore (or last_id is from another run of the node) - it then
+        gets a reset event first. A client without last_id starts with the next event.
+
+        Arguments:
+            :last_id: The id of the last event the client got, None if it's a new client.
+        """
+        with self.__changed:
+            return self.__since(last_id)
+
+    def __since(self, last_id):
+        if last_id == None:
+            return ([], True)
+        sequence = self.__parse(last_id)
+        if sequence == None or sequence > self.__sequence:
+            return ([], False)
+        first = self.__sequence - len(self.__events) + 1
+        if sequence + 1 < first:
+            return ([], False)
+        # The sequence numbers have no gaps, so the position of the next event in the history follows from its number
+        return (list(islice(self.__events, sequence + 1 - first, None)), True)
+
+    def wait(self, last_id, timeout=KEEPALIVE_INTERVAL):
+        """ Wait until there are events after last_id (at most timeout seconds) and return them - an empty list if the time ran out.
+        last_id has to be a valid id of this run (see since) """
+        with self.__changed:
+            (events, complete) = self.__since(last_id)
+            if len(events) == 0:
+                self.__changed.wait(timeout)
+                (events, complete) = self.__since(last_id)
+            return events
+
+    def stream(self, last_id, timeout=KEEPALIVE_INTERVAL):
+        """ Generate the text/event-stream of a client, forever. It starts with the events after last_id (or a reset event if they
+        can't be resumed) and then sends every new event as it happens, with a keep-alive comment when the stream is idle.
+
+        Arguments:
+            :last_id: The id of the last event the client got, None if it's a new client.
+            :timeout: Seconds of silence before a keep-alive comment is sent.
+        """
+        (events, complete) = self.since(last_id)
+        if not complete:
+            reset = self.reset_event(last_id)
+            yield reset.to_sse()
+            last_id = reset.id
+        elif last_id == None:
+            last_id = self.last_id()
+        while True:
+            for event in events:
+                yield event.to_sse()
+                last_id = event.id
+            events = self.wait(last_id, timeout)
+            if len(events) == 0:
+                yield keepalive()
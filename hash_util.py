@@ -1,6 +1,8 @@
 import hashlib as hl
 import json
 
+from block import BlockHeader
+
 
 def hash_string_256(string):
     return hl.sha256(string).hexdigest()
@@ -12,6 +14,9 @@ def hash_block(block):
     Arguments:
         :block: The block that should be hashed
     """
+    # A pruned block doesn't have its transactions anymore, it remembers its hash instead
+    if isinstance(block, BlockHeader):
+        return block.block_hash
     # Old method for calculating hash
     # return '-'.join([str(block[key]) for key in block])
     # This uses list comprehension to form the hash based on the data of the block
@@ -34,3 +39,14 @@ def hash_block(block):
     # information of the block - including the hash of the previous block - this protects the system from unwanted interference.
     # sort_keys=True ensures that the keys of the dictionary are sorted in the same order every time before converting it to a 
     # string. So the same dictionary will always lead to the same string
+
+
+def hash_transaction(transaction):
+    """ Hashes a transaction including its signature - this hash identifies the transaction when it's relayed between nodes
+
+    Arguments:
+        :transaction: The Transaction object that should be hashed
+    """
+    hashable_tx = transaction.to_ordered_dict()
+    hashable_tx['signature'] = transaction.signature
+    return hash_string_256(json.dumps(hashable_tx, sort_keys=True).encode())
@@ -0,0 +1,175 @@
+import json
+
+from utilityfolder.hash_util import hash_block
+
+
+class LedgerState:
+    """ The state derived from the confirmed chain - the balance of every address that has sent or received coins.
+
+    Attributes:
+        :balances: Dictionary of confirmed balances keyed by address.
+        :height: The index of the last block applied to the state (-1 means no block has been applied yet).
+        :nonces: Dictionary of the last confirmed nonce keyed by sender.
+    """
+
+    def __init__(self, balances=None, height=-1, nonces=None):
+        self.balances = balances if balances != None else {}
+        self.height = height
+        self.nonces = nonces if nonces != None else {}
+
+    def apply_block(self, block):
+        """ Update the balances with the transactions of the next block in the chain
+
+        Arguments:
+            :block: The block (with Transaction objects) that should be applied.
+        """
+        for tx in block.transactions:
+            # The MINING sender ends up with a negative balance, exactly like the old full scan in get_balance
+            self.balances[tx.sender] = self.balances.get(tx.sender, 0) - tx.amount
+            self.balances[tx.recipient] = self.balances.get(tx.recipient, 0) + tx.amount
+            # The nonces of a block are checked before it's applied (see Verification.verify_nonces) - they go up one by one
+            if tx.nonce != None:
+                self.nonces[tx.sender] = tx.nonce
+        self.height = block.index
+
+    def revert_block(self, block):
+        """ Undo apply_block for the last block applied to the state - a reorganization undoes the blocks of the old branch like this
+
+        Arguments:
+            :block: The block (with Transaction objects) that should be reverted.
+        """
+        # Backwards, so the nonce of a sender ends up before its first transaction of the block
+        for tx in reversed(block.transactions):
+            self.balances[tx.sender] = self.balances.get(tx.sender, 0) + tx.amount
+            self.balances[tx.recipient] = self.balances.get(tx.recipient, 0) - tx.amount
+            # ... so the nonce before a transaction is always one less
+            if tx.nonce != None:
+                self.nonces[tx.sender] = tx.nonce - 1
+        self.height = block.index - 1
+
+    def get_balance(self, participant):
+        return self.balances.get(participant, 0)
+
+    def get_nonce(self, participant):
+        """ Return the last confirmed nonce of the participant, 0 if it hasn't sent a transaction with a nonce yet """
+        return self.nonces.get(participant, 0)
+
+    def copy(self):
+        return LedgerState(dict(self.balances), self.height, dict(self.nonces))
+
+
+class PendingSpends:
+    """ The coins every address sends with the open transactions, and how many of those transactions have a nonce.
+    It's kept next to the open transactions in the ChainState, so the balance and the next nonce of an address are a lookup
+    instead of a scan of the open transactions. Like the ChainState it's never changed - add returns the spends with more transactions.
+
+    Attributes:
+        :spends: Dictionary of (amount, transactions with a nonce) tuples keyed by sender.
+    """
+    __slots__ = ('spends',)
+
+    def __init__(self, spends=None):
+        self.spends = spends if spends != None else {}
+
+    @classmethod
+    def from_transactions(cls, transactions):
+        return cls().add(transactions)
+
+    def add(self, transactions):
+        """ Return the spends after the given transactions were appended to the open transactions """
+        spends = dict(self.spends)
+        for tx in transactions:
+            (amount, nonces) = spends.get(tx.sender, (0, 0))
+            spends[tx.sender] = (amount + tx.amount, nonces + (1 if tx.nonce != None else 0))
+        return PendingSpends(spends)
+
+    def get_amount(self, participant):
+        return self.spends.get(participant, (0, 0))[0]
+
+    def get_nonces(self, participant):
+        return self.spends.get(participant, (0, 0))[1]
+
+
+class SnapshotStore:
+    """ Stores periodic snapshots of the ledger state in snapshot-<node_id>.txt, one JSON snapshot per line.
+
+    Every snapshot is keyed to the hash of the block it was taken at, so a snapshot is only used if that block is still part of the chain.
+    A pruned node also has a committed snapshot: the state at the last pruned block. It's never dropped, because the blocks before it are gone.
+    """
+
+    def __init__(self, node_id, keep=3):
+        self.node_id = node_id
+        # Only the newest snapshots are kept - older ones are never needed once a newer one matches the chain
+        self.keep = keep
+        self.__snapshots = self.load()
+        self.__committed = None
+        for snapshot in self.__snapshots:
+            if snapshot.get('committed'):
+                self.__committed = snapshot
+        self.__snapshots = [snapshot for snapshot in self.__snapshots if not snapshot.get('committed')]
+
+    def load(self):
+        try:
+            with open('snapshot-{}.txt'.format(self.node_id), mode='r') as f:
+                return [json.loads(line) for line in f.readlines() if line.strip()]
+        except (IOError, ValueError):
+            return []
+
+    def save(self):
+        try:
+            with open('snapshot-{}.txt'.format(self.node_id), mode='w') as f:
+                for snapshot in ([self.__committed] if self.__committed != None else []) + self.__snapshots:
+                    f.write(json.dumps(snapshot))
+                    f.write('\n')
+        except IOError:
+            print('Saving snapshot failed!')
+
+    def add(self, ledger, block_hash):
+        """ Store a snapshot of the given ledger state
+
+        Arguments:
+            :ledger: The LedgerState to snapshot.
+            :block_hash: The hash of the block at ledger.height.
+        """
+        snapshot = {
+            'height': ledger.height,
+            'block_hash': block_hash,
+            'balances': ledger.balances,
+            'nonces': ledger.nonces
+        }
+        # A snapshot at the same (or a higher) height belongs to a chain we have replaced, so drop it
+        self.__snapshots = [s for s in self.__snapshots if s['height'] < ledger.height]
+        self.__snapshots.append(json.loads(json.dumps(snapshot)))
+        self.__snapshots = self.__snapshots[-self.keep:]
+        self.save()
+
+    def commit(self, ledger, block_hash):
+        """ Store the committed snapshot of a pruned node - the state at the last block whose transactions were dropped
+
+        Arguments:
+            :ledger: The LedgerState at the last pruned block.
+            :block_hash: The hash of the block at ledger.height.
+        """
+        self.__committed = json.loads(json.dumps({
+            'height': ledger.height,
+            'block_hash': block_hash,
+            'balances': ledger.balances,
+            'nonces': ledger.nonces,
+            'committed': True
+        }))
+        self.save()
+
+    def latest_matching(self, chain):
+        """ Return a LedgerState from the newest snapshot whose block is still part of the given chain, or None
+
+        Arguments:
+            :chain: The list of Block objects the snapshot has to match.
+        """
+        # The newest snapshot wins, a pruned node can't replay blocks from an older snapshot than the committed one
+        snapshots = ([self.__committed] if self.__committed != None else []) + self.__snapshots
+        for snapshot in sorted(snapshots, key=lambda snapshot: snapshot['height'], reverse=True):
+            height = snapshot['height']
+            if height < len(chain) and hash_block(chain[height]) == snapshot['block_hash']:
+                # Snapshots written before there were nonces don't have them - no transaction had one then
+                return LedgerState(dict(snapshot['balances']), height, dict(snapshot.get('nonces', {})))
+        return None
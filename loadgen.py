@@ -0,0 +1,282 @@
+# Load generator - sends requests to a running node at a fixed arrival rate and reports throughput, errors and latency per route
+# python3 loadgen.py --url http://localhost:5000 --rate 50 --duration 20
+# python3 loadgen.py --url http://localhost:5000 --rate 50 --mix transaction=5,balance=3,chain=1,mine=1 --record load.jsonl
+# python3 loadgen.py --url http://localhost:5000 --replay load.jsonl
+#
+# The load is open loop: requests are sent at their scheduled time, whether or not the earlier ones have been answered. A slow node
+# therefore can't slow down the load, and the latency is measured from the scheduled time, so waiting for a free sender thread counts too.
+#
+# A request log (--replay and --record) has one JSON object per line:
+#     {"at": 0.25, "method": "POST", "path": "/transaction", "body": {"recipient": "...", "amount": 1}}
+# "at" is the number of seconds after the start of the run, if it's missing the request is sent at --rate. A /broadcast-transaction
+# request without a signature is signed by a wallet of the load generator before the run starts.
+
+import json
+import random
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from time import time, sleep
+
+import requests
+
+from wallet import Wallet, SIGNATURE_SCHEMES, SCHEME_RSA
+
+ROUTES = {
+    'transaction': ('POST', '/transaction'),
+    'broadcast-transaction': ('POST', '/broadcast-transaction'),
+    'mine': ('POST', '/mine'),
+    'balance': ('GET', '/balance'),
+    'chain': ('GET', '/chain')
+}
+DEFAULT_MIX = 'transaction=4,broadcast-transaction=2,balance=2,chain=1,mine=1'
+# Coins the node sends to every wallet of the load generator, so the wallets can pay for /broadcast-transaction requests
+FUNDING_AMOUNT = 5
+
+
+def parse_mix(mix):
+    """ Parse a mix like 'transaction=4,mine=1' into a list of (route, weight) tuples """
+    weights = []
+    for part in mix.split(','):
+        (name, weight) = part.split('=')
+        if name not in ROUTES:
+            raise ValueError('Unknown route in mix: {} (known routes: {})'.format(name, ', '.join(ROUTES)))
+        weights.append((name, float(weight)))
+    return weights
+
+
+def create_wallets(count, scheme=SCHEME_RSA):
+    wallets = []
+    for i in range(count):
+        wallet = Wallet(None, scheme)
+        wallet.create_keys()
+        wallets.append(wallet)
+    return wallets
+
+
+def synthesize(mix, rate, duration, wallets, poisson=True):
+    """ Return the requests of a synthetic load as a list of dictionaries (the format of a request log)
+
+    Arguments:
+        :mix: A list of (route, weight) tuples.
+        :rate: The average number of requests per second.
+        :duration: The length of the run in seconds.
+        :wallets: The wallets which send the /broadcast-transaction requests and receive the /transaction coins.
+        :poisson: True for random (exponential) gaps between requests, False for equal gaps.
+    """
+    names = [name for (name, weight) in mix]
+    weights = [weight for (name, weight) in mix]
+    entries = []
+    at = 0
+    count = 0
+    while True:
+        at += random.expovariate(rate) if poisson else 1 / rate
+        if at >= duration:
+            break
+        count += 1
+        name = random.choice(names) if sum(weights) == 0 else random.choices(names, weights)[0]
+        (method, path) = ROUTES[name]
+        entry = {'at': at, 'method': method, 'path': path}
+        # Signatures are deterministic, so the same transfer twice would be a duplicate. A unique tiny amount makes every transfer unique
+        amount = round(0.0001 * count, 4)
+        if name == 'transaction':
+            entry['body'] = {'recipient': random.choice(wallets).public_key, 'amount': amount}
+        elif name == 'broadcast-transaction':
+            (sender, recipient) = random.sample(wallets, 2) if len(wallets) > 1 else (wallets[0], wallets[0])
+            entry['body'] = {'sender': sender.public_key, 'recipient': recipient.public_key, 'amount': amount}
+        entries.append(entry)
+    return entries
+
+
+def load_log(path):
+    with open(path, mode='r') as f:
+        return [json.loads(line) for line in f if line.strip() != '']
+
+
+def save_log(path, entries):
+    with open(path, mode='w') as f:
+        for entry in entries:
+            f.write(json.dumps(entry))
+            f.write('\n')
+
+
+def sign_entries(entries, wallets):
+    """ Sign every /broadcast-transaction request without a signature, before the run, so signing doesn't slow down the load.
+    The sender has to be one of our wallets - if it isn't, the request is sent from a random wallet of ours instead.
+    The wallets are new, so the transfers of every wallet get the nonces 1, 2, 3... in the order they are sent. Requests which
+    overtake each other on the way are rejected by the node, like the transactions of any client that sends out of order """
+    by_key = dict((wallet.public_key, wallet) for wallet in wallets)
+    nonces = {}
+    # The same order as run() sends them in
+    schedule = sorted(enumerate(entries), key=lambda item: (item[1]['at'] if 'at' in item[1] else item[0], item[0]))
+    for (i, entry) in schedule:
+        body = entry.get('body')
+        if entry['path'] != '/broadcast-transaction' or body == None or 'signature' in body:
+            continue
+        wallet = by_key.get(body.get('sender'))
+        if wallet == None:
+            wallet = random.choice(wallets)
+            body['sender'] = wallet.public_key
+        nonces[wallet.public_key] = nonces.get(wallet.public_key, 0) + 1
+        body['nonce'] = nonces[wallet.public_key]
+        body['signature'] = wallet.sign_transaction(body['sender'], body['recipient'], body['amount'], body['nonce'])
+
+
+def fund_wallets(url, wallets, amount=FUNDING_AMOUNT):
+    """ Let the node send coins to our wallets and mine them into a block. The node mines until it has enough coins itself """
+    needed = amount * len(wallets)
+    for i in range(1000):
+        funds = requests.get(url + '/balance').json().get('funds', 0)
+        if funds >= needed:
+            break
+        requests.post(url + '/mine')
+    for wallet in wallets:
+        response = requests.post(url + '/transaction', json={'recipient': wallet.public_key, 'amount': amount})
+        if response.status_code != 201:
+            print('Funding a wallet failed: {}'.format(response.json().get('message')))
+    requests.post(url + '/mine')
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+class Recorder:
+    """ Collects the result of every request. Can be called from several threads """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.latencies = {}
+        self.statuses = {}
+        self.errors = {}
+
+    def add(self, route, latency, status):
+        """ Record one request. status is the HTTP status code or None if the request itself failed """
+        with self.__lock:
+            self.latencies.setdefault(route, []).append(latency)
+            self.statuses.setdefault(route, {})
+            self.statuses[route][status] = self.statuses[route].get(status, 0) + 1
+            if status == None or status >= 400:
+                self.errors[route] = self.errors.get(route, 0) + 1
+
+    def report(self, duration):
+        """ Return the statistics of every route as a dictionary """
+        result = {}
+        for (route, latencies) in sorted(self.latencies.items()):
+            result[route] = {
+                'requests': len(latencies),
+                'throughput': len(latencies) / duration,
+                'error_rate': self.errors.get(route, 0) / len(latencies),
+                'statuses': dict((str(status), count) for (status, count) in self.statuses[route].items()),
+                'latency_p50': percentile(latencies, 0.5),
+                'latency_p90': percentile(latencies, 0.9),
+                'latency_p99': percentile(latencies, 0.99),
+                'latency_max': max(latencies)
+            }
+        return result
+
+
+def run(url, entries, rate, concurrency=64):
+    """ Send the requests at their scheduled times and return the report
+
+    Arguments:
+        :url: The URL of the node, like http://localhost:5000.
+        :entries: The requests (the format of a request log).
+        :rate: Requests per second for the entries without an "at" time.
+        :concurrency: The number of threads sending requests - if all are busy, requests wait (and the wait counts as latency).
+    """
+    recorder = Recorder()
+    # Sessions aren't shared between threads - every sender thread gets its own (with its own open connections)
+    local = threading.local()
+
+    def send(entry, scheduled):
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        try:
+            response = local.session.request(entry['method'], url + entry['path'], json=entry.get('body'))
+            status = response.status_code
+        except requests.exceptions.RequestException:
+            status = None
+        recorder.add(entry['path'], time() - scheduled, status)
+
+    schedule = []
+    for (i, entry) in enumerate(entries):
+        schedule.append((entry['at'] if 'at' in entry else i / rate, entry))
+    schedule.sort(key=lambda item: item[0])
+    # How far behind its schedule the generator got - if this is large, the load generator (not the node) was the bottleneck
+    max_behind = 0
+    started = time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for (at, entry) in schedule:
+            scheduled = started + at
+            wait = scheduled - time()
+            if wait > 0:
+                sleep(wait)
+            else:
+                max_behind = max(max_behind, -wait)
+            executor.submit(send, entry, scheduled)
+    duration = time() - started
+    return {
+        'requests': len(schedule),
+        'duration': duration,
+        'throughput': len(schedule) / duration,
+        'max_behind_schedule': max_behind,
+        'routes': recorder.report(duration)
+    }
+
+
+def format_number(value):
+    return '-' if value == None else '{:.4f}'.format(value)
+
+
+def print_report(report):
+    print('{} requests in {:.2f}s ({:.1f} per second), at most {:.3f}s behind schedule'.format(
+        report['requests'], report['duration'], report['throughput'], report['max_behind_schedule']))
+    print('{:<24} {:>8} {:>9} {:>7} {:>9} {:>9} {:>9} {:>9}'.format(
+        'route', 'requests', 'per sec', 'errors', 'p50', 'p90', 'p99', 'max'))
+    for (route, stats) in report['routes'].items():
+        print('{:<24} {:>8} {:>9.1f} {:>6.1f}% {:>9} {:>9} {:>9} {:>9}'.format(
+            route, stats['requests'], stats['throughput'], 100 * stats['error_rate'], format_number(stats['latency_p50']),
+            format_number(stats['latency_p90']), format_number(stats['latency_p99']), format_number(stats['latency_max'])))
+        print('{:<24} status codes: {}'.format('', ', '.join(
+            '{} x{}'.format(status, count) for (status, count) in sorted(stats['statuses'].items()))))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--replay', help='Replay the requests of this JSONL request log')
+    parser.add_argument('--record', help='Save the synthesized requests to this JSONL request log')
+    parser.add_argument('--rate', type=float, default=20, help='Requests per second')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds of synthesized load')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='Weights of the routes in the synthesized load')
+    parser.add_argument('--uniform', action='store_true', help='Equal gaps between requests instead of random (Poisson) arrivals')
+    parser.add_argument('--wallets', type=int, default=4, help='Wallets of the load generator')
+    parser.add_argument('--scheme', choices=SIGNATURE_SCHEMES, default=SCHEME_RSA, help='Signature scheme of these wallets')
+    parser.add_argument('--concurrency', type=int, default=64)
+    parser.add_argument('--no-funding', action='store_true', help="Don't send coins to the wallets of the load generator first")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    url = args.url.rstrip('/')
+    wallets = create_wallets(max(1, args.wallets), args.scheme)
+    if args.replay:
+        entries = load_log(args.replay)
+    else:
+        entries = synthesize(parse_mix(args.mix), args.rate, args.duration, wallets, not args.uniform)
+    # The log is saved unsigned - the wallets only exist for this run, a replay signs with its own wallets
+    if args.record:
+        save_log(args.record, entries)
+    # Sign everything before the run, so the crypto of the load generator doesn't slow down the load
+    sign_entries(entries, wallets)
+    if not args.no_funding and any(entry['path'] == '/broadcast-transaction' for entry in entries):
+        fund_wallets(url, wallets)
+    report = run(url, entries, args.rate, args.concurrency)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
@@ -0,0 +1,64 @@
+from bisect import bisect_left, insort
+
+# A block's timestamp may not be earlier than the median of the timestamps of the last MEDIAN_TIME_SPAN blocks (the median time past).
+# One node with a wrong clock can't move the median, and the median never goes back - so timestamps can be used to measure block times
+MEDIAN_TIME_SPAN = 11
+# ... and it may not be more than MAX_FUTURE_DRIFT seconds ahead of our clock. The clocks of the nodes are never exactly the same
+MAX_FUTURE_DRIFT = 2 * 60 * 60
+
+
+class TimeWindow:
+    """ The timestamps of the last MEDIAN_TIME_SPAN blocks of a chain, in chain order and sorted. A window is never changed - push returns
+    the window of the chain with one more block, which costs the same for every block no matter how long the chain is.
+
+    Attributes:
+        :recent: Tuple of the timestamps, the oldest first.
+        :ordered: Tuple of the same timestamps, sorted.
+    """
+    __slots__ = ('recent', 'ordered')
+
+    def __init__(self, recent=(), ordered=()):
+        self.recent = recent
+        self.ordered = ordered
+
+    @classmethod
+    def from_blocks(cls, blocks):
+        """ Return the window of a chain which ends with the given blocks (only the last MEDIAN_TIME_SPAN are used) """
+        recent = tuple(block.timestamp for block in blocks[-MEDIAN_TIME_SPAN:])
+        return cls(recent, tuple(sorted(recent)))
+
+    def push(self, timestamp):
+        """ Return the window after a block with this timestamp was added """
+        ordered = list(self.ordered)
+        recent = self.recent
+        if len(recent) == MEDIAN_TIME_SPAN:
+            # The oldest timestamp drops out of the window
+            del ordered[bisect_left(ordered, recent[0])]
+            recent = recent[1:]
+        insort(ordered, timestamp)
+        return TimeWindow(recent + (timestamp,), tuple(ordered))
+
+    def median(self):
+        """ Return the median time past - the timestamp the next block may not be earlier than. 0 for an empty window """
+        if len(self.ordered) == 0:
+            return 0
+        return self.ordered[len(self.ordered) // 2]
+
+
+def check_timestamp(timestamp, median, now):
+    """ Return None if a new block may have this timestamp, otherwise the reason why it may not.
+
+    Arguments:
+        :timestamp: The timestamp of the new block.
+        :median: The median time past of the chain before the block (TimeWindow.median).
+        :now: The current time of our clock.
+    """
+    # bool is an int too, but no block has a timestamp of True
+    if isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+        return 'The timestamp is not a number.'
+    # Equal timestamps are allowed - blocks used to get the start time of the node which mined them
+    if timestamp < median:
+        return 'The timestamp is earlier than the median of the last {} blocks.'.format(MEDIAN_TIME_SPAN)
+    if timestamp > now + MAX_FUTURE_DRIFT:
+        return 'The timestamp is too far in the future.'
+    return None
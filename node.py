@@ -1,15 +1,93 @@
 # This will allow a flask application (a server) to be set up which can listen to request and send responses. It will also allow routes / API endpoints
-from flask import Flask, jsonify, request, send_from_directory
+from flask import Flask, Response, jsonify, request, send_from_directory
 # Cors is a mechanism that controls that only clients running on the same server can access this server, this is done so that only web pages (HTML pages) returned by a server can again send requests to it.
 # However we want to have a setup where other nodes can also connect. This is what the flask_cors package does
 from flask_cors import CORS
 
 # Import necessary modules
-from wallet import Wallet
-from blockchain import Blockchain
+import atexit
+import os
+import threading
+from wallet import Wallet, SIGNATURE_SCHEMES, SCHEME_RSA
+from wallets import WalletStore
+from blockchain import Blockchain, StaleTip, block_to_dict
+from persistence import DURABILITY_MODES, DURABILITY_ASYNC, FLUSH_INTERVAL, FLUSH_BATCH_SIZE
+import codec
+import tracing
+from replica import Replica, FOLLOW_INTERVAL
+from admission import AdmissionQueue, Overloaded, QUEUE_CAPACITY, ADMISSION_WORKERS, PEER_RATE, ADMISSION_TIMEOUT
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 app = Flask(__name__)
 CORS(app)  # This open the app up to other clients
+# The number of processes which sign the transfers of large payouts (--signing-processes). None signs in the request thread
+signing_processes = None
+# The Replica which follows the primary node if this node is a read-only replica (--replica-of), None otherwise
+replica = None
+# The AdmissionQueue which verifies and admits incoming transactions in batches (--admission-queue), None adds them in the request thread
+admission = None
+# The WalletStore with the wallets of the accounts this node holds for its clients (the /wallets routes)
+wallets = None
+# Transfers from the wallet of the node run one after the other, so they get one nonce after the other - the next nonce only moves on
+# once a transaction is added, so the lock is held from reading the nonce until the transactions are added
+wallet_lock = threading.Lock()
+# The routes a replica serves - it has no wallet and doesn't mine or accept transactions, so only the read routes are left
+REPLICA_ENDPOINTS = ('get_node_ui', 'get_network_ui', 'get_balance', 'get_balances', 'get_stats', 'get_open_transaction', 'get_chain',
+                     'get_nodes', 'get_health', 'get_lag', 'get_events', 'static')
+# The routes which answer while the chain is still loading - they don't need the chain. Every other route answers 503 until it's loaded
+LOADING_ENDPOINTS = ('get_node_ui', 'get_network_ui', 'get_health', 'get_events', 'get_admission', 'static')
+# Seconds a client waits before it asks a loading node again (the Retry-After header)
+LOADING_RETRY_AFTER = 1
+
+
+def get_durability():
+    """ Read the durability mode of a mutating request from the ?durability= query parameter (sync or async).
+    Returns None if it isn't set, which means the blockchain uses its default durability. """
+    durability = request.args.get('durability')
+    if durability in DURABILITY_MODES:
+        return durability
+    return None
+
+
+def get_payload():
+    """ Read the body of a request from a peer - binary (see codec.py) if the peer sent it with our media type, JSON otherwise.
+    Returns None if the body can't be read, like get_json does """
+    if request.mimetype == codec.MEDIA_TYPE:
+        try:
+            return codec.decode(request.get_data())
+        except codec.DecodeError:
+            return None
+    return request.get_json()
+
+
+def wants_binary():
+    """ True if the client prefers the binary encoding to JSON in its Accept header - browsers never ask for it """
+    accept = request.accept_mimetypes
+    # A wildcard like */* matches our media type as well, so it has to be named explicitly
+    return codec.MEDIA_TYPE in accept.values() and accept.best_match([codec.MEDIA_TYPE, 'application/json']) == codec.MEDIA_TYPE
+
+def overloaded_response(error):
+    """ The answer to a transaction the admission queue didn't take - 429 or 503 with a Retry-After header """
+    response = jsonify({'message': error.message, 'retry_after': error.retry_after})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, error.status
+
+
+@app.before_request
+def reject_writes_on_replica():
+    # Returning a response here skips the route
+    if replica != None and request.endpoint not in REPLICA_ENDPOINTS:
+        response = {'message': 'This node is a read-only replica of {}.'.format(replica.primary)}
+        return jsonify(response), 403
+
+
+@app.before_request
+def wait_for_chain():
+    # The port is open before the chain is loaded (see --load-in-foreground), so clients get an honest 503 instead of the genesis block
+    if not blockchain.loaded.is_set() and request.endpoint not in LOADING_ENDPOINTS:
+        response = jsonify({'message': 'The node is loading its chain, try again later.', 'retry_after': LOADING_RETRY_AFTER})
+        response.headers['Retry-After'] = str(LOADING_RETRY_AFTER)
+        return response, 503
 
 # Set up an end point (API). app.route() does this - we need to pass the path and the type of request
 
@@ -31,11 +109,20 @@ def get_network_ui():
 
 @app.route('/wallet', methods=['POST'])
 def create_keys():
+    # The scheme of the new keys can be chosen with {"scheme": "ed25519"}, otherwise the scheme of the wallet is used
+    values = request.get_json(silent=True) or {}
+    scheme = values.get('scheme', wallet.scheme)
+    if scheme not in SIGNATURE_SCHEMES:
+        response = {
+            'message': 'Unknown signature scheme.'
+        }
+        return jsonify(response), 400
+    wallet.scheme = scheme
     wallet.create_keys()
     # create_keys only initialises the keys. We need to call save_keys to call the keys to a file
     if wallet.save_keys():
-        global blockchain
-        blockchain = Blockchain(wallet.public_key, port)
+        # Switch the blockchain to the new keys. We don't create a new Blockchain object - other requests could be using the current one
+        blockchain.public_key = wallet.public_key
         response = {
             'public_key': wallet.public_key,
             # The user who creates his private key should be able to know it. So we can return it safely
@@ -58,8 +145,10 @@ def load_keys():
     # If the function is successful we output what we want with a successful status code such as 201.
     # If the function is unsuccessful we output a failure message and an unsuccessful status code such as 500.
     if wallet.load_keys():
-        global blockchain
-        blockchain = Blockchain(wallet.public_key, port)
+        # Switch the blockchain to the new keys. We don't create a new Blockchain object - other requests could be using the current one
+        blockchain.public_key = wallet.public_key
+        # Our transfers which were saved before there were nonces can be signed again now that we have the keys
+        resign_transactions()
         # Below is the same response as create_keys
         response = {
             'public_key': wallet.public_key,
@@ -74,9 +163,20 @@ def load_keys():
         return jsonify(response), 500
 
 
+def resign_transactions():
+    """ Sign the open transactions of our wallet which were saved before there were nonces again, with the next nonces of our account,
+    and add them. Returns the number of transactions added """
+    transfers = [{'recipient': tx.recipient, 'amount': tx.amount} for tx in blockchain.take_unsigned_transactions(wallet.public_key)]
+    if len(transfers) == 0:
+        return 0
+    (transactions, results) = add_transfers(transfers)
+    return sum(results)
+
+
 @app.route('/balance', methods=['GET'])
 def get_balance():
-    balance = blockchain.get_balance()
+    # ?address=<public key> returns the balance of any address - a replica has no wallet, so it needs it
+    balance = blockchain.get_balance(request.args.get('address'))
     if balance != None:
         response = {
             'message': 'Fetched balance successfully.',
@@ -91,9 +191,132 @@ def get_balance():
         return jsonify(response), 500
 
 
+# A node can hold many wallets for its clients (a custodial node). Every account is addressed by its public key, its transactions carry
+# the next nonce of the account, so a signed transaction can't be replayed. The single wallet of the routes above stays as it is
+
+
+@app.route('/wallets', methods=['POST'])
+def create_wallet():
+    values = request.get_json(silent=True) or {}
+    scheme = values.get('scheme', wallets.scheme)
+    if scheme not in SIGNATURE_SCHEMES:
+        response = {
+            'message': 'Unknown signature scheme.'
+        }
+        return jsonify(response), 400
+    new_wallet = wallets.create(scheme)
+    if new_wallet == None:
+        response = {
+            'message': 'Saving the keys failed.'
+        }
+        return jsonify(response), 500
+    # The node keeps the private key of a custodial wallet, it's never sent to the client
+    return jsonify(blockchain.get_account(new_wallet.public_key)), 201
+
+
+@app.route('/wallets', methods=['GET'])
+def get_wallets():
+    # Every account is a lookup in the ledger state and the pending spends, the length of the chain doesn't matter
+    response = {
+        'wallets': [blockchain.get_account(address) for address in wallets.addresses()]
+    }
+    return jsonify(response), 200
+
+
+@app.route('/wallets/<address>', methods=['GET'])
+def get_wallet(address):
+    if address not in wallets:
+        response = {
+            'message': 'This node holds no wallet with this address.'
+        }
+        return jsonify(response), 404
+    return jsonify(blockchain.get_account(address)), 200
+
+
+@app.route('/wallets/<address>/transaction', methods=['POST'])
+def add_wallet_transaction(address):
+    if address not in wallets:
+        response = {
+            'message': 'This node holds no wallet with this address.'
+        }
+        return jsonify(response), 404
+    values = request.get_json(silent=True)
+    if not values:
+        response = {
+            'message': 'No data found.'
+        }
+        return jsonify(response), 400
+    if not all(field in values for field in ['recipient', 'amount']):
+        response = {
+            'message': 'Required data is missing.'
+        }
+        return jsonify(response), 400
+    try:
+        # The transfer signs with the next nonce of the account and waits until the transaction is added
+        (transaction, success) = wallets.transfer(address, values['recipient'], values['amount'], blockchain.get_next_nonce,
+                                                  admit_transaction)
+    except Overloaded as error:
+        return overloaded_response(error)
+    if success:
+        response = {
+            'message': 'Successfully added transaction.',
+            'transaction': transaction,
+            'account': blockchain.get_account(address)
+        }
+        return jsonify(response), 201
+    else:
+        response = {
+            'message': 'Creating a transaction failed.'
+        }
+        return jsonify(response), 500
+
+
+def get_count_argument(name, default=None):
+    """ Read a non-negative number from the query string. Returns default if it isn't set and raises a ValueError if it isn't a number """
+    if name not in request.args:
+        return default
+    value = int(request.args[name])
+    if value < 0:
+        raise ValueError(name)
+    return value
+
+
+@app.route('/balances', methods=['GET'])
+def get_balances():
+    # The balance of every address, or with ?top=N only the N richest addresses (the richest first)
+    try:
+        top = get_count_argument('top')
+    except ValueError:
+        response = {'message': 'top has to be a number.'}
+        return jsonify(response), 400
+    # The columnar ledger answers this with one vectorized pass over all confirmed transactions
+    columns = blockchain.get_columns()
+    if top == None:
+        balances = columns.balances()
+    else:
+        balances = [{'address': address, 'balance': balance} for (address, balance) in columns.richest(top)]
+    response = {
+        'height': columns.height,
+        'balances': balances
+    }
+    return jsonify(response), 200
+
+
+@app.route('/stats', methods=['GET'])
+def get_stats():
+    # ?richest=N addresses (10 by default) and the transaction count and volume of the last ?blocks=N blocks (10 by default)
+    try:
+        richest = get_count_argument('richest', 10)
+        blocks = get_count_argument('blocks', 10)
+    except ValueError:
+        response = {'message': 'richest and blocks have to be numbers.'}
+        return jsonify(response), 400
+    return jsonify(blockchain.get_columns().stats(richest, blocks)), 200
+
+
 @app.route('/broadcast-transaction', methods=['POST'])
 def broadcast_transaction():
-    values = request.get_json()
+    values = get_payload()
     if not values:
         response = {'message': 'No data found.'}
         return jsonify(response), 400
@@ -102,17 +325,26 @@ def broadcast_transaction():
     if not all(key in values for key in required):
         response = {'message': 'Some data is missing.'}
         return jsonify(response), 400
+    # Transactions are relayed between nodes (gossip), so we often get one we already know. This check is cheap, so we do it first
+    if blockchain.has_seen_transaction(values['sender'], values['recipient'], values['signature'], values['amount'], values.get('nonce')):
+        response = {'message': 'Transaction already known.'}
+        return jsonify(response), 200
+    if admission != None:
+        # The transaction is only queued, the peer doesn't wait for the verification - 202 means accepted for processing
+        transaction = dict((key, values[key]) for key in required + ['nonce'] if key in values)
+        try:
+            admission.submit([transaction], is_receiving=True, durability=get_durability(), source=request.remote_addr)
+        except Overloaded as error:
+            return overloaded_response(error)
+        response = {'message': 'Transaction queued.', 'transaction': transaction}
+        return jsonify(response), 202
     success = blockchain.add_transaction(
-        values['recipient'], values['sender'], values['signature'], values['amount'], is_receiving=True)
+        values['recipient'], values['sender'], values['signature'], values['amount'], is_receiving=True,
+        durability=get_durability(), nonce=values.get('nonce'))
     if success:
         response = {
             'message': 'Successfully added transaction.',
-            'transaction': {
-                'sender': values['sender'],
-                'recipient': values['recipient'],
-                'amount': values['amount'],
-                'signature': values['signature']
-            },
+            'transaction': dict((key, values[key]) for key in required + ['nonce'] if key in values),
             'funds': blockchain.get_balance()
         }
         return jsonify(response), 201
@@ -123,30 +355,87 @@ def broadcast_transaction():
         return jsonify(response), 500
 
 
+@app.route('/broadcast-transactions/batch', methods=['POST'])
+def broadcast_transaction_batch():
+    values = get_payload()
+    if not values:
+        response = {'message': 'No data found.'}
+        return jsonify(response), 400
+    if 'transactions' not in values or not isinstance(values['transactions'], list):
+        response = {'message': 'Some data is missing.'}
+        return jsonify(response), 400
+    required = ['sender', 'recipient', 'amount', 'signature']
+    # Every item has to be an object - a number breaks the key test, a string would pass it as a substring test
+    if not all(isinstance(tx, dict) and all(key in tx for key in required) for tx in values['transactions']):
+        response = {'message': 'Some data is missing.'}
+        return jsonify(response), 400
+    if admission != None:
+        transactions = [dict((key, tx[key]) for key in required + ['nonce'] if key in tx) for tx in values['transactions']]
+        try:
+            admission.submit(transactions, is_receiving=True, durability=get_durability(), source=request.remote_addr)
+        except Overloaded as error:
+            return overloaded_response(error)
+        response = {'message': 'Queued {} transactions.'.format(len(transactions))}
+        return jsonify(response), 202
+    results = blockchain.add_transactions(
+        values['transactions'], is_receiving=True, durability=get_durability())
+    response = {
+        'message': 'Added {} of {} transactions.'.format(sum(results), len(results)),
+        'results': [{'transaction': tx, 'success': success} for (tx, success) in zip(values['transactions'], results)]
+    }
+    return jsonify(response), 201 if any(results) else 500
+
+
 # We need to be able to broadcast new block to the peer nodes
 @app.route('/broadcast-block', methods=['POST'])
 def broadcast_block():
     # We want to add the block onto the blockchain on the peer node
-    values = request.get_json()
+    values = get_payload()
     if not values:
         response = {'message': 'No data found.'}
         return jsonify(response), 400
-    # Check for an absence of a block
-    if 'block' not in values:
+    # Peers send either a full block or a compact block (the header and the hashes of the transactions)
+    if 'block' in values:
+        block = values['block']
+        # Blocks are relayed between nodes as well, so we skip a block we already know before checking the proof
+        if blockchain.has_seen_block(block):
+            response = {'message': 'Block already known.'}
+            return jsonify(response), 200
+        index = block['index']
+    elif 'compact_block' in values:
+        compact_block = values['compact_block']
+        if blockchain.has_seen_block_hash(compact_block['hash']):
+            response = {'message': 'Block already known.'}
+            return jsonify(response), 200
+        block = None
+        index = compact_block['index']
+    else:
+        # Check for an absence of a block
         response = {'message': 'Some data is missing.'}
         return jsonify(response), 400
-    block = values['block']
-    # Check the index of the incoming block on the peer node is one higher than the index on the last block on the peer node - this would mean it's 
-    # the next block in the chain
-    if block['index'] == blockchain.chain[-1].index + 1:
+    previous_hash = block['previous_hash'] if block != None else compact_block['previous_hash']
+    last_block = blockchain.get_last_blockchain_value()
+    # We can add the block if we know its parent - it either extends our chain or a competing branch, which we switch to once it has more work
+    if blockchain.has_block(previous_hash):
+        if block == None:
+            # Rebuild the block from our open transactions and the transactions the sender sent along
+            block, missing = blockchain.expand_compact_block(compact_block, values.get('transactions', []))
+            if len(missing) > 0:
+                # Ask the sender for the transactions we don't have - it sends the compact block again together with them
+                response = {'message': 'Some transactions are missing.', 'missing': missing}
+                return jsonify(response), 202
+            if block == None:
+                response = {'Message': 'Block seems invalid.'}
+                return jsonify(response), 409
         # Check if adding a block succeeded
-        if blockchain.add_block(block):
+        if blockchain.add_block(block, durability=get_durability()):
             response = {'message': 'Block added'}
             return jsonify(response), 201
         else:
             response = {'Message': 'Block seems invalid.'}
             return jsonify(response), 409  # 409 = conflict error
-    elif block['index'] > blockchain.chain[-1].index:
+    elif index > last_block.index:
+        # We miss the blocks before this one, so we have to fetch them from our peers
         response = {
             'message': 'Blockchain seems to diffe from local blockchain'}
         blockchain.resolve_conflicts = True
@@ -190,19 +479,20 @@ def add_transaction():
     recipient = values['recipient']
     amount = values['amount']
     # sender = wallet.public_key
-    signature = wallet.sign_transaction(wallet.public_key, recipient, amount)
-    # Now we have all the data we need to create a new transaction
-    success = blockchain.add_transaction(
-        recipient, wallet.public_key, signature, amount)
+    with wallet_lock:
+        # Every new transaction carries the next nonce of our account and signs it, so it can't be replayed
+        nonce = blockchain.get_next_nonce(wallet.public_key)
+        signature = wallet.sign_transaction(wallet.public_key, recipient, amount, nonce)
+        transaction = {'sender': wallet.public_key, 'recipient': recipient, 'amount': amount, 'signature': signature, 'nonce': nonce}
+        # Now we have all the data we need to create a new transaction
+        try:
+            success = admit_transaction(transaction)
+        except Overloaded as error:
+            return overloaded_response(error)
     if success:
         response = {
             'message': 'Successfully added transaction.',
-            'transaction': {
-                'sender': wallet.public_key,
-                'recipient': recipient,
-                'amount': amount,
-                'signature': signature
-            },
+            'transaction': transaction,
             'funds': blockchain.get_balance()
         }
         return jsonify(response), 201
@@ -213,6 +503,127 @@ def add_transaction():
         return jsonify(response), 500
 
 
+def admit_transaction(transaction):
+    """ Add a transaction of one of our clients (a dictionary) and return True if it was added. With an admission queue it's admitted
+    together with the others of the same batch, our clients wait for the answer. Raises Overloaded if the queue doesn't take it """
+    if admission != None:
+        (future,) = admission.submit([transaction], durability=get_durability())
+        try:
+            return future.result(timeout=ADMISSION_TIMEOUT)
+        except FutureTimeoutError:
+            raise Overloaded(503, ADMISSION_TIMEOUT, 'The transaction is still waiting to be verified.')
+    return blockchain.add_transaction(transaction['recipient'], transaction['sender'], transaction['signature'], transaction['amount'],
+                                      durability=get_durability(), nonce=transaction.get('nonce'))
+
+
+@app.route('/transactions/batch', methods=['POST'])
+def add_transaction_batch():
+    if wallet.public_key == None:
+        response = {
+            'message': 'No wallet set up.'
+        }
+        return jsonify(response), 400
+    values = request.get_json()
+    if not values:
+        response = {
+            'message': 'No data found.'
+        }
+        return jsonify(response), 400
+    # The batch is a list of transfers which all need a recipient and an amount
+    if 'transactions' not in values or not isinstance(values['transactions'], list):
+        response = {
+            'message': 'Required data is missing.'
+        }
+        return jsonify(response), 400
+    required_fields = ['recipient', 'amount']
+    if not all(isinstance(tx, dict) and all(field in tx for field in required_fields) for tx in values['transactions']):
+        response = {
+            'message': 'Required data is missing.'
+        }
+        return jsonify(response), 400
+    # Sign every transfer with our wallet, then verify, save and broadcast the whole batch at once
+    (transactions, results) = add_transfers(values['transactions'])
+    response = {
+        'message': 'Added {} of {} transactions.'.format(sum(results), len(results)),
+        'results': [{'transaction': tx, 'success': success} for (tx, success) in zip(transactions, results)],
+        'funds': blockchain.get_balance()
+    }
+    return jsonify(response), 201 if any(results) else 500
+
+
+def add_transfers(transfers, processes=None):
+    """ Sign a list of transfers (dictionaries with a recipient and an amount) with our wallet, add them at once and return a tuple
+    (transactions, results) - the transactions (the transfer itself if it wasn't signed) and whether each one was added.
+    The transfers get consecutive nonces. A transfer we can't afford gets none and is rejected - a gap in the nonces would make every
+    transfer behind it invalid too
+
+    Arguments:
+        :transfers: The list of transfers.
+        :processes: The number of processes which sign the transfers, None signs in this thread.
+    """
+    with wallet_lock:
+        funds = blockchain.get_balance()
+        nonce = blockchain.get_next_nonce(wallet.public_key)
+        signed = []
+        for (i, tx) in enumerate(transfers):
+            if funds >= tx['amount']:
+                funds -= tx['amount']
+                signed.append((i, nonce))
+                nonce += 1
+        signatures = wallet.sign_transactions([(transfers[i]['recipient'], transfers[i]['amount'], nonce) for (i, nonce) in signed], processes)
+        transactions = list(transfers)
+        for ((i, nonce), signature) in zip(signed, signatures):
+            transactions[i] = {
+                'sender': wallet.public_key,
+                'recipient': transfers[i]['recipient'],
+                'amount': transfers[i]['amount'],
+                'signature': signature,
+                'nonce': nonce
+            }
+        added = blockchain.add_transactions([transactions[i] for (i, nonce) in signed], durability=get_durability())
+    results = [False] * len(transfers)
+    for ((i, nonce), success) in zip(signed, added):
+        results[i] = success
+    return (transactions, results)
+
+
+# A payout sends coins from our wallet to many recipients at once (thousands of transfers). It works like /transactions/batch,
+# but large payouts are signed on a process pool and the response only lists the rejected transfers instead of every transaction
+@app.route('/payout', methods=['POST'])
+def payout():
+    if wallet.public_key == None:
+        response = {
+            'message': 'No wallet set up.'
+        }
+        return jsonify(response), 400
+    values = request.get_json()
+    if not values:
+        response = {
+            'message': 'No data found.'
+        }
+        return jsonify(response), 400
+    if 'transfers' not in values or not isinstance(values['transfers'], list):
+        response = {
+            'message': 'Required data is missing.'
+        }
+        return jsonify(response), 400
+    required_fields = ['recipient', 'amount']
+    if not all(field in tx for tx in values['transfers'] for field in required_fields):
+        response = {
+            'message': 'Required data is missing.'
+        }
+        return jsonify(response), 400
+    (transactions, results) = add_transfers(values['transfers'], signing_processes)
+    response = {
+        'message': 'Paid out {} of {} transfers.'.format(sum(results), len(results)),
+        'accepted': sum(results),
+        # The positions of the rejected transfers in the request
+        'rejected': [i for (i, success) in enumerate(results) if not success],
+        'funds': blockchain.get_balance()
+    }
+    return jsonify(response), 201 if any(results) else 500
+
+
 # Now we need to make blockchain related routes - we will return get the blockchain
 # This is to mine a block
 @app.route('/mine', methods=['POST'])
@@ -221,7 +632,13 @@ def mine():
     if blockchain.resolve_conflicts == True:
         response = {'message': 'Resolve conflicts first, block not added!'}
         return jsonify(response), 409
-    block = blockchain.mine_block()
+    try:
+        block = blockchain.mine_block(durability=get_durability())
+    except StaleTip as error:
+        # Other nodes were faster - nothing is wrong with this node, the client can mine again on the new last block
+        response = jsonify({'message': error.message, 'retry_after': error.retry_after})
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response, 409
     # Check if block is not equal to None
     if block != None:
         # Need to convert block from objects to dictionary
@@ -247,7 +664,7 @@ def mine():
 
 @app.route('/resolve-conflicts', methods=['POST'])
 def resolve_conflicts():
-    replaced = blockchain.resolve()
+    replaced = blockchain.resolve(durability=get_durability())
     # Check if it is true that we replaced a chain or not due to conflicts
     if replaced:
         response = {'message': 'Chain was replaced!'}
@@ -266,19 +683,48 @@ def get_open_transaction():
 
 @app.route('/chain', methods=['GET'])
 def get_chain():
+    # The blocks can be fetched in ranges with ?start=<index>&end=<index> (end is not included)
+    # A pruned node only has the newest blocks in full, so by default it returns the blocks after the ones it pruned
+    try:
+        start = int(request.args.get('start', blockchain.pruned_height + 1))
+        end = int(request.args['end']) if 'end' in request.args else None
+    except ValueError:
+        response = {'message': 'start and end have to be block indexes.'}
+        return jsonify(response), 400
     # Call blockchain from blockchain class
-    chain_snapshot = blockchain.chain
+    chain_snapshot = blockchain.get_blocks(max(start, 0), end)
+    if chain_snapshot == None:
+        response = {
+            'message': 'The blocks before index {} were pruned.'.format(blockchain.pruned_height + 1),
+            'pruned_height': blockchain.pruned_height
+        }
+        response = jsonify(response)
+        response.headers['X-Pruned-Height'] = str(blockchain.pruned_height)
+        return response, 410  # 410 = the blocks are gone
     # Now return this to the client (whoever sent the HTTP request). We will send this as JSON data
     # jsonify converts data to JSON
-    # But first we need to convert the list of object of chain_snapshot into dictionaries with the following list comprehension
-    # we use .copy() in the list comprehension to avoid unexpected side effects when we manipulate the block- it stops future copies from being manipulated
-    dict_chain = [block.__dict__.copy() for block in chain_snapshot]
-    # We also need to convert the transactions in our block from objects to dictionaries
-    for dict_block in dict_chain:
-        dict_block['transactions'] = [
-            tx.__dict__ for tx in dict_block['transactions']]
-    # IMPORTANT - return in flask takes a tuple: the first element is the data of the response and the second element is the HTTP status code (200 = success)
-    return jsonify(dict_chain), 200
+    # But first we need to convert the list of object of chain_snapshot into dictionaries (the transactions as well)
+    dict_chain = [block_to_dict(block) for block in chain_snapshot]
+    # Peers which ask for the binary encoding get it - it's a lot smaller, so syncing a long chain is faster
+    if wants_binary():
+        response = Response(codec.encode_chain(dict_chain), mimetype=codec.MEDIA_TYPE)
+    else:
+        # IMPORTANT - return in flask takes a tuple: the first element is the data of the response and the second element is the HTTP status code (200 = success)
+        response = jsonify(dict_chain)
+    # Peers see in this header that we are a pruned node (-1 means we have every block)
+    response.headers['X-Pruned-Height'] = str(blockchain.pruned_height)
+    # The index of our last block, so a client which fetched a range knows how many blocks come after it
+    response.headers['X-Chain-Height'] = str(blockchain.get_last_blockchain_value().index)
+    return response, 200
+
+
+@app.route('/lag', methods=['GET'])
+def get_lag():
+    # How far a replica is behind its primary
+    if replica == None:
+        response = {'message': 'This node is not a replica.'}
+        return jsonify(response), 404
+    return jsonify(replica.status()), 200
 
 # This route allows us to add or remove nodes
 
@@ -330,24 +776,108 @@ def remove_node(node_url):
 def get_nodes():
     nodes = blockchain.get_peer_nodes()
     response = {
-        'all_nodes': nodes
+        'all_nodes': nodes,
+        # The health of every peer - unhealthy peers are skipped until the background prober reaches them again
+        'peers': blockchain.get_peer_stats()
     }
     return jsonify(response), 200
 
 
+# A stream of server-sent events: new blocks, new transactions, reorganizations and peer changes, as they happen.
+# EventSource reconnects with the Last-Event-ID header by itself, other clients can pass ?last_event_id=. A client which missed events
+# we don't have anymore gets a reset event and loads /chain, /transactions and /nodes again
+@app.route('/events', methods=['GET'])
+def get_events():
+    last_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    response = Response(blockchain.events.stream(last_id), mimetype='text/event-stream')
+    # The events must reach the client right away - no caching, and no buffering in a proxy in front of the node
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/admission', methods=['GET'])
+def get_admission():
+    # The depth of the transaction queue and how many transactions were admitted, declined and rejected because of overload
+    if admission == None:
+        response = {'message': 'This node has no admission queue.'}
+        return jsonify(response), 404
+    return jsonify(admission.stats()), 200
+
+
+# Peers probe this route to find out if a node they marked as unhealthy is back
+@app.route('/health', methods=['GET'])
+def get_health():
+    # A node which is still loading its chain is up, but only answers the LOADING_ENDPOINTS yet
+    return jsonify({'status': 'ok' if blockchain.loaded.is_set() else 'loading'}), 200
+
+
 if __name__ == '__main__':  # Check we are running it by directly exceuting the file
     # We need to be able to use different ports so the user can run different servers. The following code allows this
     # This is a tool that allows us to parse arguments
     from argparse import ArgumentParser
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', type=int, default=5000)
+    # Default durability of mutating requests and how often the background thread writes pending changes
+    parser.add_argument('--durability', choices=DURABILITY_MODES, default=DURABILITY_ASYNC)
+    parser.add_argument('--flush-interval', type=float, default=FLUSH_INTERVAL)
+    parser.add_argument('--flush-batch-size', type=int, default=FLUSH_BATCH_SIZE)
+    # The signature scheme of new wallet keys - ed25519 keys and signatures are much smaller and faster than rsa
+    parser.add_argument('--scheme', choices=SIGNATURE_SCHEMES, default=SCHEME_RSA)
+    # Processes which sign large payouts, by default one per CPU
+    parser.add_argument('--signing-processes', type=int, default=os.cpu_count())
+    # Keep only the newest N blocks in full (a pruned node). By default every block is kept
+    parser.add_argument('--prune', type=int, default=None, metavar='N')
+    # The format of the blockchain file and of the data we send to peers. binary is smaller and faster, json is readable
+    parser.add_argument('--storage', choices=codec.ENCODINGS, default='json')
+    parser.add_argument('--wire', choices=codec.ENCODINGS, default='json')
+    # Run as a read-only replica which follows the chain of the primary node (host:port) and serves only the read routes
+    parser.add_argument('--replica-of', default=None, metavar='PRIMARY')
+    parser.add_argument('--follow-interval', type=float, default=FOLLOW_INTERVAL)
+    # Write a JSON line with the timing of every phase of mining, adding blocks and transactions and resolving ('-' is stderr)
+    parser.add_argument('--trace', default=None, metavar='FILE')
+    parser.add_argument('--trace-sample', type=float, default=1.0, metavar='RATE')
+    # Incoming transactions wait in a queue of at most N transactions and are admitted in batches by worker threads. 0 turns the queue off
+    parser.add_argument('--admission-queue', type=int, default=QUEUE_CAPACITY, metavar='N')
+    parser.add_argument('--admission-workers', type=int, default=ADMISSION_WORKERS)
+    # Transactions per second every peer may relay to us
+    parser.add_argument('--peer-rate', type=float, default=PEER_RATE)
+    # By default the node opens its port right away and loads the chain in the background - this loads it before the port is opened
+    parser.add_argument('--load-in-foreground', action='store_true')
     args = parser.parse_args()
     port = args.port
+    signing_processes = args.signing_processes
+    blockchain_options = {
+        'durability': args.durability,
+        'flush_interval': args.flush_interval,
+        'flush_batch_size': args.flush_batch_size,
+        'prune_depth': args.prune,
+        'storage_encoding': args.storage,
+        'wire_encoding': args.wire,
+        'tracer': tracing.create_tracer(args.trace, args.trace_sample),
+        'load_in_background': not args.load_in_foreground
+    }
     # We also need to vary the name of the .txt file that we save to, so that we don't overwite relevant data
-    wallet = Wallet(port)
-    blockchain = Blockchain(wallet.public_key, port)
+    wallet = Wallet(port, args.scheme)
+    wallets = WalletStore(port, args.scheme)
+    blockchain = Blockchain(wallet.public_key, port, **blockchain_options)
+    if args.replica_of != None:
+        # A replica never loads or creates keys, the wallet stays empty
+        replica = Replica(blockchain, args.replica_of, args.follow_interval)
+        replica.start()
+    elif args.admission_queue > 0:
+        admission = AdmissionQueue(blockchain, args.admission_queue, args.admission_workers, peer_rate=args.peer_rate)
+        admission.start()
+    # Make sure all pending changes reach the disk when the node shuts down - the queued transactions are admitted first
+
+    def shutdown():
+        if admission != None:
+            admission.stop()
+        blockchain.close()
+    atexit.register(shutdown)
     # run() takes two arguments, the IP on which we want to run and the port on which we want to listen. Arbitrary numbers are placed at first
-    app.run(host='0.0.0.0', port=port)
+    # The Blockchain is thread safe, so requests can be handled by several threads at the same time
+    app.run(host='0.0.0.0', port=port, threaded=True)
 
 # We need to be able to broadcast information (such as new transaction has been completed or new block has been mined) between nodes
 
@@ -0,0 +1,1054 @@
+# An asyncio variant of node.py - it offers the same routes with the same JSON responses, but runs on aiohttp instead of Flask
+# The node mostly waits for I/O (peer broadcasts, fetching chains in resolve, serving HTTP). In node.py every request which waits for a peer
+# blocks a worker thread. Here the waiting happens on the event loop, so one process can serve many clients and peers at the same time.
+# CPU heavy work (PoW, signing and signature checks) runs in an executor so it doesn't block the event loop.
+# The Blockchain class is the same one node.py uses - we only take over the network part (broadcasting and fetching peer chains)
+# python3 node_async.py -p 5000
+
+import asyncio
+import functools
+import os
+import threading
+from time import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from aiohttp import web, ClientSession, ClientTimeout, ClientError
+
+from wallet import Wallet, SIGNATURE_SCHEMES, SCHEME_RSA
+from wallets import WalletStore
+from block import Block
+from transaction import Transaction
+from blockchain import Blockchain, StaleTip, block_to_dict
+from utilityfolder.hash_util import hash_transaction
+from persistence import DURABILITY_MODES, DURABILITY_ASYNC, FLUSH_INTERVAL, FLUSH_BATCH_SIZE
+import codec
+import tracing
+from events import keepalive, KEEPALIVE_INTERVAL
+from admission import AdmissionQueue, Overloaded, QUEUE_CAPACITY, ADMISSION_WORKERS, PEER_RATE, ADMISSION_TIMEOUT
+
+# Seconds we wait for a peer before we give up on it
+PEER_TIMEOUT = 5
+# The paths which answer while the chain is still loading, like the LOADING_ENDPOINTS of node.py. Every other path answers 503 until it's loaded
+LOADING_PATHS = ('/', '/network', '/health', '/events', '/admission')
+# Seconds a client waits before it asks a loading node again (the Retry-After header)
+LOADING_RETRY_AFTER = 1
+
+routes = web.RouteTableDef()
+
+
+def get_durability(request):
+    """ Read the durability mode of a mutating request from the ?durability= query parameter (sync or async) """
+    durability = request.query.get('durability')
+    if durability in DURABILITY_MODES:
+        return durability
+    return None
+
+
+async def read_json(request):
+    """ Return the JSON data of the request or None if there is none - like request.get_json() in Flask.
+    Peers with the binary wire encoding send their data binary (see codec.py), it's decoded the same way """
+    try:
+        if request.content_type == codec.MEDIA_TYPE:
+            return codec.decode(await request.read())
+        return await request.json()
+    except ValueError:
+        return None
+
+
+def wants_binary(request):
+    """ True if the client prefers the binary encoding to JSON in its Accept header - browsers never ask for it """
+    accept = request.headers.get('Accept', '')
+    return codec.MEDIA_TYPE in accept and not accept.startswith('application/json')
+
+
+async def read_response(response):
+    """ Return the data of a peer response - binary if the peer sent our media type, JSON otherwise. Raises a ValueError if it can't be read """
+    if response.content_type == codec.MEDIA_TYPE:
+        content = await response.read()
+        return codec.decode_chain(content) if content[:len(codec.MAGIC)] == codec.MAGIC else codec.decode(content)
+    return await response.json(content_type=None)
+
+
+def overloaded_response(error):
+    """ The answer to a transaction the admission queue didn't take - 429 or 503 with a Retry-After header """
+    return web.json_response({'message': error.message, 'retry_after': error.retry_after}, status=error.status,
+                             headers={'Retry-After': str(error.retry_after)})
+
+
+async def run_blocking(app, function, *args, **kwargs):
+    """ Run a blocking (CPU heavy) function in the executor and wait for its result without blocking the event loop """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(app['executor'], functools.partial(function, *args, **kwargs))
+
+
+async def post_peer(app, node, path, payload, parent=None):
+    """ Send a POST request to a peer node and record whether it succeeded.
+    Returns a tuple (status, data) - status is None if the peer couldn't be reached, data is None if the response wasn't JSON.
+    The request is traced like in Blockchain (a post_peer span), as a child of the parent span if there is one """
+    with app['blockchain'].tracer.span('post_peer', parent=parent, detached=True, node=node, path=path) as span:
+        (status, data) = await send_post(app, node, path, payload)
+        span.set('status', status)
+        return (status, data)
+
+
+async def send_post(app, node, path, payload):
+    # The request itself, post_peer traces it
+    blockchain = app['blockchain']
+    start = time()
+    url = 'http://{}{}'.format(node, path)
+    try:
+        # With the binary wire encoding we send binary, a peer which rejects it (an older node) gets JSON from now on
+        if blockchain.wire_encoding == 'binary' and node not in app['json_peers']:
+            async with app['session'].post(url, data=codec.encode(payload), headers={'Content-Type': codec.MEDIA_TYPE}) as response:
+                if response.status not in (400, 415):
+                    blockchain.record_peer_success(node, time() - start)
+                    try:
+                        data = await read_response(response)
+                    except ValueError:
+                        data = None
+                    return (response.status, data)
+            app['json_peers'].add(node)
+        async with app['session'].post(url, json=payload) as response:
+            blockchain.record_peer_success(node, time() - start)
+            try:
+                data = await read_response(response)
+            except ValueError:
+                data = None
+            return (response.status, data)
+    except (ClientError, asyncio.TimeoutError):
+        blockchain.record_peer_failure(node)
+        return (None, None)
+
+
+async def broadcast(app, path, payload):
+    """ Post the payload to the given path of the gossip peers (a few random peer nodes) at the same time.
+    Returns a list with the status code of every peer, None if a peer couldn't be reached. """
+    with app['blockchain'].tracer.span('broadcast', detached=True, path=path) as span:
+        async def post(node):
+            (status, data) = await post_peer(app, node, path, payload, span)
+            return status
+        nodes = app['blockchain'].gossip_peers()
+        statuses = await asyncio.gather(*[post(node) for node in nodes])
+        record_declines(span, nodes, statuses)
+        return statuses
+
+
+def record_declines(span, nodes, statuses):
+    # A peer which declines what we sent needs resolving - the span records which one, like in Blockchain
+    for (node, status) in zip(nodes, statuses):
+        if status == 400 or status == 500:
+            span.set('declined_by', node)
+            span.set('rejected', 'needs_resolving')
+
+
+async def relay_block(app, block):
+    """ Send the compact form of a new block (header and transaction hashes) to the gossip peers at the same time.
+    A peer which misses some transactions answers 202 with their hashes and gets exactly those in a second request.
+    Returns a list with the final status code of every peer. """
+    compact_block = app['blockchain'].compact_block(block)
+    with app['blockchain'].tracer.span('broadcast', detached=True, index=block.index) as span:
+        async def relay(node):
+            (status, data) = await post_peer(app, node, '/broadcast-block', {'compact_block': compact_block}, span)
+            if status == 202 and data != None and 'missing' in data:
+                missing = set(data['missing'])
+                missing_transactions = [tx.__dict__ for tx in block.transactions[:-1] if hash_transaction(tx) in missing]
+                (status, data) = await post_peer(app, node, '/broadcast-block', {
+                    'compact_block': compact_block, 'transactions': missing_transactions}, span)
+            return status
+        nodes = app['blockchain'].gossip_peers()
+        statuses = await asyncio.gather(*[relay(node) for node in nodes])
+        record_declines(span, nodes, statuses)
+        if any(status == 409 for status in statuses):
+            span.set('resolve_conflicts', True)
+        return statuses
+
+
+def dict_to_block(dict_block):
+    return Block(dict_block['index'], dict_block['previous_hash'], [Transaction(
+        tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce')) for tx in dict_block['transactions']],
+        dict_block['proof'], dict_block['timestamp'])
+
+
+async def fetch_peer_chains(app):
+    """ Fetch the chains of all peer nodes at the same time """
+    session = app['session']
+
+    blockchain = app['blockchain']
+
+    # With the binary wire encoding we ask for it, a peer which doesn't know it answers with JSON
+    headers = {'Accept': codec.MEDIA_TYPE + ', application/json'} if blockchain.wire_encoding == 'binary' else {}
+
+    async def fetch(node, parent):
+        start = time()
+        with blockchain.tracer.span('get_peer', parent=parent, detached=True, node=node, path='/chain') as span:
+            try:
+                async with session.get('http://{}/chain'.format(node), headers=headers) as response:
+                    span.set('status', response.status)
+                    chain = await read_response(response)
+                    blockchain.record_peer_success(node, time() - start)
+                    # Pruned peers tell us how far they pruned - their chain only starts after that block
+                    blockchain.record_peer_pruned_height(node, int(response.headers.get('X-Pruned-Height', -1)))
+                    return chain
+            except (ClientError, asyncio.TimeoutError):
+                blockchain.record_peer_failure(node)
+                span.set('status', None)
+                return None
+            except ValueError:
+                return None
+    with blockchain.tracer.span('fetch_chains', detached=True) as span:
+        # Unhealthy peers are skipped, the background prober of the Blockchain tells us when they are back
+        chains = await asyncio.gather(*[fetch(node, span) for node in blockchain.get_healthy_peer_nodes()])
+        chains = [chain for chain in chains if chain != None]
+        span.set('peer_chains', len(chains))
+        return chains
+
+
+@web.middleware
+async def cors(request, handler):
+    # This opens the app up to other clients, like flask_cors does for node.py
+    if request.method == 'OPTIONS':
+        response = web.Response()
+    else:
+        response = await handler(request)
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, DELETE, OPTIONS'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+    return response
+
+
+@web.middleware
+async def wait_for_chain(request, handler):
+    # The port is open before the chain is loaded (see --load-in-foreground), so clients get an honest 503 instead of the genesis block
+    if not request.app['blockchain'].loaded.is_set() and request.path not in LOADING_PATHS:
+        return web.json_response({'message': 'The node is loading its chain, try again later.', 'retry_after': LOADING_RETRY_AFTER},
+                                 status=503, headers={'Retry-After': str(LOADING_RETRY_AFTER)})
+    return await handler(request)
+
+
+@routes.get('/')
+async def get_node_ui(request):
+    return web.FileResponse('ui/node.html')
+
+
+@routes.get('/network')
+async def get_network_ui(request):
+    return web.FileResponse('ui/network.html')
+
+
+@routes.post('/wallet')
+async def create_keys(request):
+    wallet = request.app['wallet']
+    blockchain = request.app['blockchain']
+    values = await read_json(request) or {}
+    scheme = values.get('scheme', wallet.scheme)
+    if scheme not in SIGNATURE_SCHEMES:
+        response = {
+            'message': 'Unknown signature scheme.'
+        }
+        return web.json_response(response, status=400)
+    wallet.scheme = scheme
+    # Generating RSA keys is slow, so it runs in the executor
+    await run_blocking(request.app, wallet.create_keys)
+    if wallet.save_keys():
+        blockchain.public_key = wallet.public_key
+        response = {
+            'public_key': wallet.public_key,
+            'private_key': wallet.private_key,
+            'funds': blockchain.get_balance()
+        }
+        return web.json_response(response, status=201)
+    else:
+        response = {
+            'message': 'Saving the keys failed.'
+        }
+        return web.json_response(response, status=500)
+
+
+@routes.get('/wallet')
+async def load_keys(request):
+    wallet = request.app['wallet']
+    blockchain = request.app['blockchain']
+    if wallet.load_keys():
+        blockchain.public_key = wallet.public_key
+        # Our transfers which were saved before there were nonces can be signed again now that we have the keys
+        await resign_transactions(request.app, get_durability(request))
+        response = {
+            'public_key': wallet.public_key,
+            'private_key': wallet.private_key,
+            'funds': blockchain.get_balance()
+        }
+        return web.json_response(response, status=201)
+    else:
+        response = {
+            'message': 'Loading the keys failed.'
+        }
+        return web.json_response(response, status=500)
+
+
+async def resign_transactions(app, durability):
+    """ Sign the open transactions of the wallet of the node which were saved before there were nonces again, with the next nonces of
+    its account, add them and broadcast them. Returns the number of transactions added """
+    wallet = app['wallet']
+    unsigned = await run_blocking(app, app['blockchain'].take_unsigned_transactions, wallet.public_key)
+    if len(unsigned) == 0:
+        return 0
+    transfers = [{'recipient': tx.recipient, 'amount': tx.amount} for tx in unsigned]
+    (transactions, results) = await run_blocking(app, add_transfers, app, durability, transfers)
+    accepted = [tx for (tx, success) in zip(transactions, results) if success]
+    if len(accepted) > 0:
+        await broadcast(app, '/broadcast-transactions/batch', {'transactions': accepted})
+    return len(accepted)
+
+
+@routes.get('/balance')
+async def get_balance(request):
+    # ?address=<public key> returns the balance of any address, like the /balance route of node.py
+    balance = request.app['blockchain'].get_balance(request.query.get('address'))
+    if balance != None:
+        response = {
+            'message': 'Fetched balance successfully.',
+            'funds': balance
+        }
+        return web.json_response(response, status=200)
+    else:
+        response = {
+            'messsage': 'Loading balance failed.',
+            'wallet_set_up': request.app['wallet'].public_key != None
+        }
+        return web.json_response(response, status=500)
+
+
+# A node can hold many wallets for its clients (a custodial node), like the /wallets routes of node.py
+
+
+@routes.post('/wallets')
+async def create_wallet(request):
+    wallets = request.app['wallets']
+    values = await read_json(request) or {}
+    scheme = values.get('scheme', wallets.scheme)
+    if scheme not in SIGNATURE_SCHEMES:
+        response = {
+            'message': 'Unknown signature scheme.'
+        }
+        return web.json_response(response, status=400)
+    # Generating the keys is slow and the file is synced, so it runs in the executor
+    new_wallet = await run_blocking(request.app, wallets.create, scheme)
+    if new_wallet == None:
+        response = {
+            'message': 'Saving the keys failed.'
+        }
+        return web.json_response(response, status=500)
+    return web.json_response(request.app['blockchain'].get_account(new_wallet.public_key), status=201)
+
+
+@routes.get('/wallets')
+async def get_wallets(request):
+    blockchain = request.app['blockchain']
+    response = {
+        'wallets': [blockchain.get_account(address) for address in request.app['wallets'].addresses()]
+    }
+    return web.json_response(response, status=200)
+
+
+@routes.get('/wallets/{address}')
+async def get_wallet(request):
+    address = request.match_info['address']
+    if address not in request.app['wallets']:
+        response = {
+            'message': 'This node holds no wallet with this address.'
+        }
+        return web.json_response(response, status=404)
+    return web.json_response(request.app['blockchain'].get_account(address), status=200)
+
+
+def admit_transaction(app, durability, transaction):
+    """ Add a transaction of one of our clients (a dictionary) without broadcasting it and return True if it was added.
+    It waits for the admission queue if there is one, so it has to run in the executor. Raises Overloaded if the queue doesn't take it """
+    if app['admission'] != None:
+        (future,) = app['admission'].submit([transaction], durability=durability)
+        try:
+            return future.result(timeout=ADMISSION_TIMEOUT)
+        except FutureTimeoutError:
+            raise Overloaded(503, ADMISSION_TIMEOUT, 'The transaction is still waiting to be verified.')
+    return app['blockchain'].add_transaction(transaction['recipient'], transaction['sender'], transaction['signature'], transaction['amount'],
+                                             durability=durability, broadcast=False, nonce=transaction.get('nonce'))
+
+
+@routes.post('/wallets/{address}/transaction')
+async def add_wallet_transaction(request):
+    blockchain = request.app['blockchain']
+    address = request.match_info['address']
+    if address not in request.app['wallets']:
+        response = {
+            'message': 'This node holds no wallet with this address.'
+        }
+        return web.json_response(response, status=404)
+    values = await read_json(request)
+    if not values:
+        response = {
+            'message': 'No data found.'
+        }
+        return web.json_response(response, status=400)
+    if not all(field in values for field in ['recipient', 'amount']):
+        response = {
+            'message': 'Required data is missing.'
+        }
+        return web.json_response(response, status=400)
+    # Signing and adding run in the executor - the transfer holds the lock of the wallet until the transaction is added
+    try:
+        (transaction, success) = await run_blocking(request.app, request.app['wallets'].transfer, address, values['recipient'],
+                                                    values['amount'], blockchain.get_next_nonce,
+                                                    functools.partial(admit_transaction, request.app, get_durability(request)))
+    except Overloaded as error:
+        return overloaded_response(error)
+    # The admission workers relay what they admit, otherwise we relay the transaction to the gossip peers ourselves
+    if success and request.app['admission'] == None:
+        statuses = await broadcast(request.app, '/broadcast-transaction', transaction)
+        # Like in Blockchain.add_transaction a peer which declines the transaction makes the request fail (the broadcast span records it)
+        if any(status == 400 or status == 500 for status in statuses):
+            success = False
+    if success:
+        response = {
+            'message': 'Successfully added transaction.',
+            'transaction': transaction,
+            'account': blockchain.get_account(address)
+        }
+        return web.json_response(response, status=201)
+    else:
+        response = {
+            'message': 'Creating a transaction failed.'
+        }
+        return web.json_response(response, status=500)
+
+
+def get_count_argument(request, name, default=None):
+    """ Read a non-negative number from the query string. Returns default if it isn't set and raises a ValueError if it isn't a number """
+    if name not in request.query:
+        return default
+    value = int(request.query[name])
+    if value < 0:
+        raise ValueError(name)
+    return value
+
+
+@routes.get('/balances')
+async def get_balances(request):
+    try:
+        top = get_count_argument(request, 'top')
+    except ValueError:
+        response = {'message': 'top has to be a number.'}
+        return web.json_response(response, status=400)
+    # Building the columnar ledger the first time and the query itself are CPU work, so they run in the executor
+    columns = await run_blocking(request.app, request.app['blockchain'].get_columns)
+    if top == None:
+        balances = await run_blocking(request.app, columns.balances)
+    else:
+        richest = await run_blocking(request.app, columns.richest, top)
+        balances = [{'address': address, 'balance': balance} for (address, balance) in richest]
+    response = {
+        'height': columns.height,
+        'balances': balances
+    }
+    return web.json_response(response, status=200)
+
+
+@routes.get('/stats')
+async def get_stats(request):
+    try:
+        richest = get_count_argument(request, 'richest', 10)
+        blocks = get_count_argument(request, 'blocks', 10)
+    except ValueError:
+        response = {'message': 'richest and blocks have to be numbers.'}
+        return web.json_response(response, status=400)
+    columns = await run_blocking(request.app, request.app['blockchain'].get_columns)
+    return web.json_response(await run_blocking(request.app, columns.stats, richest, blocks), status=200)
+
+
+@routes.post('/broadcast-transaction')
+async def broadcast_transaction(request):
+    blockchain = request.app['blockchain']
+    values = await read_json(request)
+    if not values:
+        response = {'message': 'No data found.'}
+        return web.json_response(response, status=400)
+    required = ['sender', 'recipient', 'amount', 'signature']
+    if not all(key in values for key in required):
+        response = {'message': 'Some data is missing.'}
+        return web.json_response(response, status=400)
+    if blockchain.has_seen_transaction(values['sender'], values['recipient'], values['signature'], values['amount'], values.get('nonce')):
+        response = {'message': 'Transaction already known.'}
+        return web.json_response(response, status=200)
+    if request.app['admission'] != None:
+        # The transaction is only queued, the peer doesn't wait for the verification
+        transaction = dict((key, values[key]) for key in required + ['nonce'] if key in values)
+        try:
+            request.app['admission'].submit([transaction], is_receiving=True, durability=get_durability(request), source=request.remote)
+        except Overloaded as error:
+            return overloaded_response(error)
+        response = {'message': 'Transaction queued.', 'transaction': transaction}
+        return web.json_response(response, status=202)
+    # The signature check is CPU heavy, so it runs in the executor
+    success = await run_blocking(request.app, blockchain.add_transaction,
+                                 values['recipient'], values['sender'], values['signature'], values['amount'],
+                                 is_receiving=True, durability=get_durability(request), broadcast=False, nonce=values.get('nonce'))
+    if success:
+        transaction = dict((key, values[key]) for key in required + ['nonce'] if key in values)
+        # Relay the new transaction to a few of our peers (gossip)
+        await broadcast(request.app, '/broadcast-transaction', transaction)
+        response = {
+            'message': 'Successfully added transaction.',
+            'transaction': transaction,
+            'funds': blockchain.get_balance()
+        }
+        return web.json_response(response, status=201)
+    else:
+        response = {
+            'message': 'Creating a transaction failed.'
+        }
+        return web.json_response(response, status=500)
+
+
+@routes.post('/broadcast-transactions/batch')
+async def broadcast_transaction_batch(request):
+    values = await read_json(request)
+    if not values:
+        response = {'message': 'No data found.'}
+        return web.json_response(response, status=400)
+    if 'transactions' not in values or not isinstance(values['transactions'], list):
+        response = {'message': 'Some data is missing.'}
+        return web.json_response(response, status=400)
+    required = ['sender', 'recipient', 'amount', 'signature']
+    # Every item has to be an object - a number breaks the key test, a string would pass it as a substring test
+    if not all(isinstance(tx, dict) and all(key in tx for key in required) for tx in values['transactions']):
+        response = {'message': 'Some data is missing.'}
+        return web.json_response(response, status=400)
+    if request.app['admission'] != None:
+        transactions = [dict((key, tx[key]) for key in required + ['nonce'] if key in tx) for tx in values['transactions']]
+        try:
+            request.app['admission'].submit(transactions, is_receiving=True, durability=get_durability(request), source=request.remote)
+        except Overloaded as error:
+            return overloaded_response(error)
+        response = {'message': 'Queued {} transactions.'.format(len(transactions))}
+        return web.json_response(response, status=202)
+    results = await run_blocking(request.app, request.app['blockchain'].add_transactions,
+                                 values['transactions'], is_receiving=True, durability=get_durability(request), broadcast=False)
+    accepted = [tx for (tx, success) in zip(values['transactions'], results) if success]
+    if len(accepted) > 0:
+        await broadcast(request.app, '/broadcast-transactions/batch', {'transactions': accepted})
+    response = {
+        'message': 'Added {} of {} transactions.'.format(sum(results), len(results)),
+        'results': [{'transaction': tx, 'success': success} for (tx, success) in zip(values['transactions'], results)]
+    }
+    return web.json_response(response, status=201 if any(results) else 500)
+
+
+@routes.post('/broadcast-block')
+async def broadcast_block(request):
+    blockchain = request.app['blockchain']
+    values = await read_json(request)
+    if not values:
+        response = {'message': 'No data found.'}
+        return web.json_response(response, status=400)
+    # Peers send either a full block or a compact block (the header and the hashes of the transactions)
+    if 'block' in values:
+        block = values['block']
+        if blockchain.has_seen_block(block):
+            response = {'message': 'Block already known.'}
+            return web.json_response(response, status=200)
+        index = block['index']
+    elif 'compact_block' in values:
+        compact_block = values['compact_block']
+        if blockchain.has_seen_block_hash(compact_block['hash']):
+            response = {'message': 'Block already known.'}
+            return web.json_response(response, status=200)
+        block = None
+        index = compact_block['index']
+    else:
+        response = {'message': 'Some data is missing.'}
+        return web.json_response(response, status=400)
+    previous_hash = block['previous_hash'] if block != None else compact_block['previous_hash']
+    last_block = blockchain.get_last_blockchain_value()
+    # A block whose parent we know extends our chain or a competing branch
+    if blockchain.has_block(previous_hash):
+        if block == None:
+            block, missing = blockchain.expand_compact_block(compact_block, values.get('transactions', []))
+            if len(missing) > 0:
+                response = {'message': 'Some transactions are missing.', 'missing': missing}
+                return web.json_response(response, status=202)
+            if block == None:
+                response = {'Message': 'Block seems invalid.'}
+                return web.json_response(response, status=409)
+        if await run_blocking(request.app, blockchain.add_block, block, durability=get_durability(request), broadcast=False):
+            # Relay the new block to a few of our peers (gossip)
+            await relay_block(request.app, dict_to_block(block))
+            response = {'message': 'Block added'}
+            return web.json_response(response, status=201)
+        else:
+            response = {'Message': 'Block seems invalid.'}
+            return web.json_response(response, status=409)
+    elif index > last_block.index:
+        response = {
+            'message': 'Blockchain seems to diffe from local blockchain'}
+        blockchain.resolve_conflicts = True
+        return web.json_response(response, status=200)
+    else:
+        response = {
+            'message': 'Blockchain seems to be shorter, block not added'}
+        return web.json_response(response, status=409)
+
+
+@routes.post('/transaction')
+async def add_transaction(request):
+    wallet = request.app['wallet']
+    blockchain = request.app['blockchain']
+    if wallet.public_key == None:
+        response = {
+            'message': 'No wallet set up.'
+        }
+        return web.json_response(response, status=400)
+    values = await read_json(request)
+    if not values:
+        response = {
+            'message': 'No data found.'
+        }
+        return web.json_response(response, status=400)
+    required_fields = ['recipient', 'amount']
+    if not all(field in values for field in required_fields):
+        response = {
+            'message': 'Required data is missing.'
+        }
+        return web.json_response(response, status=400)
+    # Signing and adding run in the executor - they hold the lock of our wallet until the transaction is added
+    try:
+        (transaction, success) = await run_blocking(request.app, send_from_wallet, request.app, get_durability(request),
+                                                    values['recipient'], values['amount'])
+    except Overloaded as error:
+        return overloaded_response(error)
+    # The admission workers relay what they admit, otherwise we relay the transaction to the gossip peers ourselves
+    if success and request.app['admission'] == None:
+        statuses = await broadcast(request.app, '/broadcast-transaction', transaction)
+        # Like in Blockchain.add_transaction a peer which declines the transaction makes the request fail (the broadcast span records it)
+        if any(status == 400 or status == 500 for status in statuses):
+            success = False
+    if success:
+        response = {
+            'message': 'Successfully added transaction.',
+            'transaction': transaction,
+            'funds': blockchain.get_balance()
+        }
+        return web.json_response(response, status=201)
+    else:
+        response = {
+            'message': 'Creating a transaction failed.'
+        }
+        return web.json_response(response, status=500)
+
+
+@routes.post('/transactions/batch')
+async def add_transaction_batch(request):
+    wallet = request.app['wallet']
+    blockchain = request.app['blockchain']
+    if wallet.public_key == None:
+        response = {
+            'message': 'No wallet set up.'
+        }
+        return web.json_response(response, status=400)
+    values = await read_json(request)
+    if not values:
+        response = {
+            'message': 'No data found.'
+        }
+        return web.json_response(response, status=400)
+    if 'transactions' not in values or not isinstance(values['transactions'], list):
+        response = {
+            'message': 'Required data is missing.'
+        }
+        return web.json_response(response, status=400)
+    required_fields = ['recipient', 'amount']
+    if not all(isinstance(tx, dict) and all(field in tx for field in required_fields) for tx in values['transactions']):
+        response = {
+            'message': 'Required data is missing.'
+        }
+        return web.json_response(response, status=400)
+
+    (transactions, results) = await run_blocking(request.app, add_transfers, request.app, get_durability(request), values['transactions'])
+    accepted = [tx for (tx, success) in zip(transactions, results) if success]
+    if len(accepted) > 0:
+        # A peer which declines the batch is recorded by the broadcast span
+        await broadcast(request.app, '/broadcast-transactions/batch', {'transactions': accepted})
+    response = {
+        'message': 'Added {} of {} transactions.'.format(sum(results), len(results)),
+        'results': [{'transaction': tx, 'success': success} for (tx, success) in zip(transactions, results)],
+        'funds': blockchain.get_balance()
+    }
+    return web.json_response(response, status=201 if any(results) else 500)
+
+
+def send_from_wallet(app, durability, recipient, amount):
+    """ Sign a transfer from the wallet of the node with the next nonce of its account and add it without broadcasting it.
+    Returns a tuple (transaction, success). It holds the lock of the wallet until the transaction is added, so it runs in the executor """
+    wallet = app['wallet']
+    with app['wallet_lock']:
+        nonce = app['blockchain'].get_next_nonce(wallet.public_key)
+        transaction = {
+            'sender': wallet.public_key,
+            'recipient': recipient,
+            'amount': amount,
+            'signature': wallet.sign_transaction(wallet.public_key, recipient, amount, nonce),
+            'nonce': nonce
+        }
+        return (transaction, admit_transaction(app, durability, transaction))
+
+
+def add_transfers(app, durability, transfers, processes=None):
+    """ Sign a list of transfers (dictionaries with a recipient and an amount) with the wallet of the node, add them at once without
+    broadcasting them and return a tuple (transactions, results) - the transactions (the transfer itself if it wasn't signed) and
+    whether each one was added. The transfers get consecutive nonces. A transfer we can't afford gets none and is rejected - a gap in
+    the nonces would make every transfer behind it invalid too. It holds the lock of the wallet, so it runs in the executor
+    """
+    wallet = app['wallet']
+    blockchain = app['blockchain']
+    with app['wallet_lock']:
+        funds = blockchain.get_balance()
+        nonce = blockchain.get_next_nonce(wallet.public_key)
+        signed = []
+        for (i, tx) in enumerate(transfers):
+            if funds >= tx['amount']:
+                funds -= tx['amount']
+                signed.append((i, nonce))
+                nonce += 1
+        signatures = wallet.sign_transactions([(transfers[i]['recipient'], transfers[i]['amount'], nonce) for (i, nonce) in signed], processes)
+        transactions = list(transfers)
+        for ((i, nonce), signature) in zip(signed, signatures):
+            transactions[i] = {
+                'sender': wallet.public_key,
+                'recipient': transfers[i]['recipient'],
+                'amount': transfers[i]['amount'],
+                'signature': signature,
+                'nonce': nonce
+            }
+        added = blockchain.add_transactions([transactions[i] for (i, nonce) in signed], durability=durability, broadcast=False)
+    results = [False] * len(transfers)
+    for ((i, nonce), success) in zip(signed, added):
+        results[i] = success
+    return (transactions, results)
+
+
+@routes.post('/payout')
+async def payout(request):
+    wallet = request.app['wallet']
+    blockchain = request.app['blockchain']
+    if wallet.public_key == None:
+        response = {
+            'message': 'No wallet set up.'
+        }
+        return web.json_response(response, status=400)
+    values = await read_json(request)
+    if not values:
+        response = {
+            'message': 'No data found.'
+        }
+        return web.json_response(response, status=400)
+    if 'transfers' not in values or not isinstance(values['transfers'], list):
+        response = {
+            'message': 'Required data is missing.'
+        }
+        return web.json_response(response, status=400)
+    required_fields = ['recipient', 'amount']
+    if not all(field in tx for tx in values['transfers'] for field in required_fields):
+        response = {
+            'message': 'Required data is missing.'
+        }
+        return web.json_response(response, status=400)
+    (transactions, results) = await run_blocking(request.app, add_transfers, request.app, get_durability(request), values['transfers'],
+                                                 request.app['signing_processes'])
+    accepted = [tx for (tx, success) in zip(transactions, results) if success]
+    if len(accepted) > 0:
+        await broadcast(request.app, '/broadcast-transactions/batch', {'transactions': accepted})
+    response = {
+        'message': 'Paid out {} of {} transfers.'.format(sum(results), len(results)),
+        'accepted': sum(results),
+        'rejected': [i for (i, success) in enumerate(results) if not success],
+        'funds': blockchain.get_balance()
+    }
+    return web.json_response(response, status=201 if any(results) else 500)
+
+
+@routes.post('/mine')
+async def mine(request):
+    blockchain = request.app['blockchain']
+    if blockchain.resolve_conflicts == True:
+        response = {'message': 'Resolve conflicts first, block not added!'}
+        return web.json_response(response, status=409)
+    # PoW is the most CPU heavy part of the node, so it runs in the executor. We broadcast the block ourselves
+    try:
+        block = await run_blocking(request.app, blockchain.mine_block,
+                                   durability=get_durability(request), broadcast=False)
+    except StaleTip as error:
+        # Other nodes were faster - nothing is wrong with this node, the client can mine again on the new last block
+        return web.json_response({'message': error.message, 'retry_after': error.retry_after}, status=409,
+                                 headers={'Retry-After': str(error.retry_after)})
+    if block != None:
+        dict_block = block_to_dict(block)
+        # A peer which declines the block is recorded by the broadcast span
+        statuses = await relay_block(request.app, block)
+        # If status code = 409 we need to resolve conflicts
+        if any(status == 409 for status in statuses):
+            blockchain.resolve_conflicts = True
+        response = {
+            'message': 'Block added successfully.',
+            'block': dict_block,
+            'funds': blockchain.get_balance()
+        }
+        return web.json_response(response, status=201)
+    else:
+        response = {
+            'message': 'Adding a block failed.',
+            'wallet_set_up': request.app['wallet'].public_key != None
+        }
+        return web.json_response(response, status=500)
+
+
+@routes.post('/resolve-conflicts')
+async def resolve_conflicts(request):
+    # Fetch all peer chains at the same time, then verify them and pick the winner in the executor
+    peer_chains = await fetch_peer_chains(request.app)
+    replaced = await run_blocking(request.app, request.app['blockchain'].resolve_from,
+                                  peer_chains, durability=get_durability(request))
+    if replaced:
+        response = {'message': 'Chain was replaced!'}
+    else:
+        response = {'message': 'Local chain kept!'}
+    return web.json_response(response, status=200)
+
+
+@routes.get('/transactions')
+async def get_open_transaction(request):
+    transactions = request.app['blockchain'].get_open_transactions()
+    dict_transactions = [tx.__dict__ for tx in transactions]
+    return web.json_response(dict_transactions, status=200)
+
+
+@routes.get('/chain')
+async def get_chain(request):
+    blockchain = request.app['blockchain']
+    # Ranges work like in node.py: ?start=<index>&end=<index>, a pruned node returns the blocks after the ones it pruned by default
+    try:
+        start = int(request.query.get('start', blockchain.pruned_height + 1))
+        end = int(request.query['end']) if 'end' in request.query else None
+    except ValueError:
+        response = {'message': 'start and end have to be block indexes.'}
+        return web.json_response(response, status=400)
+    headers = {'X-Pruned-Height': str(blockchain.pruned_height), 'X-Chain-Height': str(blockchain.get_last_blockchain_value().index)}
+    chain_snapshot = blockchain.get_blocks(max(start, 0), end)
+    if chain_snapshot == None:
+        response = {
+            'message': 'The blocks before index {} were pruned.'.format(blockchain.pruned_height + 1),
+            'pruned_height': blockchain.pruned_height
+        }
+        return web.json_response(response, status=410, headers=headers)
+    dict_chain = [block_to_dict(block) for block in chain_snapshot]
+    # Peers which ask for the binary encoding get it, browsers get JSON
+    if wants_binary(request):
+        return web.Response(body=codec.encode_chain(dict_chain), content_type=codec.MEDIA_TYPE, status=200, headers=headers)
+    return web.json_response(dict_chain, status=200, headers=headers)
+
+
+@routes.post('/node')
+async def add_node(request):
+    values = await read_json(request)
+    if not values:
+        response = {
+            'message': 'No data attached.'
+        }
+        return web.json_response(response, status=400)
+    if 'node' not in values:
+        response = {
+            'message': 'No data attached.'
+        }
+        return web.json_response(response, status=400)
+    node = values['node']
+    request.app['blockchain'].add_peer_node(node)
+    response = {
+        'message': 'Node added successfully.',
+        'all_nodes': request.app['blockchain'].get_peer_nodes()
+    }
+    return web.json_response(response, status=201)
+
+
+@routes.delete('/node/{node_url}')
+async def remove_node(request):
+    node_url = request.match_info['node_url']
+    if node_url == '' or node_url == None:
+        response = {
+            'message': 'No node found.'
+        }
+        return web.json_response(response, status=400)
+    request.app['blockchain'].remove_peer_node(node_url)
+    response = {
+        'message': 'Node removed successfully',
+        'all_nodes': request.app['blockchain'].get_peer_nodes()
+    }
+    return web.json_response(response, status=200)
+
+
+@routes.get('/nodes')
+async def get_nodes(request):
+    response = {
+        'all_nodes': request.app['blockchain'].get_peer_nodes(),
+        'peers': request.app['blockchain'].get_peer_stats()
+    }
+    return web.json_response(response, status=200)
+
+
+class EventSignal:
+    """ Wakes up the /events streams. A stream waits on the current event - every new event of the blockchain sets it and replaces it
+    with a new one, which wakes up all streams at once. Only used in the event loop.
+
+    Attributes:
+        :event: The asyncio.Event the streams wait on right now.
+    """
+
+    def __init__(self):
+        self.event = asyncio.Event()
+
+    def wake(self):
+        self.event.set()
+        self.event = asyncio.Event()
+
+
+@routes.get('/events')
+async def get_events(request):
+    # The stream of new blocks, transactions, reorganizations and peer changes - see /events in node.py
+    events = request.app['blockchain'].events
+    last_id = request.headers.get('Last-Event-ID', request.query.get('last_event_id'))
+    response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    await response.prepare(request)
+    (pending, complete) = events.since(last_id)
+    if not complete:
+        reset = events.reset_event(last_id)
+        await response.write(reset.to_sse().encode())
+        last_id = reset.id
+    elif last_id == None:
+        last_id = events.last_id()
+    # The stream ends when the client disconnects - the next write raises then
+    while True:
+        for event in pending:
+            await response.write(event.to_sse().encode())
+            last_id = event.id
+        # The signal is taken before we look for new events, so an event published in between still wakes us up
+        signal = request.app['events_signal'].event
+        (pending, complete) = events.since(last_id)
+        if len(pending) > 0:
+            continue
+        try:
+            await asyncio.wait_for(signal.wait(), KEEPALIVE_INTERVAL)
+        except asyncio.TimeoutError:
+            await response.write(keepalive().encode())
+        (pending, complete) = events.since(last_id)
+
+
+@routes.get('/admission')
+async def get_admission(request):
+    if request.app['admission'] == None:
+        response = {'message': 'This node has no admission queue.'}
+        return web.json_response(response, status=404)
+    return web.json_response(request.app['admission'].stats(), status=200)
+
+
+@routes.get('/health')
+async def get_health(request):
+    # A node which is still loading its chain is up, but only answers the LOADING_PATHS yet
+    return web.json_response({'status': 'ok' if request.app['blockchain'].loaded.is_set() else 'loading'}, status=200)
+
+
+async def start_background(app):
+    # One HTTP session is shared by all peer requests, it keeps the connections to the peers open
+    app['session'] = ClientSession(timeout=ClientTimeout(total=PEER_TIMEOUT))
+    # Events are published by the threads which change the blockchain, the signal is woken up in the event loop
+    loop = asyncio.get_running_loop()
+    app['events_listener'] = lambda: loop.call_soon_threadsafe(app['events_signal'].wake)
+    app['blockchain'].events.subscribe(app['events_listener'])
+    if app['admission_options'] != None:
+        # The workers run in threads, the admitted batches are relayed with the shared session in the event loop
+        def relay(admitted):
+            loop.call_soon_threadsafe(lambda: asyncio.ensure_future(
+                broadcast(app, '/broadcast-transactions/batch', {'transactions': admitted})))
+        app['admission'] = AdmissionQueue(app['blockchain'], on_admitted=relay, **app['admission_options'])
+        app['admission'].start()
+
+
+async def stop_background(app):
+    app['blockchain'].events.unsubscribe(app['events_listener'])
+    if app['admission'] != None:
+        # The queued transactions are admitted before the node stops
+        await run_blocking(app, app['admission'].stop)
+    await app['session'].close()
+    app['executor'].shutdown()
+    # Make sure all pending changes reach the disk when the node shuts down
+    app['blockchain'].close()
+
+
+def create_app(wallet, blockchain, workers=None, signing_processes=None, admission_options=None, wallets=None):
+    """ Create the aiohttp application for the given wallet and blockchain
+
+    Arguments:
+        :wallet: The Wallet of the node.
+        :blockchain: The Blockchain of the node - the same class node.py uses.
+        :workers: The number of executor threads for CPU heavy work, None uses the default of ThreadPoolExecutor.
+        :signing_processes: The number of processes which sign large payouts, None signs in an executor thread.
+        :admission_options: Dictionary of AdmissionQueue options (capacity, workers, peer_rate, ...) - incoming transactions are then
+            queued and admitted in batches. None adds them in the request.
+        :wallets: The WalletStore with the wallets the node holds for its clients, None opens the one of the node.
+    """
+    app = web.Application(middlewares=[cors, wait_for_chain])
+    app['wallet'] = wallet
+    # Transfers from the wallet of the node run one after the other, so they get one nonce after the other
+    app['wallet_lock'] = threading.Lock()
+    app['wallets'] = wallets if wallets != None else WalletStore(blockchain.node_id, wallet.scheme)
+    app['signing_processes'] = signing_processes
+    app['blockchain'] = blockchain
+    app['executor'] = ThreadPoolExecutor(max_workers=workers)
+    # Peers which rejected a binary request - they only get JSON from now on
+    app['json_peers'] = set()
+    app['admission_options'] = admission_options
+    # The application can't be changed once it runs, so the signal of the /events streams swaps its event inside itself
+    app['events_signal'] = EventSignal()
+    # The AdmissionQueue is created on startup, its workers relay in the event loop
+    app['admission'] = None
+    app.add_routes(routes)
+    app.on_startup.append(start_background)
+    app.on_cleanup.append(stop_background)
+    return app
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument('-p', '--port', type=int, default=5000)
+    parser.add_argument('--durability', choices=DURABILITY_MODES, default=DURABILITY_ASYNC)
+    parser.add_argument('--flush-interval', type=float, default=FLUSH_INTERVAL)
+    parser.add_argument('--flush-batch-size', type=int, default=FLUSH_BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--scheme', choices=SIGNATURE_SCHEMES, default=SCHEME_RSA)
+    parser.add_argument('--signing-processes', type=int, default=os.cpu_count())
+    parser.add_argument('--prune', type=int, default=None, metavar='N')
+    parser.add_argument('--storage', choices=codec.ENCODINGS, default='json')
+    parser.add_argument('--wire', choices=codec.ENCODINGS, default='json')
+    parser.add_argument('--trace', default=None, metavar='FILE')
+    parser.add_argument('--trace-sample', type=float, default=1.0, metavar='RATE')
+    parser.add_argument('--admission-queue', type=int, default=QUEUE_CAPACITY, metavar='N')
+    parser.add_argument('--admission-workers', type=int, default=ADMISSION_WORKERS)
+    parser.add_argument('--peer-rate', type=float, default=PEER_RATE)
+    parser.add_argument('--load-in-foreground', action='store_true')
+    args = parser.parse_args()
+    port = args.port
+    wallet = Wallet(port, args.scheme)
+    blockchain = Blockchain(wallet.public_key, port, durability=args.durability,
+                            flush_interval=args.flush_interval, flush_batch_size=args.flush_batch_size, prune_depth=args.prune,
+                            storage_encoding=args.storage, wire_encoding=args.wire,
+                            tracer=tracing.create_tracer(args.trace, args.trace_sample), load_in_background=not args.load_in_foreground)
+    admission_options = None
+    if args.admission_queue > 0:
+        admission_options = {'capacity': args.admission_queue, 'workers': args.admission_workers, 'peer_rate': args.peer_rate}
+    web.run_app(create_app(wallet, blockchain, args.workers, args.signing_processes, admission_options), host='0.0.0.0', port=port)
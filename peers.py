@@ -0,0 +1,125 @@
+import threading
+from time import time
+
+# After FAILURE_THRESHOLD failed requests in a row we stop sending requests to a peer (the circuit breaker opens)
+FAILURE_THRESHOLD = 3
+# While the circuit is open we wait before trying the peer again. The wait doubles with every failure, up to MAX_BACKOFF seconds
+BASE_BACKOFF = 1.0
+MAX_BACKOFF = 300.0
+# Weight of the newest measurement in the latency average (exponentially weighted moving average)
+LATENCY_WEIGHT = 0.2
+
+
+class PeerState:
+    """ The health of one peer node.
+
+    Attributes:
+        :node: The URL of the peer node.
+        :last_seen: The time of the last successful request (None if there never was one).
+        :latency: Exponentially weighted moving average of the request time in seconds.
+        :failures: The number of failed requests in a row.
+        :retry_at: The time after which we try the peer again while its circuit is open.
+        :pruned_height: The index of the last block the peer dropped the transactions of, -1 if it keeps all blocks (None if we don't know yet).
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.last_seen = None
+        self.latency = None
+        self.failures = 0
+        self.retry_at = 0
+        self.pruned_height = None
+
+    def is_healthy(self, now):
+        """ A peer is healthy while its circuit is closed. Once the backoff has passed it's tried again (half open) """
+        return self.failures < FAILURE_THRESHOLD or now >= self.retry_at
+
+    def record_success(self, latency, now):
+        self.last_seen = now
+        self.failures = 0
+        self.retry_at = 0
+        if self.latency == None:
+            self.latency = latency
+        else:
+            self.latency = LATENCY_WEIGHT * latency + (1 - LATENCY_WEIGHT) * self.latency
+
+    def record_failure(self, now):
+        self.failures += 1
+        if self.failures >= FAILURE_THRESHOLD:
+            backoff = BASE_BACKOFF * 2 ** (self.failures - FAILURE_THRESHOLD)
+            self.retry_at = now + min(backoff, MAX_BACKOFF)
+
+    def to_dict(self, now):
+        return {
+            'node': self.node,
+            'healthy': self.is_healthy(now),
+            'last_seen': self.last_seen,
+            'latency': self.latency,
+            'failures': self.failures,
+            'retry_in': max(0, self.retry_at - now) if self.failures >= FAILURE_THRESHOLD else 0,
+            'pruned_height': self.pruned_height
+        }
+
+
+class PeerTable:
+    """ The peer nodes of a node together with their health. All methods can be called from several threads. """
+
+    def __init__(self, nodes=()):
+        self.__lock = threading.Lock()
+        self.__peers = dict((node, PeerState(node)) for node in nodes)
+
+    def add(self, node):
+        with self.__lock:
+            if node not in self.__peers:
+                self.__peers[node] = PeerState(node)
+
+    def remove(self, node):
+        with self.__lock:
+            self.__peers.pop(node, None)
+
+    def nodes(self):
+        """ Return a list of all peer nodes - healthy or not """
+        with self.__lock:
+            return list(self.__peers)
+
+    def healthy_nodes(self):
+        """ Return a list of the peer nodes we should send requests to """
+        now = time()
+        with self.__lock:
+            return [peer.node for peer in self.__peers.values() if peer.is_healthy(now)]
+
+    def nodes_to_probe(self):
+        """ Return the peers with an open circuit whose backoff has passed - the background prober tries them again """
+        now = time()
+        with self.__lock:
+            return [peer.node for peer in self.__peers.values()
+                    if peer.failures >= FAILURE_THRESHOLD and now >= peer.retry_at]
+
+    def record_success(self, node, latency):
+        with self.__lock:
+            if node in self.__peers:
+                self.__peers[node].record_success(latency, time())
+
+    def record_failure(self, node):
+        with self.__lock:
+            if node in self.__peers:
+                self.__peers[node].record_failure(time())
+
+    def set_pruned_height(self, node, pruned_height):
+        with self.__lock:
+            if node in self.__peers:
+                self.__peers[node].pruned_height = pruned_height
+
+    def prune(self, max_failures):
+        """ Remove all peers which failed max_failures times in a row and return their URLs """
+        with self.__lock:
+            dead = [node for (node, peer) in self.__peers.items() if peer.failures >= max_failures]
+            for node in dead:
+                del self.__peers[node]
+            return dead
+
+    def stats(self):
+        """ Return the health of every peer as a list of dictionaries """
+        now = time()
+        with self.__lock:
+            return [peer.to_dict(now) for peer in self.__peers.values()]
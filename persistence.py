@@ -0,0 +1,97 @@
+import threading
+
+# Durability modes - they can be chosen per operation
+# DURABILITY_ASYNC only marks the data as dirty, the background thread writes it with the next flush
+DURABILITY_ASYNC = 'async'
+# DURABILITY_SYNC writes the data before the operation returns
+DURABILITY_SYNC = 'sync'
+DURABILITY_MODES = (DURABILITY_ASYNC, DURABILITY_SYNC)
+
+# Default flush settings: write at least every FLUSH_INTERVAL seconds, or as soon as FLUSH_BATCH_SIZE changes are pending
+FLUSH_INTERVAL = 1.0
+FLUSH_BATCH_SIZE = 100
+
+
+class PersistenceScheduler:
+    """ Groups state changes together so that many changes are written to disk with a single write (group commit).
+
+    Changes are marked with mark_dirty, a background thread then flushes them after an interval or once enough changes are pending.
+
+    Attributes:
+        :interval: The maximum number of seconds a change waits before it is written.
+        :batch_size: The number of pending changes which triggers an early flush.
+    """
+
+    def __init__(self, write, interval=FLUSH_INTERVAL, batch_size=FLUSH_BATCH_SIZE):
+        # write is a reference to the function that writes the full state, it returns True if writing succeeded
+        self.__write = write
+        self.interval = interval
+        self.batch_size = batch_size
+        self.__pending = 0
+        self.__condition = threading.Condition()
+        # Only one flush may write at a time, otherwise an older state could overwrite a newer one
+        self.__flush_lock = threading.Lock()
+        self.__running = False
+        self.__thread = None
+
+    def start(self):
+        """ Start the background thread which flushes the pending changes """
+        if self.__running:
+            return
+        self.__running = True
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """ Stop the background thread and write all pending changes - call this on shutdown """
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        if self.__thread != None:
+            self.__thread.join()
+            self.__thread = None
+        self.flush()
+
+    def mark_dirty(self, durability=DURABILITY_ASYNC):
+        """ Mark the state as changed
+
+        Arguments:
+            :durability: DURABILITY_SYNC to write before returning, DURABILITY_ASYNC to leave it to the background thread.
+        """
+        with self.__condition:
+            self.__pending += 1
+            if self.__pending >= self.batch_size:
+                self.__condition.notify()
+        # Without a running background thread nobody else would write the change, so write it now
+        if durability == DURABILITY_SYNC or not self.__running:
+            return self.flush()
+        return True
+
+    def flush(self):
+        """ Write the state if there are pending changes. Returns False if writing failed """
+        with self.__flush_lock:
+            with self.__condition:
+                pending = self.__pending
+                self.__pending = 0
+            if pending == 0:
+                return True
+            if not self.__write():
+                # The changes are still not on disk, so keep them pending and try again with the next flush
+                with self.__condition:
+                    self.__pending += pending
+                return False
+            return True
+
+    def pending(self):
+        """ Return the number of changes which are not written yet """
+        with self.__condition:
+            return self.__pending
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(lambda: not self.__running or self.__pending >= self.batch_size,
+                                          timeout=self.interval)
+                if not self.__running:
+                    return
+            self.flush()
@@ -0,0 +1,148 @@
+import threading
+from time import time
+
+import codec
+from block import Block
+from blockchain import read_peer_response, PEER_TIMEOUT
+from transaction import Transaction
+from utilityfolder.hash_util import hash_block
+
+# Seconds between two polls of the primary node
+FOLLOW_INTERVAL = 1.0
+# The most blocks a replica fetches in one request - a replica which is far behind catches up in several requests
+FOLLOW_BATCH_SIZE = 500
+
+
+def dict_to_block(dict_block):
+    return Block(dict_block['index'], dict_block['previous_hash'], [Transaction(
+        tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce')) for tx in dict_block['transactions']],
+        dict_block['proof'], dict_block['timestamp'])
+
+
+class Replica:
+    """ Follows the chain of a primary node, so a read-only node can serve the read routes without the primary doing the work.
+
+    Every poll fetches only the blocks after our tip (/chain?start=<our tip>). The first block of the answer is our tip itself - if the
+    primary switched to another branch we don't know it, and we go back further (twice as far every time) until we find the block the
+    branches share. The new blocks go through resolve_from, so they are verified and applied incrementally like blocks of any other peer.
+    The open transactions of the primary are mirrored as they are.
+
+    Attributes:
+        :primary: The URL of the primary node.
+        :interval: Seconds between two polls.
+        :primary_height: The index of the last block of the primary at the last poll (None before the first successful poll).
+        :last_sync: The time of the last successful poll (None if there wasn't one yet).
+        :caught_up_at: The last time we had every block of the primary.
+        :error: The error of the last poll, None if it succeeded.
+    """
+
+    def __init__(self, blockchain, primary, interval=FOLLOW_INTERVAL, transport=None):
+        self.blockchain = blockchain
+        self.primary = primary
+        self.interval = interval
+        # None is the requests module, it's imported when the replica starts to follow (see sync)
+        self.transport = transport
+        self.primary_height = None
+        self.last_sync = None
+        self.caught_up_at = None
+        self.error = None
+        self.__stopped = threading.Event()
+        self.__thread = None
+
+    def start(self):
+        """ Start the background thread which polls the primary """
+        if self.__thread != None:
+            return
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+
+    def __run(self):
+        # The blocks of the primary are added to our loaded chain, not to the genesis block we start with
+        self.blockchain.loaded.wait()
+        while True:
+            self.sync()
+            if self.__stopped.wait(self.interval):
+                return
+
+    def __get(self, path):
+        headers = {'Accept': codec.MEDIA_TYPE + ', application/json'} if self.blockchain.wire_encoding == 'binary' else {}
+        import requests
+        transport = self.transport if self.transport != None else requests
+        return transport.get('http://{}{}'.format(self.primary, path), headers=headers, timeout=PEER_TIMEOUT)
+
+    def sync(self):
+        """ Fetch the new blocks and the open transactions of the primary once. Returns True if we have every block of the primary now """
+        import requests
+        try:
+            caught_up = self.__sync_blocks()
+            response = self.__get('/transactions')
+            if response.status_code == 200:
+                self.blockchain.replace_open_transactions([Transaction(
+                    tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce')) for tx in read_peer_response(response)])
+        except requests.exceptions.RequestException as error:
+            self.error = 'The primary can not be reached: {}'.format(error)
+            return False
+        except (ValueError, KeyError, TypeError) as error:
+            self.error = 'The primary sent invalid data: {}'.format(error)
+            return False
+        now = time()
+        self.last_sync = now
+        if caught_up:
+            self.caught_up_at = now
+            self.error = None
+        return caught_up
+
+    def __sync_blocks(self):
+        back = 0
+        while True:
+            tip = self.blockchain.get_last_blockchain_value()
+            start = max(tip.index - back, 0)
+            response = self.__get('/chain?start={}&end={}'.format(start, start + FOLLOW_BATCH_SIZE))
+            if response.status_code == 410:
+                self.error = 'The primary pruned the blocks after index {}, which we need.'.format(start)
+                return False
+            if response.status_code != 200:
+                self.error = 'The primary answered /chain with status {}.'.format(response.status_code)
+                return False
+            self.primary_height = int(response.headers.get('X-Chain-Height', -1))
+            dict_chain = read_peer_response(response)
+            if len(dict_chain) == 0:
+                self.error = 'The primary has no blocks after index {}.'.format(start)
+                return False
+            if self.primary_height < 0:
+                self.primary_height = dict_chain[-1]['index']
+            if not self.blockchain.has_block(hash_block(dict_to_block(dict_chain[0]))):
+                # The primary is on another branch - go back until we reach a block both chains share
+                if start == 0:
+                    self.error = 'The primary has another genesis block.'
+                    return False
+                back = max(1, back * 2)
+                continue
+            self.blockchain.resolve_from([dict_chain])
+            tip = self.blockchain.get_last_blockchain_value()
+            if tip.index >= self.primary_height:
+                return True
+            if tip.index < dict_chain[-1]['index']:
+                # The new blocks weren't accepted (they are invalid, or our branch has more work), so polling again doesn't help now
+                self.error = 'The blocks of the primary after index {} were not accepted.'.format(tip.index)
+                return False
+            # More blocks than one batch are missing, fetch the next batch
+            back = 0
+
+    def status(self):
+        """ Return a dictionary with how far the replica lags behind the primary (the /lag route) """
+        height = self.blockchain.get_last_blockchain_value().index
+        now = time()
+        return {
+            'primary': self.primary,
+            'height': height,
+            'primary_height': self.primary_height,
+            'blocks_behind': max(self.primary_height - height, 0) if self.primary_height != None else None,
+            # Seconds since we last had every block of the primary - 0 right after a poll which caught up
+            'seconds_behind': now - self.caught_up_at if self.caught_up_at != None else None,
+            'last_sync': self.last_sync,
+            'error': self.error
+        }
@@ -0,0 +1,45 @@
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class SeenCache:
+    """ A set of hashes (of transactions or blocks) we have seen recently. Entries expire after ttl seconds and the set never grows
+    beyond max_size entries, so it stays small no matter how long the node runs.
+
+    Attributes:
+        :ttl: The number of seconds a hash is remembered.
+        :max_size: The maximum number of hashes that are remembered.
+    """
+
+    def __init__(self, ttl=600, max_size=100000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # The OrderedDict keeps the hashes in the order they were added, so the oldest ones are always at the front
+        self.__entries = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __expire(self, now):
+        while len(self.__entries) > 0:
+            (key, added) = next(iter(self.__entries.items()))
+            if now - added < self.ttl and len(self.__entries) <= self.max_size:
+                break
+            self.__entries.popitem(last=False)
+
+    def add(self, key):
+        """ Remember a hash. Returns True if it was new, False if we had already seen it """
+        now = time()
+        with self.__lock:
+            self.__expire(now)
+            if key in self.__entries:
+                return False
+            self.__entries[key] = now
+            return True
+
+    def __contains__(self, key):
+        with self.__lock:
+            self.__expire(time())
+            return key in self.__entries
+
+    def __len__(self):
+        return len(self.__entries)
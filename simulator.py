@@ -0,0 +1,386 @@
+# Cluster simulator - runs N nodes inside this process and measures how transactions and blocks propagate between them
+# Every node is its own copy of node.py (its own Flask app, Wallet and Blockchain). Peer requests don't go over the network: a fake transport
+# hands them to the Flask test client of the target node, after an injected latency and with injected failures.
+# python3 simulator.py --nodes 8 --topology ring --transactions 40 --blocks 6 --latency 0.005 --failure-rate 0.02
+# This is our main check for scaling regressions in the networking code - compare the report before and after a change
+
+import importlib.util
+import json
+import os
+import random
+import tempfile
+import threading
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from time import time, sleep
+from urllib.parse import urlparse
+
+import requests
+
+from block import Block
+from blockchain import Blockchain
+import codec
+from transaction import Transaction
+from utilityfolder.hash_util import hash_block, hash_transaction
+from wallet import Wallet
+from wallets import WalletStore
+
+TOPOLOGIES = ('full', 'ring', 'line', 'star', 'random')
+
+
+def build_topology(names, topology, degree=3):
+    """ Return a dictionary with the set of peers of every node for the given topology
+
+    Arguments:
+        :names: The names (URLs) of the nodes.
+        :topology: One of TOPOLOGIES.
+        :degree: The number of peers every node connects to in the random topology.
+    """
+    peers = dict((name, set()) for name in names)
+
+    def connect(a, b):
+        if a != b:
+            peers[a].add(b)
+            peers[b].add(a)
+    if topology == 'full':
+        for a in names:
+            for b in names:
+                connect(a, b)
+    elif topology == 'ring' or topology == 'line':
+        for (a, b) in zip(names, names[1:]):
+            connect(a, b)
+        if topology == 'ring' and len(names) > 2:
+            connect(names[-1], names[0])
+    elif topology == 'star':
+        for name in names[1:]:
+            connect(names[0], name)
+    elif topology == 'random':
+        # Start with a line so the network is always connected, then add random connections
+        for (a, b) in zip(names, names[1:]):
+            connect(a, b)
+        for a in names:
+            while len(peers[a]) < min(degree, len(names) - 1):
+                connect(a, random.choice(names))
+    else:
+        raise ValueError('Unknown topology: {}'.format(topology))
+    return peers
+
+
+def percentile(values, fraction):
+    if len(values) == 0:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def load_node_module(name):
+    """ Load a fresh copy of node.py - every copy has its own Flask app and its own wallet and blockchain globals """
+    spec = importlib.util.spec_from_file_location('simulated_node_{}'.format(name),
+                                                  os.path.join(os.path.dirname(os.path.abspath(__file__)), 'node.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class FakeResponse:
+    """ Looks like a response of the requests module, which is all the Blockchain needs """
+
+    def __init__(self, response):
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = response.data
+        self.__data = response.get_json(silent=True)
+
+    def json(self):
+        if self.__data == None:
+            raise ValueError('Response is not JSON')
+        return self.__data
+
+
+class FakeTransport:
+    """ The transport of one simulated node - it delivers the peer requests of the node through the cluster """
+
+    def __init__(self, cluster, source):
+        self.cluster = cluster
+        self.source = source
+
+    def post(self, url, json=None, data=None, headers=None, timeout=None):
+        return self.cluster.deliver(self.source, 'POST', url, json, data, headers)
+
+    def get(self, url, headers=None, timeout=None):
+        return self.cluster.deliver(self.source, 'GET', url, None, None, headers)
+
+
+class Cluster:
+    """ N simulated nodes wired into a topology.
+
+    Attributes:
+        :latency: Seconds every peer request is delayed.
+        :jitter: Up to this many extra seconds are added to the latency at random.
+        :failure_rate: The probability that a peer request fails with a connection error.
+        :down: Names of nodes which are unreachable (every request to them fails).
+        :wire_encoding: The wire encoding of the nodes, 'json' or 'binary' (see codec.py).
+    """
+
+    def __init__(self, size, topology='full', latency=0, jitter=0, failure_rate=0, degree=3, wire_encoding='json'):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.down = set()
+        self.names = ['node{}'.format(i) for i in range(size)]
+        self.modules = {}
+        self.__lock = threading.Lock()
+        # Metrics
+        self.origin_times = {}
+        self.arrivals = {}
+        self.kinds = {}
+        self.handled = dict((name, 0) for name in self.names)
+        self.dropped = 0
+        self.conflicts = 0
+        self.resolves = 0
+        self.replaced = 0
+        self.mined = []
+        # The bytes of the peer request and response bodies
+        self.request_bytes = 0
+        self.response_bytes = 0
+        # All data files of the nodes go into a temporary directory
+        os.chdir(tempfile.mkdtemp())
+        for name in self.names:
+            module = load_node_module(name)
+            module.port = name
+            module.wallet = Wallet(name)
+            module.wallet.create_keys()
+            module.wallet.save_keys()
+            module.wallets = WalletStore(name)
+            module.blockchain = Blockchain(module.wallet.public_key, name, transport=FakeTransport(self, name),
+                                           wire_encoding=wire_encoding)
+            self.modules[name] = module
+        for (name, peers) in build_topology(self.names, topology, degree).items():
+            for peer in peers:
+                self.modules[name].blockchain.add_peer_node(peer)
+        self.started = time()
+
+    def deliver(self, source, method, url, payload, data=None, headers=None):
+        """ Deliver a peer request from the source node to the node in the URL. The body is either the JSON payload or the raw data """
+        parsed = urlparse(url)
+        target = parsed.netloc
+        if target not in self.modules or target in self.down or random.random() < self.failure_rate:
+            with self.__lock:
+                self.dropped += 1
+            raise requests.exceptions.ConnectionError('Simulated failure {} -> {}'.format(source, target))
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            sleep(delay)
+        # Peer requests can come from background threads too, so every request gets its own test client
+        client = self.modules[target].app.test_client()
+        # The query string is part of the request too (like the range of /chain?start=&end=)
+        path = parsed.path + ('?' + parsed.query if parsed.query else '')
+        if data != None:
+            response = client.open(path, method=method, data=data, headers=headers)
+            # The metrics need the payload itself
+            payload = codec.decode(data)
+        else:
+            response = client.open(path, method=method, json=payload, headers=headers)
+        with self.__lock:
+            self.request_bytes += len(data) if data != None else len(json.dumps(payload)) if payload != None else 0
+            self.response_bytes += len(response.data)
+        self.record(target, parsed.path, payload, response.status_code)
+        return FakeResponse(response)
+
+    def record(self, target, path, payload, status):
+        now = time()
+        item = None
+        if path == '/broadcast-transaction' and status == 201:
+            item = hash_transaction(Transaction(payload['sender'], payload['recipient'], payload['signature'], payload['amount'],
+                                                payload.get('nonce')))
+        elif path == '/broadcast-block' and status == 201:
+            if 'compact_block' in payload:
+                item = payload['compact_block']['hash']
+            else:
+                item = hash_block(self.to_block(payload['block']))
+        with self.__lock:
+            self.handled[target] += 1
+            if path == '/broadcast-block' and status == 409:
+                self.conflicts += 1
+            if item != None:
+                self.arrivals.setdefault(item, {}).setdefault(target, now)
+
+    @staticmethod
+    def to_block(dict_block):
+        return Block(dict_block['index'], dict_block['previous_hash'], [Transaction(
+            tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce')) for tx in dict_block['transactions']],
+            dict_block['proof'], dict_block['timestamp'])
+
+    def __start_item(self, kind, item, name, started):
+        with self.__lock:
+            self.kinds[item] = kind
+            self.origin_times[item] = started
+            self.arrivals.setdefault(item, {})[name] = started
+
+    def submit_transaction(self, name, recipient, amount=1):
+        """ Let the node send coins to the recipient through its /transaction route """
+        module = self.modules[name]
+        started = time()
+        response = module.app.test_client().post('/transaction', json={'recipient': recipient, 'amount': amount})
+        with self.__lock:
+            self.handled[name] += 1
+        if response.status_code == 201:
+            tx = response.get_json()['transaction']
+            item = hash_transaction(Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce')))
+            self.__start_item('transaction', item, name, started)
+        return response.status_code
+
+    def mine(self, name):
+        """ Let the node mine a block through its /mine route - it resolves conflicts first if the node needs to """
+        module = self.modules[name]
+        client = module.app.test_client()
+        if module.blockchain.resolve_conflicts:
+            self.resolve(name)
+        started = time()
+        response = client.post('/mine')
+        with self.__lock:
+            self.handled[name] += 1
+        if response.status_code == 201:
+            item = hash_block(self.to_block(response.get_json()['block']))
+            self.__start_item('block', item, name, started)
+            with self.__lock:
+                self.mined.append(item)
+        return response.status_code
+
+    def resolve(self, name):
+        response = self.modules[name].app.test_client().post('/resolve-conflicts')
+        with self.__lock:
+            self.resolves += 1
+            self.handled[name] += 1
+            if response.get_json()['message'] == 'Chain was replaced!':
+                self.replaced += 1
+
+    def run_workload(self, transactions, blocks, threads=1):
+        """ Send transactions between random nodes and mine blocks on random nodes, in random order
+
+        Arguments:
+            :transactions: The number of transactions to send.
+            :blocks: The number of blocks to mine.
+            :threads: The number of workload steps which run at the same time - more than 1 leads to competing blocks (forks).
+        """
+        # Every node mines once first, so every wallet has coins to send
+        for name in self.names:
+            self.mine(name)
+        steps = ['transaction'] * transactions + ['block'] * blocks
+        random.shuffle(steps)
+        recipients = [self.modules[name].wallet.public_key for name in self.names]
+
+        def step(kind):
+            name = random.choice(self.names)
+            if kind == 'transaction':
+                self.submit_transaction(name, random.choice(recipients))
+            else:
+                self.mine(name)
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(step, steps))
+        # Give every node the chance to catch up before we measure the final state
+        for name in self.names:
+            if self.modules[name].blockchain.resolve_conflicts:
+                self.resolve(name)
+
+    def report(self):
+        """ Return the propagation, fork, resolve and throughput metrics as a dictionary """
+        duration = time() - self.started
+        size = len(self.names)
+        result = {'nodes': size, 'duration': duration, 'dropped_requests': self.dropped}
+        for kind in ('transaction', 'block'):
+            items = [item for (item, item_kind) in self.kinds.items() if item_kind == kind]
+            delays = []
+            full_delays = []
+            coverage = []
+            for item in items:
+                arrivals = self.arrivals.get(item, {})
+                item_delays = [arrived - self.origin_times[item] for arrived in arrivals.values()]
+                delays.extend(item_delays)
+                coverage.append(len(arrivals) / size)
+                if len(arrivals) == size:
+                    full_delays.append(max(item_delays))
+            result[kind + 's'] = {
+                'count': len(items),
+                'coverage': sum(coverage) / len(coverage) if len(coverage) > 0 else None,
+                'fully_propagated': len(full_delays),
+                'latency_p50': percentile(delays, 0.5),
+                'latency_p90': percentile(delays, 0.9),
+                'latency_max': max(delays) if len(delays) > 0 else None,
+                'full_propagation_p50': percentile(full_delays, 0.5)
+            }
+        # A block is orphaned if it isn't part of the final chain - that's a fork which was lost
+        final_chains = [self.modules[name].blockchain.chain for name in self.names]
+        longest = max(final_chains, key=len)
+        in_chain = set(hash_block(block) for block in longest)
+        orphaned = sum(1 for item in self.mined if item not in in_chain)
+        result['forks'] = {
+            'block_conflicts': self.conflicts,
+            'orphaned_blocks': orphaned,
+            'fork_rate': orphaned / len(self.mined) if len(self.mined) > 0 else 0,
+            'distinct_tips': len(set(hash_block(chain[-1]) for chain in final_chains)),
+            'reorganizations': sum(self.modules[name].blockchain.get_fork_stats()['reorganizations'] for name in self.names)
+        }
+        result['resolve'] = {
+            'calls': self.resolves,
+            'replaced': self.replaced,
+            'per_block': self.resolves / len(self.mined) if len(self.mined) > 0 else 0
+        }
+        result['throughput'] = dict((name, self.handled[name] / duration) for name in self.names)
+        result['traffic'] = {'request_bytes': self.request_bytes, 'response_bytes': self.response_bytes}
+        return result
+
+    def close(self):
+        for module in self.modules.values():
+            module.blockchain.close()
+
+
+def print_report(report):
+    print('Nodes: {}, duration: {:.2f}s, dropped requests: {}'.format(report['nodes'], report['duration'], report['dropped_requests']))
+    for kind in ('transactions', 'blocks'):
+        stats = report[kind]
+        print('{}: {} sent, {} reached every node, coverage {}, latency p50 {} p90 {} max {}'.format(
+            kind.capitalize(), stats['count'], stats['fully_propagated'], format_number(stats['coverage']),
+            format_number(stats['latency_p50']), format_number(stats['latency_p90']), format_number(stats['latency_max'])))
+    forks = report['forks']
+    print('Forks: {} block conflicts, {} orphaned blocks (fork rate {}), {} distinct tips, {} reorganizations'.format(
+        forks['block_conflicts'], forks['orphaned_blocks'], format_number(forks['fork_rate']), forks['distinct_tips'],
+        forks['reorganizations']))
+    print('Resolve: {} calls, {} replaced chains, {} per mined block'.format(
+        report['resolve']['calls'], report['resolve']['replaced'], format_number(report['resolve']['per_block'])))
+    print('Requests per second per node: ' + ', '.join(
+        '{} {:.1f}'.format(name, rate) for (name, rate) in report['throughput'].items()))
+    print('Peer traffic: {} request bytes, {} response bytes'.format(
+        report['traffic']['request_bytes'], report['traffic']['response_bytes']))
+
+
+def format_number(value):
+    return '-' if value == None else '{:.3f}'.format(value)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--nodes', type=int, default=5)
+    parser.add_argument('--topology', choices=TOPOLOGIES, default='full')
+    parser.add_argument('--degree', type=int, default=3, help='Peers per node in the random topology')
+    parser.add_argument('--transactions', type=int, default=20)
+    parser.add_argument('--blocks', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=1, help='Workload steps running at the same time')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds every peer request is delayed')
+    parser.add_argument('--jitter', type=float, default=0, help='Up to this many random extra seconds of latency')
+    parser.add_argument('--failure-rate', type=float, default=0, help='Probability that a peer request fails')
+    parser.add_argument('--down', type=int, default=0, help='Number of nodes which are unreachable during the workload')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--wire', choices=codec.ENCODINGS, default='json', help='The encoding of blocks and transactions between the nodes')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    cluster = Cluster(args.nodes, args.topology, args.latency, args.jitter, args.failure_rate, args.degree, args.wire)
+    cluster.down = set(cluster.names[len(cluster.names) - args.down:]) if args.down > 0 else set()
+    cluster.run_workload(args.transactions, args.blocks, args.threads)
+    report = cluster.report()
+    cluster.close()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
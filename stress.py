@@ -0,0 +1,154 @@
+# Stress test for the node - hammers the routes of node.py from many threads at the same time and checks that the blockchain stays consistent
+# Run it with: python3 stress.py --threads 8 --requests 200
+# The node runs in this process (with the Flask test client) in a temporary directory, so no server and no existing data files are needed
+
+import os
+import random
+import tempfile
+import threading
+from argparse import ArgumentParser
+
+import node
+from block import Block
+from blockchain import Blockchain, MINING_REWARD
+from transaction import Transaction
+from utilityfolder.verification import Verification
+from wallet import Wallet
+
+
+def to_blocks(dict_chain):
+    """ Convert the JSON chain of the /chain route back to Block objects """
+    return [Block(block['index'], block['previous_hash'], [Transaction(
+        tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx.get('nonce')) for tx in block['transactions']],
+        block['proof'], block['timestamp']) for block in dict_chain]
+
+
+def check_chain(dict_chain, errors):
+    """ Check the invariants of a chain snapshot and add a message to errors for every broken invariant """
+    chain = to_blocks(dict_chain)
+    if [block.index for block in chain] != list(range(len(chain))):
+        errors.append('Block indexes are not continuous')
+    if not Verification.verify_chain(chain):
+        errors.append('Chain is invalid')
+    # No coins are created except the mining rewards
+    balances = {}
+    for block in chain:
+        for tx in block.transactions:
+            balances[tx.sender] = balances.get(tx.sender, 0) - tx.amount
+            balances[tx.recipient] = balances.get(tx.recipient, 0) + tx.amount
+    supply = sum(amount for (address, amount) in balances.items() if address != 'MINING')
+    if supply != MINING_REWARD * (len(chain) - 1):
+        errors.append('Supply {} does not match {} mined blocks'.format(supply, len(chain) - 1))
+    negative = [address for (address, amount) in balances.items() if address != 'MINING' and amount < 0]
+    if len(negative) > 0:
+        errors.append('{} addresses have a negative balance'.format(len(negative)))
+    return chain, balances
+
+
+def worker(recipients, request_count, stats, errors, lock):
+    # The Flask test client isn't shared between threads - every thread gets its own
+    client = node.app.test_client()
+    for i in range(request_count):
+        action = random.random()
+        # Number of transactions the node accepted with this request
+        accepted = 0
+        if action < 0.35:
+            response = client.post('/transaction', json={
+                'recipient': random.choice(recipients), 'amount': random.randint(1, 3)})
+            route = '/transaction'
+            accepted = 1 if response.status_code == 201 else 0
+        elif action < 0.45:
+            response = client.post('/transactions/batch', json={'transactions': [
+                {'recipient': random.choice(recipients), 'amount': 1} for j in range(5)]})
+            route = '/transactions/batch'
+            accepted = sum(1 for result in response.get_json().get('results', []) if result['success'])
+        elif action < 0.55:
+            response = client.post('/mine')
+            route = '/mine'
+        elif action < 0.7:
+            response = client.get('/balance')
+            route = '/balance'
+            if response.status_code == 200 and response.get_json()['funds'] < 0:
+                with lock:
+                    errors.append('/balance returned a negative balance')
+        elif action < 0.85:
+            response = client.get('/transactions')
+            route = '/transactions'
+        else:
+            response = client.get('/chain')
+            route = '/chain'
+            # Every chain a reader gets has to be consistent on its own, even while other threads are mining
+            chain_errors = []
+            check_chain(response.get_json(), chain_errors)
+            if len(chain_errors) > 0:
+                with lock:
+                    errors.extend(chain_errors)
+        with lock:
+            stats['accepted'] = stats.get('accepted', 0) + accepted
+            key = (route, response.status_code)
+            stats[key] = stats.get(key, 0) + 1
+
+
+def run(thread_count, request_count):
+    os.chdir(tempfile.mkdtemp())
+    node.port = 'stress'
+    node.wallet = Wallet(node.port)
+    node.wallet.create_keys()
+    node.blockchain = Blockchain(node.wallet.public_key, node.port)
+    client = node.app.test_client()
+    # Mine a few blocks first so the wallet has funds to send
+    for i in range(5):
+        client.post('/mine')
+    recipients = []
+    for i in range(3):
+        recipient = Wallet(None)
+        recipient.create_keys()
+        recipients.append(recipient.public_key)
+
+    stats = {}
+    errors = []
+    lock = threading.Lock()
+    threads = [threading.Thread(target=worker, args=(recipients, request_count, stats, errors, lock))
+               for i in range(thread_count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # Final checks on the state after all threads finished
+    chain, balances = check_chain(client.get('/chain').get_json(), errors)
+    open_transactions = client.get('/transactions').get_json()
+    # Every accepted transaction is either confirmed or still open - none got lost and none was added twice
+    confirmed = sum(1 for block in chain for tx in block.transactions if tx.sender != 'MINING')
+    accepted = stats.pop('accepted', 0)
+    if confirmed + len(open_transactions) != accepted:
+        errors.append('{} transactions were accepted but {} are confirmed and {} are open'.format(
+            accepted, confirmed, len(open_transactions)))
+    open_sent = sum(tx['amount'] for tx in open_transactions if tx['sender'] == node.wallet.public_key)
+    funds = client.get('/balance').get_json()['funds']
+    if funds != balances.get(node.wallet.public_key, 0) - open_sent:
+        errors.append('/balance returned {} but the chain says {}'.format(
+            funds, balances.get(node.wallet.public_key, 0) - open_sent))
+    mined = sum(count for ((route, status), count) in stats.items() if route == '/mine' and status == 201)
+    if len(chain) - 1 != mined + 5:
+        errors.append('{} blocks were mined but the chain has {} blocks'.format(mined + 5, len(chain) - 1))
+    node.blockchain.close()
+
+    for (route, status), count in sorted(stats.items()):
+        print('{:<22} {}  x{}'.format(route, status, count))
+    print('Chain length: {}, open transactions: {}'.format(len(chain), len(open_transactions)))
+    if len(errors) > 0:
+        for error in errors:
+            print('FAILED: ' + error)
+        return False
+    print('All invariants hold.')
+    return True
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-t', '--threads', type=int, default=8)
+    parser.add_argument('-r', '--requests', type=int, default=200)
+    args = parser.parse_args()
+    if not run(args.threads, args.requests):
+        raise SystemExit(1)
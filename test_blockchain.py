@@ -0,0 +1,87 @@
+import os
+import tempfile
+import unittest
+from time import time
+
+from utilityfolder.hash_util import hash_block
+from utilityfolder.verification import Verification
+
+from block import Block
+from blockchain import Blockchain, block_to_dict
+from transaction import Transaction
+
+
+def mine(previous, transactions, miner='miner'):
+    """ Return a block with a valid proof on top of the previous block
+
+    Arguments:
+        :previous: The block the new block extends.
+        :transactions: The transactions of the block (as dictionaries), without the reward.
+        :miner: The recipient of the reward.
+    """
+    previous_hash = hash_block(previous)
+    transactions = [Transaction(tx['sender'], tx['recipient'], tx['signature'], tx['amount'], tx['nonce']) for tx in transactions]
+    proof = 0
+    while not Verification.valid_proof(transactions, previous_hash, proof):
+        proof += 1
+    return Block(previous.index + 1, previous_hash, transactions + [Transaction('MINING', miner, '', 10)], proof, time())
+
+
+class ReorganizeTest(unittest.TestCase):
+
+    def setUp(self):
+        # The node writes its chain and snapshots to the working directory
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+        self.blockchain = Blockchain('node', 5990)
+        self.genesis = self.blockchain.chain[0]
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_reorganize_away_from_malformed_sender(self):
+        # Blocks of peers are added without checking signatures, so a sender which isn't a key at all gets into our chain
+        poisoned = mine(self.genesis, [{'sender': 'zz', 'recipient': 'someone', 'signature': 'zz', 'amount': 1, 'nonce': 1}])
+        self.assertTrue(self.blockchain.add_block(block_to_dict(poisoned), broadcast=False))
+        # A heavier branch from the genesis block undoes it - its transaction is checked now and has to be dropped, not raise
+        first = mine(self.genesis, [], miner='other')
+        second = mine(first, [], miner='other')
+        self.assertTrue(self.blockchain.add_block(block_to_dict(first), broadcast=False))
+        self.assertTrue(self.blockchain.add_block(block_to_dict(second), broadcast=False))
+        self.assertEqual(hash_block(self.blockchain.chain[-1]), hash_block(second))
+        self.assertEqual(self.blockchain.get_open_transactions(), [])
+        # The next blocks of the better branch are added as well
+        third = mine(second, [], miner='other')
+        self.assertTrue(self.blockchain.add_block(block_to_dict(third), broadcast=False))
+        self.assertEqual(hash_block(self.blockchain.chain[-1]), hash_block(third))
+
+
+
+class PruneTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.TemporaryDirectory()
+        os.chdir(self.directory.name)
+        self.blockchain = Blockchain('node', 5991, prune_depth=20)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.directory.cleanup()
+
+    def test_columns_drop_pruned_transactions(self):
+        # Once the columns are built they're updated with every block - pruning has to take the old transactions out of them as well
+        self.blockchain.mine_block(broadcast=False)
+        self.blockchain.get_columns()
+        for i in range(80):
+            self.blockchain.mine_block(broadcast=False)
+        columns = self.blockchain.get_columns()
+        self.assertGreater(self.blockchain.pruned_height, 0)
+        self.assertTrue(all(columns.heights > self.blockchain.pruned_height))
+        self.assertEqual(columns.balances(), {'node': self.blockchain.get_balance('node')})
+        self.assertEqual(columns.stats()['supply'], 810)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,226 @@
+import json
+import random
+import sys
+import threading
+from time import time, perf_counter
+
+# Lightweight tracing: a span measures one phase of an operation (like the proof of work of mine_block) and is written as one JSON
+# object per line when it ends. Spans opened while another span is open in the same thread become its children, so all spans of
+# one operation share a trace id.
+#
+#     with tracer.span('mine_block') as span:
+#         with tracer.span('proof_of_work'):
+#             ...
+#         span.set('transactions', 12)
+#
+# Sampling is decided once per trace (at the root span): an unsampled trace costs almost nothing, its spans are never created.
+#
+# Coroutines share the thread of the event loop, so they can't use the span stack of the thread - their spans are detached and every
+# child names its parent:
+#
+#     with tracer.span('broadcast', detached=True) as span:
+#         with tracer.span('post_peer', parent=span, detached=True):
+#             await ...
+
+
+class Span:
+    """ One timed phase. It's written to the sink of its tracer when it ends.
+
+    Attributes:
+        :name: The name of the phase.
+        :trace_id: The id every span of the same operation shares.
+        :span_id: The id of this span.
+        :parent_id: The id of the enclosing span, None for the root span of a trace.
+        :attributes: Dictionary of extra values that are written with the span.
+        :detached: True if the span isn't put on the span stack of the thread (a span of a coroutine).
+    """
+
+    def __init__(self, tracer, name, trace_id, parent_id, attributes, detached=False):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.detached = detached
+        self.error = None
+        self.start = time()
+        self.__started = perf_counter()
+
+    def set(self, key, value):
+        """ Add an attribute to the span """
+        self.attributes[key] = value
+
+    def __enter__(self):
+        if not self.detached:
+            self.tracer._push(self)
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        duration = perf_counter() - self.__started
+        if not self.detached:
+            self.tracer._pop(self)
+        if error != None:
+            self.error = '{}: {}'.format(error_type.__name__, error)
+        record = {
+            'trace': self.trace_id,
+            'span': self.span_id,
+            'parent': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration_ms': duration * 1000,
+            'thread': threading.current_thread().name
+        }
+        if len(self.attributes) > 0:
+            record['attributes'] = self.attributes
+        if self.error != None:
+            record['error'] = self.error
+        self.tracer.emit(record)
+        # Exceptions are never swallowed
+        return False
+
+
+class _NoSpan:
+    """ Stands in for a span which isn't recorded (tracing is off or the trace wasn't sampled) - every method does nothing """
+    name = None
+    trace_id = None
+    span_id = None
+
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        return False
+
+
+NO_SPAN = _NoSpan()
+
+
+class _UnsampledRoot(_NoSpan):
+    """ The root of a trace which wasn't sampled. It's on the span stack while it's open, so the spans inside it aren't recorded either """
+
+    def __init__(self, tracer):
+        self.tracer = tracer
+
+    def __enter__(self):
+        self.tracer._push(self)
+        return self
+
+    def __exit__(self, error_type, error, traceback):
+        self.tracer._pop(self)
+        return False
+
+
+def _new_id():
+    return '{:016x}'.format(random.getrandbits(64))
+
+
+class Tracer:
+    """ Creates spans and hands the finished ones to a sink.
+
+    Attributes:
+        :sink: A function which gets every finished span as a dictionary, None turns tracing off.
+        :sample_rate: The fraction of traces (root spans) which are recorded, between 0 and 1.
+    """
+
+    def __init__(self, sink=None, sample_rate=1.0):
+        self.sink = sink
+        self.sample_rate = sample_rate
+        self.__local = threading.local()
+
+    @property
+    def enabled(self):
+        return self.sink != None and self.sample_rate > 0
+
+    def __stack(self):
+        stack = getattr(self.__local, 'stack', None)
+        if stack == None:
+            stack = self.__local.stack = []
+        return stack
+
+    def _push(self, span):
+        self.__stack().append(span)
+
+    def _pop(self, span):
+        stack = self.__stack()
+        if len(stack) > 0 and stack[-1] is span:
+            stack.pop()
+
+    def current(self):
+        """ Return the innermost open span of this thread, or NO_SPAN """
+        stack = self.__stack()
+        return stack[-1] if len(stack) > 0 else NO_SPAN
+
+    def span(self, name, parent=None, detached=False, **attributes):
+        """ Return a span for the phase name - use it with a with statement.
+
+        Arguments:
+            :name: The name of the phase.
+            :parent: The parent span if it was opened in another thread, by default it's the innermost open span of this thread.
+            :detached: True for a span of a coroutine - it ignores the span stack of the thread and isn't put on it, so without a
+                parent it's the root of a new trace.
+            :attributes: Extra values that are written with the span.
+        """
+        if not self.enabled:
+            return NO_SPAN
+        if parent == None and not detached:
+            stack = self.__stack()
+            parent = stack[-1] if len(stack) > 0 else None
+        if parent == None:
+            if self.sample_rate < 1 and random.random() >= self.sample_rate:
+                # Nothing of a detached trace is on the stack, its children get this as their parent and aren't recorded either
+                return NO_SPAN if detached else _UnsampledRoot(self)
+            return Span(self, name, _new_id(), None, attributes, detached)
+        if isinstance(parent, _NoSpan):
+            return NO_SPAN
+        return Span(self, name, parent.trace_id, parent.span_id, attributes, detached)
+
+    def emit(self, record):
+        try:
+            self.sink(record)
+        except Exception:
+            # A broken sink must never break the operation that is traced
+            pass
+
+
+class JsonLogSink:
+    """ Writes every span as one JSON object per line to a stream (stderr by default) or to a file """
+
+    def __init__(self, stream=None, path=None):
+        self.__lock = threading.Lock()
+        if path != None:
+            self.stream = open(path, mode='a')
+        else:
+            self.stream = stream if stream != None else sys.stderr
+
+    def __call__(self, record):
+        line = json.dumps(record, default=str)
+        with self.__lock:
+            self.stream.write(line + '\n')
+            self.stream.flush()
+
+
+class MemorySink:
+    """ Keeps the spans in a list - for tests and benchmarks which look at the spans themselves """
+
+    def __init__(self):
+        self.records = []
+        self.__lock = threading.Lock()
+
+    def __call__(self, record):
+        with self.__lock:
+            self.records.append(record)
+
+
+# Tracing is off unless a node is started with --trace (or a Blockchain gets its own Tracer)
+DISABLED = Tracer()
+
+
+def create_tracer(destination, sample_rate=1.0):
+    """ Create the tracer of a node from its --trace option: '-' writes to stderr, anything else is the path of a log file, None is off """
+    if destination == None:
+        return DISABLED
+    return Tracer(JsonLogSink(path=None if destination == '-' else destination), sample_rate)
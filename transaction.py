@@ -10,13 +10,21 @@ class Transaction(Printable):
         :recipient: The recipient of the coins.
         :signature: The signature of the transaction.
         :amount: The amount of the coins sent.
+        :nonce: The number of the transaction in the account of the sender (1, 2, 3, ...), None for transactions without one.
     """
+    # Transactions without a nonce only get the class attribute, so their dictionary (what we store and send) stays the same as before
+    nonce = None
 
-    def __init__(self, sender, recipient, signature, amount):
+    def __init__(self, sender, recipient, signature, amount, nonce=None):
         self.sender = sender
         self.recipient = recipient
         self.amount = amount
         self.signature = signature
+        if nonce != None:
+            self.nonce = nonce
 
     def to_ordered_dict(self):
+        # The nonce is part of the hash, so a miner can't change it - it's left out if there is none, so old blocks keep their hashes
+        if self.nonce != None:
+            return OrderedDict([('sender', self.sender), ('recipient', self.recipient), ('amount', self.amount), ('nonce', self.nonce)])
         return OrderedDict([('sender', self.sender), ('recipient', self.recipient), ('amount', self.amount)])
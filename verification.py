@@ -5,6 +5,13 @@
 # Import two functions from our hash_util.py file. Omit the ".py" in the import
 from utilityfolder.hash_util import hash_string_256, hash_block
 from wallet import Wallet
+from block import BlockHeader
+from median_time import TimeWindow, check_timestamp
+from time import time
+
+# Blocks with a timestamp from this time on (2026-10-19 UTC) may only contain transactions with a nonce. Older blocks were mined before
+# transactions had nonces, they stay valid - but a transaction without a nonce can never get into a new block (and be replayed there)
+NONCE_REQUIRED_SINCE = 1792368000
 
 
 class Verification:
@@ -32,15 +39,43 @@ class Verification:
 
     # verify_chain uses valid_proof - therefore we need access to the chain, but we don't need an instance so we can use a class method
     @classmethod
-    def verify_chain(cls, blockchain):
+    def verify_chain(cls, blockchain, times=None):
         """ Verify the current blockchain and return True if it's Valid and False if it's not.
         Compare the stored hash in a given block with the re-calculated hash of the previous block
-        Also check PoW is valid using valid_proof """
+        Also check PoW is valid using valid_proof, that no timestamp is earlier than the median time of the blocks before it
+        and - for a chain which starts with the genesis block - that the nonces of every sender follow each other
+
+        Arguments: blockchain: The blocks to verify, the first block isn't verified (it's the genesis block or a block we know).
+                : times: The TimeWindow of the chain up to the first block, None if the chain starts with the genesis block.
+        """
+        # The nonces of a chain which starts after the genesis block depend on the blocks before it - the blockchain checks those
+        # when it applies the blocks to its ledger (see Blockchain.__reorganize)
+        nonces = {} if times == None else None
+        # The window moves along the chain, so checking the timestamps costs the same for every block
+        if times == None:
+            times = TimeWindow.from_blocks(blockchain[:1])
+        now = time()
         for (index, block) in enumerate(blockchain):
             if index == 0:
                 continue
             if block.previous_hash != hash_block(blockchain[index - 1]):
                 return False
+            if check_timestamp(block.timestamp, times.median(), now) != None:
+                print('Timestamp is invalid')
+                return False
+            times = times.push(block.timestamp)
+            # The proof of a pruned block can't be checked without its transactions - it was checked before the block was pruned
+            # Neither can its nonces, so the nonces of the blocks after it aren't known either
+            if isinstance(block, BlockHeader):
+                nonces = None
+                continue
+            if nonces != None:
+                if not cls.verify_nonces(block, lambda sender: nonces.get(sender, 0)):
+                    print('Nonces are invalid')
+                    return False
+                for tx in block.transactions[:-1]:
+                    if tx.nonce != None:
+                        nonces[tx.sender] = tx.nonce
             # In the following PoW validation we need to exclude the reward transaction because in mine_block the reward is included after the calculation of proof
             # Using the range selector [:-1] selects all elements except the final one
             # valid_proof is form a different class so we need .self
@@ -76,3 +111,66 @@ class Verification:
         # All transactions need to be true
         # This is a second safety precuation as verify_transaction already "verifies that the sender can afford the requested transaction"
         return all([cls.verify_transaction(tx, get_balance, False) for tx in open_transactions])
+
+    @classmethod
+    def verify_nonces(cls, block, get_nonce):
+        """ Verify the nonces of the transactions of a block - the transactions of every sender have to continue its nonces one by one,
+        so a nonce is never used twice. Transactions without a nonce are only valid in blocks before NONCE_REQUIRED_SINCE.
+
+        Arguments: block: The block (with Transaction objects), its last transaction is the reward which has no nonce.
+                : get_nonce: Reference to a function which returns the last nonce of a sender before the block (0 for none).
+        """
+        next_nonces = {}
+        for tx in block.transactions[:-1]:
+            if tx.nonce == None:
+                if block.timestamp >= NONCE_REQUIRED_SINCE:
+                    return False
+                continue
+            expected = next_nonces.get(tx.sender)
+            if expected == None:
+                expected = get_nonce(tx.sender) + 1
+            if not cls.valid_nonce(tx.nonce, expected):
+                return False
+            next_nonces[tx.sender] = expected + 1
+        return True
+
+    @staticmethod
+    def valid_nonce(nonce, expected):
+        """ Return True if a transaction may have this nonce - the nonce after the last one its sender used, so every nonce is only used once
+
+        Arguments: nonce: The nonce of the transaction.
+                : expected: The next nonce of the sender.
+        """
+        # A new transaction needs a nonce. bool is an int too, but True isn't a nonce - and 1.0 would be signed and hashed differently than 1
+        return isinstance(nonce, int) and not isinstance(nonce, bool) and nonce == expected
+
+    @classmethod
+    def verify_transaction_batch(cls, transactions, get_balance, check_signatures=True, get_nonce=None):
+        """ Verify a batch of transactions together and return a list with True or False for every transaction.
+        The balance of every sender is fetched once and the amounts of the accepted transactions are deducted from it cumulatively,
+        so a sender can't spend the same coins twice within one batch. The nonces of a sender have to follow each other in the same way.
+
+        Arguments: transactions: The transactions that should be verified.
+                : get_balance: Reference to the get_balance function of the blockchain.
+                : check_signatures: False if the signatures were already verified and only the funds should be checked.
+                : get_nonce: Reference to a function which returns the next nonce of a sender, None doesn't check the nonces.
+                    Transactions without a nonce are invalid when the nonces are checked.
+        """
+        remaining_balances = {}
+        next_nonces = {}
+        results = []
+        for tx in transactions:
+            if tx.sender not in remaining_balances:
+                remaining_balances[tx.sender] = get_balance(tx.sender)
+            check_nonce = get_nonce != None
+            if check_nonce and tx.sender not in next_nonces:
+                next_nonces[tx.sender] = get_nonce(tx.sender)
+            # We only pay for the signature check if the sender can afford the transaction
+            valid = (remaining_balances[tx.sender] >= tx.amount and (not check_nonce or cls.valid_nonce(tx.nonce, next_nonces[tx.sender]))
+                     and (not check_signatures or Wallet.verify_transaction(tx)))
+            if valid:
+                remaining_balances[tx.sender] -= tx.amount
+                if check_nonce:
+                    next_nonces[tx.sender] += 1
+            results.append(valid)
+        return results
@@ -1,17 +1,78 @@
-# Import from pycoin third party package
-from Crypto.PublicKey import RSA  # Function for generating keys
-from Crypto.Signature import PKCS1_v1_5  # Algorithm for generating signatures
-from Crypto.Hash import SHA256
-import Crypto.Random
+# The pycryptodome modules (Crypto) are imported in the functions which use them - the first signature or key pays for the import, not
+# every program which imports the wallet (like the node before it answers its first request). After the first time an import is a lookup
 import binascii
+import json
+from concurrent.futures import ProcessPoolExecutor
+
+# The signature schemes a wallet can use. RSA keys are plain hex (like all the keys created before there was a choice), the keys of every
+# other scheme are tagged with the name of the scheme, like 'ed25519:<hex>'. Verification looks at the tag of the sender to pick the scheme
+SCHEME_RSA = 'rsa'
+SCHEME_ED25519 = 'ed25519'
+SIGNATURE_SCHEMES = (SCHEME_RSA, SCHEME_ED25519)
+# The tag in front of every signed transaction - a new payload format gets a new tag, so old signatures never fit it
+SIGNING_DOMAIN = 'pythonblockchain-transaction-v1'
+# Starting a process pool takes longer than signing a small batch, so smaller batches are always signed in this process
+PARALLEL_SIGNING_MIN = 1000
+
+
+def key_scheme(key):
+    """ Return the signature scheme of a public or private key (an address) """
+    if key.startswith(SCHEME_ED25519 + ':'):
+        return SCHEME_ED25519
+    return SCHEME_RSA
+
+
+def signing_payload(sender, recipient, amount, nonce=None):
+    # This is what gets signed for a transaction - the same for every scheme. The fields are a JSON list behind a domain tag, so no two
+    # transactions have the same payload (a recipient can't swallow a part of the amount or the nonce), and a signed nonce can't be changed
+    if nonce != None:
+        return json.dumps([SIGNING_DOMAIN, sender, recipient, amount, nonce], separators=(',', ':')).encode('utf8')
+    # Transactions without a nonce are only valid in old blocks (see Verification.verify_nonces), they were signed like this. The payload
+    # starts with the key of the sender, never with the bracket of the list above, so the two forms can't be mixed up
+    return (str(sender) + str(recipient) + str(amount)).encode('utf8')
+
+
+def create_signer(private_key):
+    """ Parse the private key once and return a function which signs a payload (bytes) and returns the signature as hex """
+    from Crypto.PublicKey import RSA  # Function for generating keys
+    from Crypto.Signature import PKCS1_v1_5, eddsa  # Algorithms for generating signatures
+    from Crypto.Hash import SHA256
+    if key_scheme(private_key) == SCHEME_ED25519:
+        # Ed25519 signs the payload itself (it hashes it internally) and the signature has 64 bytes
+        signer = eddsa.new(eddsa.import_private_key(binascii.unhexlify(private_key[len(SCHEME_ED25519) + 1:])), 'rfc8032')
+        return lambda payload: binascii.hexlify(signer.sign(payload)).decode('ascii')
+    # Create a signer identity with PKCS1_v1_5
+    # We also use RSA to import keys. We need to convert the string keys to binary with binascii.unhexlify()
+    signer = PKCS1_v1_5.new(RSA.importKey(binascii.unhexlify(private_key)))
+    # RSA signs a SHA256 hash of the payload
+    return lambda payload: binascii.hexlify(signer.sign(SHA256.new(payload))).decode('ascii')
+
+
+# Every worker process of the signing pool parses the private key once when it starts and keeps the signer here
+_worker_signer = None
+
+
+def _init_signing_worker(private_key):
+    global _worker_signer
+    _worker_signer = create_signer(private_key)
+
+
+def _sign_payloads(payloads):
+    return [_worker_signer(payload) for payload in payloads]
 
 
 class Wallet:
-    def __init__(self, node_id):
+    def __init__(self, node_id, scheme=SCHEME_RSA):
         # Initialisation of keys
         self.private_key = None
         self.public_key = None
         self.node_id = node_id
+        # The scheme for new keys. Loaded keys bring their own scheme
+        if scheme not in SIGNATURE_SCHEMES:
+            raise ValueError('Unknown signature scheme: {}'.format(scheme))
+        self.scheme = scheme
+        # The parsed private key (the signer) together with the key it was parsed from. It's only parsed again when the keys change
+        self.__signer = (None, None)
 
     def create_keys(self):
         # Use unpacking from generate_keys
@@ -46,12 +107,20 @@ class Wallet:
                 private_key = keys[1]
                 self.public_key = public_key
                 self.private_key = private_key
+                self.scheme = key_scheme(public_key)
             return True
         except (IOError, IndexError):
             print('Loading wallet failed')
             return False
 
     def generate_keys(self):
+        from Crypto.PublicKey import RSA, ECC
+        import Crypto.Random
+        if self.scheme == SCHEME_ED25519:
+            # Ed25519 keys are generated in no time, and the public key (the address) has only 32 bytes
+            private_key = ECC.generate(curve='Ed25519')
+            return (SCHEME_ED25519 + ':' + binascii.hexlify(private_key.seed).decode('ascii'),
+                    SCHEME_ED25519 + ':' + binascii.hexlify(private_key.public_key().export_key(format='raw')).decode('ascii'))
         # RSA is a type of key used in blockchain wallets
         private_key = RSA.generate(1024, Crypto.Random.new().read)
         # We get the public key from the private key. In the private key there is a publickey() method
@@ -59,30 +128,63 @@ class Wallet:
         return (binascii.hexlify(private_key.exportKey(format='DER')).decode('ascii'), 
                 binascii.hexlify(public_key.exportKey(format='DER')).decode('ascii'))
 
+    def __get_signer(self):
+        (private_key, signer) = self.__signer
+        if private_key != self.private_key:
+            # One assignment, so another thread never sees a signer together with the wrong key
+            private_key = self.private_key
+            signer = create_signer(private_key)
+            self.__signer = (private_key, signer)
+        return signer
+
     # We need methods for creating a signature (assigning a transaction) and one for verifying
-    def sign_transaction(self, sender, recipient, amount):
-        # Create a signer identity with PKCS1_v1_5
-        # We also use RSA to import keys. We need to convert the string keys to binary with binascii.unhexlify()
-        # The private key is used for signing
-        signer = PKCS1_v1_5.new(RSA.importKey(
-            binascii.unhexlify(self.private_key)))
-        # We need the payload of what we are going to sign, we store that in a normal hash
-        h = SHA256.new((str(sender) + str(recipient) +
-                       str(amount)).encode('utf8'))
-        # Generate a signature for the transaction
-        signature = signer.sign(h)
-        return binascii.hexlify(signature).decode('ascii')
+    def sign_transaction(self, sender, recipient, amount, nonce=None):
+        # We need the payload of what we are going to sign. The private key is used for signing
+        return self.__get_signer()(signing_payload(sender, recipient, amount, nonce))
+
+    def sign_transactions(self, transfers, processes=None):
+        """ Sign many transfers from this wallet at once and return the signatures in the same order
+
+        Arguments:
+            :transfers: A list of (recipient, amount) or (recipient, amount, nonce) tuples.
+            :processes: The number of processes which sign in parallel. None or 1 signs in this process (batches below PARALLEL_SIGNING_MIN always do).
+        """
+        payloads = [signing_payload(self.public_key, *transfer) for transfer in transfers]
+        if processes == None or processes <= 1 or len(payloads) < PARALLEL_SIGNING_MIN:
+            signer = self.__get_signer()
+            return [signer(payload) for payload in payloads]
+        # A few chunks per process, so a slow process doesn't hold up the whole batch. Every process parses the key only once
+        size = -(-len(payloads) // (processes * 4))
+        chunks = [payloads[i:i + size] for i in range(0, len(payloads), size)]
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_signing_worker, initargs=(self.private_key,)) as executor:
+            return [signature for signatures in executor.map(_sign_payloads, chunks) for signature in signatures]
 
     # The following method only requires transaciton so we can use the static method
     @staticmethod
     # Receives whole transaction object because this contains all the data we need to verify
     def verify_transaction(transaction):
+        from Crypto.PublicKey import RSA
+        from Crypto.Signature import PKCS1_v1_5, eddsa
+        from Crypto.Hash import SHA256
+        # The tag of the sender tells us the scheme. Untagged senders are RSA keys, so old transactions stay valid
+        if key_scheme(transaction.sender) == SCHEME_ED25519:
+            try:
+                verifier = eddsa.new(eddsa.import_public_key(
+                    binascii.unhexlify(transaction.sender[len(SCHEME_ED25519) + 1:])), 'rfc8032')
+                verifier.verify(signing_payload(transaction.sender, transaction.recipient, transaction.amount, transaction.nonce),
+                                binascii.unhexlify(transaction.signature))
+                return True
+            except (ValueError, TypeError, binascii.Error):
+                return False
         # If the sender is someone esle, we need to verify. But first we need the public key (of the sender) in binary format
-        public_key = RSA.importKey(binascii.unhexlify(transaction.sender))
-        verifier = PKCS1_v1_5.new(public_key)
-        h = SHA256.new((str(transaction.sender) + str(transaction.recipient) +
-                       str(transaction.amount)).encode('utf8'))
-        return verifier.verify(h, binascii.unhexlify(transaction.signature))
+        # Transactions in blocks of peers were never checked, so a sender or signature which isn't hex or not a key at all is just invalid
+        try:
+            public_key = RSA.importKey(binascii.unhexlify(transaction.sender))
+            verifier = PKCS1_v1_5.new(public_key)
+            h = SHA256.new(signing_payload(transaction.sender, transaction.recipient, transaction.amount, transaction.nonce))
+            return verifier.verify(h, binascii.unhexlify(transaction.signature))
+        except (ValueError, TypeError, binascii.Error):
+            return False
 
 
 # The public and private key are in binary so we need to convert them to a string, we do this with binascii - this allows us to convert binary data to ASCII
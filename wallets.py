@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+
+from wallet import Wallet, SCHEME_RSA, key_scheme
+
+
+class WalletStore:
+    """ The wallets of the accounts a node holds for its clients (a custodial node), keyed by their address (the public key).
+    Every request names the account it signs for, so adding or using a wallet never touches the Blockchain of the node.
+    The keys are stored in wallets-<node_id>.txt, one JSON line per wallet - a new wallet appends one line.
+
+    Attributes:
+        :node_id: The id (port) of the node.
+        :scheme: The signature scheme of new wallets unless another one is asked for.
+    """
+
+    def __init__(self, node_id, scheme=SCHEME_RSA):
+        self.node_id = node_id
+        self.scheme = scheme
+        self.filename = 'wallets-{}.txt'.format(node_id)
+        # Guards the dictionaries and the file. Signing doesn't take it, only the lock of the wallet that signs
+        self.__lock = threading.Lock()
+        self.__wallets = {}
+        # One lock per wallet - transfers of one wallet run one after the other, so they get one nonce after the other
+        self.__transfer_locks = {}
+        self.load()
+
+    def load(self):
+        # A node which never created a wallet has no file yet
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename, mode='r') as f:
+                for line in f:
+                    if line.strip():
+                        keys = json.loads(line)
+                        self.__add(keys['public_key'], keys['private_key'])
+        except (IOError, ValueError, KeyError):
+            print('Loading wallets failed')
+
+    def __add(self, public_key, private_key):
+        wallet = Wallet(self.node_id, key_scheme(public_key))
+        wallet.public_key = public_key
+        wallet.private_key = private_key
+        self.__wallets[public_key] = wallet
+        self.__transfer_locks[public_key] = threading.Lock()
+        return wallet
+
+    def create(self, scheme=None):
+        """ Create a wallet with new keys, store it and return it. Returns None if the keys couldn't be saved
+
+        Arguments:
+            :scheme: The signature scheme of the keys, None uses the scheme of the store.
+        """
+        wallet = Wallet(self.node_id, scheme if scheme != None else self.scheme)
+        # Generating the keys takes the longest, nobody has to wait for it
+        wallet.create_keys()
+        with self.__lock:
+            try:
+                with open(self.filename, mode='a') as f:
+                    f.write(json.dumps({'public_key': wallet.public_key, 'private_key': wallet.private_key}))
+                    f.write('\n')
+                    # A wallet we lose holds coins nobody can spend anymore, so it has to be on the disk before we hand out its address
+                    f.flush()
+                    os.fsync(f.fileno())
+            except IOError:
+                print('Saving wallet failed')
+                return None
+            return self.__add(wallet.public_key, wallet.private_key)
+
+    def get(self, address):
+        """ Return the wallet of the address, None if we don't hold it """
+        return self.__wallets.get(address)
+
+    def addresses(self):
+        with self.__lock:
+            return list(self.__wallets)
+
+    def __contains__(self, address):
+        return address in self.__wallets
+
+    def __len__(self):
+        return len(self.__wallets)
+
+    def transfer(self, address, recipient, amount, get_next_nonce, add):
+        """ Sign a transfer from the wallet of the address with the next nonce of its account and hand the transaction to add.
+        Returns a tuple (transaction, success) - the transaction as a dictionary and the result of add.
+        Raises a KeyError if we don't hold the wallet.
+
+        Arguments:
+            :address: The address of the wallet which sends the coins.
+            :recipient: The recipient of the coins.
+            :amount: The amount of coins.
+            :get_next_nonce: Reference to the get_next_nonce function of the blockchain.
+            :add: A function which adds the transaction (a dictionary) to the blockchain and returns True if it was added.
+        """
+        wallet = self.__wallets[address]
+        # The next nonce only moves on once the transaction is added, so the lock is held until add returns
+        with self.__transfer_locks[address]:
+            nonce = get_next_nonce(address)
+            transaction = {
+                'sender': address,
+                'recipient': recipient,
+                'amount': amount,
+                'signature': wallet.sign_transaction(address, recipient, amount, nonce),
+                'nonce': nonce
+            }
+            return (transaction, add(transaction))